@@ -5,7 +5,7 @@ import os
 import uuid
 from datetime import datetime
 from functools import lru_cache
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Mapping, Tuple, Optional
 from collections import defaultdict, Counter
 from textwrap import dedent
 import smtplib, ssl
@@ -19,6 +19,8 @@ except Exception:
 import pandas as pd  # ให้แน่ใจว่ามี pandas ใช้สร้าง DataFrame สำหรับกราฟ
 from email.message import EmailMessage
 
+from course_catalog import CourseCatalog, CourseRecord, catalog_version
+
 # =============================
 # Page config & global styles
 # =============================
@@ -149,90 +151,38 @@ def load_courses_from_gsheets() -> List[Dict]:
         st.warning(f"ไม่สามารถโหลดคาแทล็อกจาก Google Sheets ได้ ใช้ข้อมูลตัวอย่างแทน — {e}")
         return [_normalize_course_row(r) for r in FALLBACK_ROWS]
 
-@st.cache_data(ttl=300)
-def build_catalog_struct(course_rows: List[Dict]):
-    """
-    คืนค่า:
-      - COURSE_TYPES: dict[str,str] (ใช้ label เป็น key และ value)
-      - FACULTIES_BY_TYPE: {category: {fac_code: fac_name}}
-      - COURSE_CATALOG_BY_TYPE: {category: {fac_code: [course,...]}}
-      - COURSE_LUT: {course_code: meta}
-      - ALL_COURSES: flat list (บางส่วนของโค้ดเก่าอาจยังใช้)
-    """
-    cats = sorted({r["course_type"] for r in course_rows if r.get("course_type")})
-    COURSE_TYPES = {c: c for c in cats}
-
-    FACULTIES_BY_TYPE: Dict[str, Dict[str, str]] = defaultdict(dict)
-    COURSE_CATALOG_BY_TYPE: Dict[str, Dict[str, List[Dict]]] = defaultdict(lambda: defaultdict(list))
-    for r in course_rows:
-        ctype = r["course_type"]
-        fac_code = r["faculty"]
-        fac_name = r["faculty_name"] or fac_code
-        FACULTIES_BY_TYPE[ctype][fac_code] = fac_name
-        COURSE_CATALOG_BY_TYPE[ctype][fac_code].append({
-            "code": r["code"],
-            "name": r["name"],
-            "desc_th": r.get("desc_th",""),
-            "desc_en": r.get("desc_en",""),
-            "credit": r.get("credit"),
-            "grading": r.get("grading"),
-            "updated_at": r.get("updated_at"),
-            "prereq_en": r.get("prereq_en",""),
-        })
+@st.cache_resource(max_entries=2)
+def _build_course_catalog(version: str, _course_rows: List[Dict]) -> CourseCatalog:
+    return CourseCatalog.from_rows(version, _course_rows)
+
+
+def get_course_catalog() -> CourseCatalog:
+    rows = load_courses_from_gsheets()
+    return _build_course_catalog(catalog_version(rows), rows)
+
 
-    # sort by code
-    for ctype in COURSE_CATALOG_BY_TYPE:
-        for fac in COURSE_CATALOG_BY_TYPE[ctype]:
-            COURSE_CATALOG_BY_TYPE[ctype][fac].sort(key=lambda x: x.get("code",""))
-
-    ALL_COURSES: List[Dict] = []
-    for ctype, facs in COURSE_CATALOG_BY_TYPE.items():
-        for fac_code, items in facs.items():
-            fac_name = FACULTIES_BY_TYPE[ctype].get(fac_code, fac_code)
-            for c in items:
-                ALL_COURSES.append({
-                    "course_type": ctype,
-                    "faculty": fac_code,
-                    "faculty_name": fac_name,
-                    "department": "",
-                    "department_name": "",
-                    "year": 0,
-                    "code": c["code"],
-                    "name": c["name"],
-                    "desc_th": c.get("desc_th",""),
-                    "desc_en": c.get("desc_en",""),
-                    "credit": c.get("credit"),
-                    "prereq_en": c.get("prereq_en"),
-                })
-    ALL_COURSES.sort(key=lambda r: (r["course_type"], r["faculty"], r["code"]))
-
-    COURSE_LUT: Dict[str, Dict] = {}
-    for r in course_rows:
-        COURSE_LUT[r["code"]] = {
-            "credit": r.get("credit"),
-            "grading": r.get("grading"),
-            "updated_at": r.get("updated_at"),
-            "prereq_en": r.get("prereq_en"),
-            "desc_th": r.get("desc_th"),
-            "desc_en": r.get("desc_en"),
-            "type": r.get("course_type"),
-            "faculty": r.get("faculty"),
-            "faculty_name": r.get("faculty_name"),
-            "name": r.get("name"),
-        }
-
-    return COURSE_TYPES, dict(FACULTIES_BY_TYPE), {k: dict(v) for k,v in COURSE_CATALOG_BY_TYPE.items()}, ALL_COURSES, COURSE_LUT
-
-# Build catalog structures (from Sheets)
-_COURSE_ROWS = load_courses_from_gsheets()
-COURSE_TYPES, FACULTIES_BY_TYPE, COURSE_CATALOG_BY_TYPE, ALL_COURSES, COURSE_LUT = build_catalog_struct(_COURSE_ROWS)
+# Build catalog (from Sheets) — แบบ lazy:
+# ไม่โหลดชีตรายวิชาตอน import เพื่อให้หน้า login ขึ้นได้ทันทีหลัง cold start; โหลดครั้งแรกเมื่อหน้าไหนต้องใช้
+_CATALOG = None  # memo ต่อรอบรัน (สคริปต์รันใหม่ทุก rerun)
+
+def _catalog() -> CourseCatalog:
+    global _CATALOG
+    if _CATALOG is None:
+        _CATALOG = get_course_catalog()
+    return _CATALOG
 
 # convenience helpers
-def list_faculties_by_type(course_type: str) -> dict:
-    return FACULTIES_BY_TYPE.get(course_type, {})
+def course_types() -> Mapping[str, str]:
+    return _catalog().types
+
+def list_faculties_by_type(course_type: str) -> Mapping[str, str]:
+    return _catalog().list_faculties_by_type(course_type)
 
-def list_courses(course_type: str, faculty_code: str) -> list:
-    return COURSE_CATALOG_BY_TYPE.get(course_type, {}).get(faculty_code, [])
+def list_courses(course_type: str, faculty_code: str) -> Tuple[CourseRecord, ...]:
+    return _catalog().list_courses(course_type, faculty_code)
+
+def course_meta(code: str):
+    return _catalog().get(code) or {}
 
 # -----------------------------
 # Auth (prototype admin fallback)
@@ -518,7 +468,7 @@ def load_data() -> Dict:
 def save_data(data: Dict) -> None:
     get_storage().save_data(data)
     st.session_state["data_version"] = st.session_state.get("data_version", 0) + 1
-    try: _cached_load_data.clear()
+    try: _cached_load_data.clear(); _cached_summary_rows.clear()
     except Exception: pass
 
 # -----------------------------
@@ -1072,30 +1022,6 @@ def star_histogram(reviews: List[Dict]) -> pd.DataFrame:
     data = {"ดาว": [5,4,3,2,1], "จำนวน": [cnt.get(5,0), cnt.get(4,0), cnt.get(3,0), cnt.get(2,0), cnt.get(1,0)]}
     return pd.DataFrame(data).set_index("ดาว")
 
-def build_summary_rows(approved: List[Dict]) -> List[Dict]:
-    agg: Dict[Tuple[str,str,str,str,str], Dict[str,float]] = {}
-    for r in approved:
-        if r.get("status") != "approved": continue
-        key = (r.get("course_type",""), r.get("faculty","-"), r.get("faculty_name","-"),
-               r.get("course_code",""), r.get("course_name","-"))
-        obj = agg.setdefault(key, {"sum":0.0, "count":0.0})
-        obj["sum"] += float(r.get("rating",0)); obj["count"] += 1
-    rows: List[Dict] = []
-    for (ctype, code, name, ccode, cname), v in agg.items():
-        avg = v["sum"]/v["count"] if v["count"] else 0.0
-        rows.append({
-            "ประเภท": ctype,
-            "คณะ": f"{code} - {name}",
-            "รหัสวิชา": ccode,
-            "รายวิชา": cname,
-            "ค่าเฉลี่ย": round(avg,2),
-            "ดาว": star_str(int(round(avg))),
-            "จำนวนรีวิว": int(v["count"]),
-            "เฉลี่ย/5": avg/5.0,
-        })
-    rows.sort(key=lambda r: (r["ประเภท"], r["คณะ"], r["รหัสวิชา"]))
-    return rows
-
 # -----------------------------
 # Student page
 # -----------------------------
@@ -1110,11 +1036,12 @@ def page_student(data: Dict):
         st.subheader("เลือกประเภท / คณะ / รายวิชา")
 
         # ประเภท (dynamic จากชีต)
-        type_keys = list(COURSE_TYPES.keys())
+        type_labels = course_types()
+        type_keys = list(type_labels.keys())
         if not type_keys:
             st.error("ยังไม่มีหมวดรายวิชาใน Google Sheet"); st.stop()
         type_ix = st.selectbox("ประเภทของรายวิชา", options=list(range(len(type_keys))),
-                               format_func=lambda i: COURSE_TYPES[type_keys[i]], key="stu_type_ix")
+                               format_func=lambda i: type_labels[type_keys[i]], key="stu_type_ix")
         sel_type = type_keys[type_ix]
 
         # คณะ (ตามประเภท)
@@ -1149,7 +1076,7 @@ def page_student(data: Dict):
             <span class='codepill'>{course['code']}</span> <b>{course['name']}</b>
           </div>
           <div class='muted' style="margin-bottom:.5rem;">
-            ประเภท: {COURSE_TYPES[sel_type]} • คณะ: {fac_code} - {fac_name}
+            ประเภท: {type_labels[sel_type]} • คณะ: {fac_code} - {fac_name}
           </div>
           {f'<div style="margin-bottom:.75rem;">' + ' • '.join(meta_bits) + '</div>' if meta_bits else ''}
 
@@ -1278,10 +1205,17 @@ def build_summary_rows(approved: List[Dict]) -> List[Dict]:
     rows.sort(key=lambda r: (r["ประเภท"], r["คณะ"], r["รหัสวิชา"]))
     return rows
 
+@st.cache_data(ttl=10)
+def _cached_summary_rows(data_version: int) -> List[Dict]:
+    """สรุปต่อรายวิชาคำนวณครั้งเดียวต่อ data_version (save_data เพิ่มเวอร์ชัน → คำนวณใหม่)"""
+    return build_summary_rows(_cached_load_data(data_version).get("approved_reviews", []))
+
 def summary_table_panel(data: Dict):
     st.subheader("📊 สรุปภาพรวม (ตาราง)")
-    approved = [r for r in data.get("approved_reviews", []) if r.get("status") == "approved"]
-    all_rows = build_summary_rows(approved)
+    try:
+        all_rows = _cached_summary_rows(st.session_state.get("data_version", 0))
+    except Exception:  # เช่น เกินโควต้า Sheets → สรุปจาก data ที่หน้าได้มาแทน
+        all_rows = build_summary_rows(data.get("approved_reviews", []))
     if not all_rows:
         st.info("ยังไม่มีข้อมูลสรุป"); return
 
@@ -1355,7 +1289,7 @@ def page_admin(data: Dict):
         with col1:
             t_opts = admin_type_options(pending)
             p_type = st.selectbox("ประเภท", t_opts, index=0, key="stu_a_type",
-                      format_func=lambda v: "ทั้งหมด" if v=="ทั้งหมด" else COURSE_TYPES.get(v, v))
+                      format_func=lambda v: "ทั้งหมด" if v=="ทั้งหมด" else course_types().get(v, v))
             sel_type = None if p_type=="ทั้งหมด" else p_type
         with col2:
             fac_map = admin_faculty_map(pending, sel_type)
@@ -1411,10 +1345,10 @@ def page_admin(data: Dict):
             if course_reviews:
                 render_star_histogram_altair(course_reviews, title=f"สรุปแนวโน้มรีวิว — {a_course}")
 
-        # โชว์ meta รายวิชา (จาก COURSE_LUT) + กราฟสรุปดาว
+        # โชว์ meta รายวิชา (จาก course_meta) + กราฟสรุปดาว
         if a_course != "ทั้งหมด":
             code = a_course.split(" ")[0]
-            info = COURSE_LUT.get(code, {})
+            info = course_meta(code)
             meta2 = []
             if info.get("credit"): meta2.append(f"หน่วยกิต: {info['credit']}")
             if info.get("prereq_en"): meta2.append(f"เงื่อนไขรายวิชา: {info['prereq_en']}")
@@ -1,13 +1,30 @@
 import streamlit as st
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import math
 import os
+import random
+import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
 from functools import lru_cache
-from typing import Dict, List, Tuple, Optional
-from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple, Optional
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from textwrap import dedent
+import numpy as np
 import pandas as pd
+
+from course_catalog import CourseCatalog, CourseRecord, catalog_version
 import smtplib, ssl
 from email.message import EmailMessage
 # -----------------------------
@@ -209,11 +226,23 @@ COURSE_CATALOG_BY_TYPE = {
 }
 
 
-def list_faculties_by_type(course_type: str) -> dict:
-    return FACULTIES_BY_TYPE.get(course_type, {})
+@st.cache_resource(max_entries=2)
+def _build_course_catalog(version: str) -> CourseCatalog:
+    return CourseCatalog.from_nested(version, COURSE_TYPES, FACULTIES_BY_TYPE, COURSE_CATALOG_BY_TYPE)
+
+
+def get_course_catalog() -> CourseCatalog:
+    return _build_course_catalog(catalog_version(COURSE_TYPES, FACULTIES_BY_TYPE, COURSE_CATALOG_BY_TYPE))
+
 
-def list_courses(course_type: str, faculty_code: str) -> list:
-    return COURSE_CATALOG_BY_TYPE.get(course_type, {}).get(faculty_code, [])
+COURSE_CATALOG = get_course_catalog()
+
+
+def list_faculties_by_type(course_type: str) -> Mapping[str, str]:
+    return COURSE_CATALOG.list_faculties_by_type(course_type)
+
+def list_courses(course_type: str, faculty_code: str) -> Tuple[CourseRecord, ...]:
+    return COURSE_CATALOG.list_courses(course_type, faculty_code)
 
 
 
@@ -229,38 +258,8 @@ USERS: Dict[str, Dict[str, str]] = {
 # ==============================================
 # Faculty / Department / Course Catalog (Prototype)
 # ==============================================
-@lru_cache(maxsize=1)
-# สร้างรายการคอร์สแบบ "แบน" จากคาแทล็อกใหม่ (ประเภท → คณะ → รายวิชา)
-def flatten_catalog() -> list[dict]:
-    rows: list[dict] = []
-    for ctype, facs in COURSE_CATALOG_BY_TYPE.items():           # GE / FE / ME
-        fac_map = FACULTIES_BY_TYPE.get(ctype, {})
-        for fac_code, courses in facs.items():                   # SI / PY / SC / ...
-            fac_name = fac_map.get(fac_code, fac_code)
-            for c in courses:                                    # {"code": "...", "name": "...", ...}
-                rows.append({
-                    # ฟิลด์อ้างอิงตามโครงใหม่
-                    "course_type": ctype,
-                    "faculty": fac_code,
-                    "faculty_name": fac_name,
-
-                    # ฟิลด์ที่โค้ดบางส่วนเก่ายังเรียกใช้ — ให้เว้นไว้/เป็นค่าว่างเพื่อกันพัง
-                    "department": "",
-                    "department_name": "",
-                    "year": 0,
-
-                    # เมทาดาต้ารายวิชา (คงชื่อ key 'code','name' ตามเดิม)
-                    "code": c["code"],
-                    "name": c["name"],
-                    "desc_th": c.get("desc_th", ""),
-                    "desc_en": c.get("desc_en", ""),
-                    "credit": c.get("credit"),
-                    "prereq": c.get("prereq"),
-                })
-    rows.sort(key=lambda r: (r["course_type"], r["faculty"], r["code"]))
-    return rows
-
-ALL_COURSES = flatten_catalog()
+# รายการคอร์สแบบ "แบน" (เรียงตาม ประเภท, คณะ, รหัส) — มาจาก index ของ CourseCatalog
+ALL_COURSES = COURSE_CATALOG.courses
 
 
 # -----------------------------
@@ -296,6 +295,291 @@ except NameError:
     ]
 
 
+# -----------------------------
+# Instrumentation (stage timers)
+# -----------------------------
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+METRICS_WINDOW = 512  # จำนวนครั้งล่าสุดที่เก็บต่อ stage (ring buffer)
+
+
+class StageMetrics:
+    """เวลา (ms) ล่าสุดของแต่ละ stage ใน ring buffer + จำนวนครั้งสะสม; summary() คืน p50/p95"""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, ms: float) -> None:
+        with self._lock:
+            buf = self._samples.get(stage)
+            if buf is None:
+                buf = self._samples[stage] = deque(maxlen=self.window)
+            buf.append(ms)
+            self.counts[stage] += 1
+
+    def summary(self) -> List[Dict]:
+        with self._lock:
+            snap = {k: np.fromiter(v, dtype=float) for k, v in self._samples.items()}
+            counts = dict(self.counts)
+        rows = []
+        for stage in sorted(snap):
+            p50, p95 = np.percentile(snap[stage], [50, 95])
+            rows.append({"stage": stage, "calls": counts[stage], "p50 (ms)": round(float(p50), 2),
+                         "p95 (ms)": round(float(p95), 2), "max (ms)": round(float(snap[stage].max()), 2)})
+        return rows
+
+    def reset(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self.counts.clear()
+
+
+@st.cache_resource
+def get_process_metrics() -> StageMetrics:
+    return StageMetrics()
+
+
+def _session_metrics() -> Optional[StageMetrics]:
+    """ของ session ปัจจุบัน; thread เบื้องหลัง (write-behind, export) ไม่มี session → None"""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.setdefault("_stage_metrics", StageMetrics())
+
+
+def record_stage(stage: str, ms: float, process: Optional[StageMetrics] = None) -> None:
+    (process or get_process_metrics()).record(stage, ms)
+    session = _session_metrics()
+    if session is not None:
+        session.record(stage, ms)
+
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, (time.perf_counter() - t0) * 1000.0)
+
+
+def instrumented(stage: Optional[str] = None):
+    """decorator: จับเวลาทุกครั้งที่เรียกฟังก์ชัน (ชื่อ stage = ชื่อฟังก์ชันถ้าไม่ระบุ)"""
+    def deco(fn):
+        name = stage or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+# -----------------------------
+# Sheets API call scheduler (quota + retry)
+# -----------------------------
+
+SHEETS_READS_PER_MINUTE = int(st.secrets.get("SHEETS_READS_PER_MINUTE", 60))   # โควต้าต่อผู้ใช้ต่อนาทีของ Sheets API
+SHEETS_WRITES_PER_MINUTE = int(st.secrets.get("SHEETS_WRITES_PER_MINUTE", 60))
+SHEETS_MAX_RETRIES = 6
+SHEETS_MAX_WAIT = 120.0  # วินาที: รอคิวโควต้านานสุดเท่านี้ก่อนยอมแพ้
+
+# write-behind: การอนุมัติ/ปฏิเสธ/ส่งรีวิวลง journal ในเครื่องก่อน แล้วค่อยทยอยส่งขึ้นชีตเป็นชุด
+SHEETS_WRITE_BEHIND = bool(st.secrets.get("SHEETS_WRITE_BEHIND", False))
+SHEETS_WRITE_BEHIND_MS = int(st.secrets.get("SHEETS_WRITE_BEHIND_MS", 500))
+SHEETS_WRITE_BEHIND_MAX_OPS = int(st.secrets.get("SHEETS_WRITE_BEHIND_MAX_OPS", 20))
+SHEETS_JOURNAL_PATH = st.secrets.get("SHEETS_JOURNAL_PATH", os.path.join("data", "sheets_journal.jsonl"))
+
+# เมธอดของ gspread ที่เป็นการอ่าน (ปลอดภัยที่จะ retry และรวมคำขอซ้ำได้)
+SHEETS_READ_METHODS = frozenset({
+    "get_all_values", "get_all_records", "get", "get_values", "batch_get", "values_batch_get",
+    "row_values", "col_values", "acell", "cell", "worksheet", "worksheets", "fetch_sheet_metadata",
+})
+
+
+def _api_status(e: Exception) -> Optional[int]:
+    """ดึง HTTP status จาก gspread.exceptions.APIError (รองรับหลายเวอร์ชัน)"""
+    code = getattr(e, "code", None)
+    if code is None:
+        code = getattr(getattr(e, "response", None), "status_code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """token bucket ง่าย ๆ: เติม rate_per_min/60 โทเคนต่อวินาที จุสูงสุด capacity"""
+
+    def __init__(self, rate_per_min: float, capacity: Optional[float] = None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(capacity or rate_per_min)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> float:
+        """รอจนได้ 1 โทเคน คืนเวลาที่ต้องรอ (วินาที); รอเกิน timeout → TimeoutError"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                need = (1 - self.tokens) / self.rate
+            if waited + need > timeout:
+                raise TimeoutError("Sheets API quota queue timeout")
+            time.sleep(need)
+            waited += need
+
+    def available(self) -> float:
+        """โทเคนที่เหลือตอนนี้ (ไม่หัก) — ใช้แสดง headroom ของโควต้า"""
+        with self._lock:
+            return min(self.capacity, self.tokens + (time.monotonic() - self.stamp) * self.rate)
+
+    def drain(self) -> None:
+        """เจอ 429 แปลว่าโควต้าฝั่งเซิร์ฟเวอร์หมดแล้ว — ทิ้งโทเคนที่เหลือ ให้คำขอถัดไปรอรอบเติม"""
+        with self._lock:
+            self.tokens = min(self.tokens, 0.0)
+
+
+class SheetsScheduler:
+    """
+    ชั้นกลางของทุกการเรียก gspread (แชร์ทั้งโปรเซส)
+    - token bucket แยกอ่าน/เขียน ตามโควต้าต่อนาที: ช่วงคนใช้เยอะคำขอจะเข้าคิวแทนการ error
+    - 429 / 5xx → exponential backoff + jitter; การเขียน retry เฉพาะ 429 (5xx อาจเขียนไปแล้ว ลองซ้ำจะได้แถวซ้ำ)
+    - การอ่านที่เหมือนกันและกำลังรออยู่ จะรวมเป็นคำขอเดียว (ผู้มาทีหลังรอผลเดียวกัน)
+    - stats(): ตัวนับ calls / throttled / retried / coalesced / errors
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, reads_per_min: int = SHEETS_READS_PER_MINUTE, writes_per_min: int = SHEETS_WRITES_PER_MINUTE):
+        self.read_bucket = TokenBucket(reads_per_min)
+        self.write_bucket = TokenBucket(writes_per_min)
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple, Dict] = {}
+        self.counters = defaultdict(int)
+        self.metrics = get_process_metrics()  # เก็บไว้ตรงนี้ เพราะ thread write-behind เรียกผ่านตัวนี้ด้วย
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+    def call(self, fn, *args, read: bool = False, key: Optional[Tuple] = None, **kwargs):
+        if read and key is not None:
+            return self._coalesced(key, fn, args, kwargs)
+        return self._run(fn, args, kwargs, read)
+
+    def _coalesced(self, key: Tuple, fn, args, kwargs):
+        with self._lock:
+            slot = self._inflight.get(key)
+            leader = slot is None
+            if leader:
+                slot = self._inflight[key] = {"done": threading.Event()}
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            slot["done"].wait()
+            if "error" in slot:
+                raise slot["error"]
+            return slot["result"]
+        try:
+            slot["result"] = self._run(fn, args, kwargs, True)
+            return slot["result"]
+        except Exception as e:
+            slot["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            slot["done"].set()
+
+    def _attempt(self, fn, args, kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record_stage(f"sheets.{getattr(fn, '__name__', 'call')}", (time.perf_counter() - t0) * 1000.0, self.metrics)
+
+    def _run(self, fn, args, kwargs, read: bool):
+        bucket = self.read_bucket if read else self.write_bucket
+        self._count("reads" if read else "writes")
+        deadline = time.monotonic() + SHEETS_MAX_WAIT
+        attempt = 0
+        while True:
+            waited = bucket.acquire(max(0.0, deadline - time.monotonic()))
+            if waited > 0:
+                self._count("throttled")
+                record_stage("sheets.quota_wait", waited * 1000.0, self.metrics)
+            try:
+                return self._attempt(fn, args, kwargs)
+            except Exception as e:
+                status = _api_status(e)
+                retryable = status == 429 or (read and status in self.RETRY_STATUSES)
+                if not retryable or attempt >= SHEETS_MAX_RETRIES:
+                    if status is not None:  # นับเฉพาะ error จาก API (ไม่นับเช่น WorksheetNotFound)
+                        self._count("errors")
+                    raise
+                if status == 429:
+                    self._count("rate_limited")
+                    bucket.drain()
+                delay = min(32.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+                if time.monotonic() + delay > deadline:
+                    self._count("errors")
+                    raise
+                attempt += 1
+                self._count("retried")
+                time.sleep(delay)
+
+
+@st.cache_resource
+def get_sheets_scheduler() -> SheetsScheduler:
+    return SheetsScheduler()
+
+
+class _ScheduledProxy:
+    """ห่อ Spreadsheet/Worksheet ของ gspread ให้ทุกเมธอดวิ่งผ่าน SheetsScheduler (attribute อื่นส่งผ่านตรง)"""
+
+    def __init__(self, target, scheduler: SheetsScheduler):
+        self._target = target
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        read = name in SHEETS_READ_METHODS
+        owner = getattr(self._target, "id", None) or id(self._target)
+
+        def scheduled(*args, **kwargs):
+            key = (owner, name, repr(args), repr(sorted(kwargs.items()))) if read else None
+            result = self._scheduler.call(attr, *args, read=read, key=key, **kwargs)
+            # worksheet()/add_worksheet() คืน Worksheet → ห่อต่อ ให้การเรียกบนชีตนั้นผ่านตัวจัดคิวด้วย
+            if name in ("worksheet", "add_worksheet") and result is not None:
+                return _ScheduledProxy(result, self._scheduler)
+            if name == "worksheets":
+                return [_ScheduledProxy(w, self._scheduler) for w in result]
+            return result
+
+        return scheduled
+
+
+def _lazy_ws(title: str):
+    """property ของ worksheet ที่ดึง handle เมื่อใช้ครั้งแรก (กำหนดค่าตรง ๆ ได้ เช่นตอนทดสอบ)"""
+    return property(lambda self: self._schema_ws(title),
+                    lambda self, ws: self._ws_handles.__setitem__(title, ws))
+
 
 class GoogleSheetsStorage:
     """
@@ -313,28 +597,106 @@ class GoogleSheetsStorage:
         if not self.spreadsheet_key:
             raise RuntimeError("Missing SPREADSHEET_KEY in secrets")
 
+        # สร้างแค่ credentials (ยังไม่ยิงเน็ต) — เปิดสเปรดชีต/ดึง worksheet/ตรวจ schema ตอนใช้ครั้งแรก
         self.gc = gspread.service_account_from_dict(svc_info)
-        self.ss = self.gc.open_by_key(self.spreadsheet_key)
-
-        # worksheets ที่ต้องใช้
-        self.ws_pending  = self._get_or_create_ws("pending_reviews",  cols=len(HEADERS))
-        self.ws_approved = self._get_or_create_ws("approved_reviews", cols=len(HEADERS))
-        self.ws_users    = self._get_or_create_ws("users",            cols=len(USERS_HEADERS))
-        self.ws_tokens   = self._get_or_create_ws("tokens",           cols=len(TOKENS_HEADERS))
-
-        # บังคับหัวตารางให้ครบ (เติมหัวที่ตกหล่น “ต่อท้าย” ไม่ลบของเดิม)
-        self._ensure_headers(self.ws_pending,  HEADERS)
-        self._ensure_headers(self.ws_approved, HEADERS)
-        self._ensure_headers(self.ws_users,    USERS_HEADERS)
-        self._ensure_headers(self.ws_tokens,   TOKENS_HEADERS)
+        self._init_state()
+        if SHEETS_WRITE_BEHIND:
+            self._start_write_behind(SHEETS_JOURNAL_PATH)
 
     # ---------- internal helpers ----------
 
-    def _get_or_create_ws(self, title: str, rows: int = 2000, cols: int = 20):
-        try:
-            return self.ss.worksheet(title)
-        except Exception:
-            return self.ss.add_worksheet(title=title, rows=rows, cols=cols)
+    def _open_spreadsheet(self):
+        """เปิดสเปรดชีตผ่าน SheetsScheduler — ทุกการเรียกบน ss/worksheet หลังจากนี้ถูกจัดคิวตามโควต้า"""
+        self.scheduler = get_sheets_scheduler()
+        ss = self.scheduler.call(self.gc.open_by_key, self.spreadsheet_key, read=True)
+        return _ScheduledProxy(ss, self.scheduler)
+
+    def _init_state(self):
+        # snapshot ของชีตรีวิวล่าสุดที่อ่าน/เขียน: bucket -> {"headers", "ids", "id_set", "rows"}
+        # (id_set = set(ids) ไว้เช็กว่ามี id แล้วหรือยังแบบ O(1) — ทุกที่ที่แก้ ids ต้องแก้ id_set ด้วย)
+        self._snapshots: Dict[str, Dict] = {}
+        self._lock = threading.RLock()
+        # index ผู้ใช้ email(lower) -> user สร้างใหม่เมื่ออ่านชีต users ทั้งแผ่น
+        self._users_idx: Optional[Dict[str, Dict]] = None
+        self._users_idx_at = 0.0
+        self._users_rows: Dict[str, int] = {}  # email(lower) -> เลขแถวในชีต users (1-based)
+        self._tokens_idx: Optional[Dict[str, Tuple[int, Dict]]] = None  # token -> (เลขแถว, record)
+        self._tokens_idx_at = 0.0
+        # ผลแปลงชีตรีวิวล่าสุด + write stamp ที่เห็นตอนนั้น (ใช้ข้ามการดาวน์โหลดเมื่อไม่มีใครเขียน)
+        self._parsed: Optional[Dict] = None
+        self._parsed_at = 0.0
+        self._write_stamp: Optional[str] = None
+        self._wb_ops: Optional[List[Dict]] = None  # None = เขียนตรง (ไม่ใช้ write-behind)
+        # handle แบบ lazy
+        self._ss = None
+        self._ws_handles: Dict[str, object] = {}
+        self._schema_ok = False
+
+    def _review_sheets(self):
+        return (("pending_reviews", self.ws_pending), ("approved_reviews", self.ws_approved))
+
+    # ---------- lazy spreadsheet / worksheet handles ----------
+
+    SCHEMA_VERSION = 1  # เพิ่มเมื่อเปลี่ยนชุดชีตหรือหัวตาราง → ครั้งถัดไปจะตรวจ/เติมหัวตารางใหม่ 1 รอบ
+    SCHEMA_VERSION_KEY = "schema_version"
+
+    @property
+    def ss(self):
+        if self._ss is None:
+            with self._lock:
+                if self._ss is None:
+                    self._ss = self._open_spreadsheet()
+        return self._ss
+
+    @ss.setter
+    def ss(self, value) -> None:
+        self._ss = value
+
+    def _sheet_headers(self) -> List[Tuple[str, List[str]]]:
+        return [("pending_reviews", HEADERS), ("approved_reviews", HEADERS),
+                ("users", USERS_HEADERS), ("tokens", TOKENS_HEADERS)]
+
+    def _worksheet(self, title: str, cols: int = 20):
+        """handle ของ worksheet: ดึงรายชื่อชีตทั้งหมดในคำขอเดียวเมื่อใช้ครั้งแรก; ไม่มีชีตนั้น → สร้าง"""
+        ws = self._ws_handles.get(title)
+        if ws is None:
+            with self._lock:
+                if not self._ws_handles:
+                    self._ws_handles.update({w.title: w for w in self.ss.worksheets()})
+                ws = self._ws_handles.get(title)
+                if ws is None:
+                    ws = self._ws_handles[title] = self.ss.add_worksheet(title=title, rows=2000, cols=cols)
+        return ws
+
+    def _ensure_schema(self) -> None:
+        """
+        bootstrap ครั้งเดียวต่อ deployment: ถ้า schema_version ใน _meta ตรงกับ SCHEMA_VERSION
+        จะข้ามการสร้างชีต/ตรวจหัวตารางทั้งหมด (เสียแค่อ่าน _meta!A1:B3)
+        """
+        if self._schema_ok:
+            return
+        with self._lock:
+            if self._schema_ok:
+                return
+            meta = self._worksheet(self.META_SHEET, cols=2)
+            kv = {r[0]: (r[1] if len(r) > 1 else "") for r in meta.get("A1:B3") if r}
+            if kv.get(self.SCHEMA_VERSION_KEY) != str(self.SCHEMA_VERSION):
+                for title, headers in self._sheet_headers():
+                    # บังคับหัวตารางให้ครบ (เติมหัวที่ตกหล่น “ต่อท้าย” ไม่ลบของเดิม)
+                    self._ensure_headers(self._worksheet(title, cols=len(headers)), headers)
+                meta.update("A1", [["key", "value"],
+                                   [self.WRITE_STAMP_KEY, kv.get(self.WRITE_STAMP_KEY, "")],
+                                   [self.SCHEMA_VERSION_KEY, str(self.SCHEMA_VERSION)]])
+            self._schema_ok = True
+
+    def _schema_ws(self, title: str):
+        self._ensure_schema()
+        return self._worksheet(title)
+
+    ws_pending = _lazy_ws("pending_reviews")
+    ws_approved = _lazy_ws("approved_reviews")
+    ws_users = _lazy_ws("users")
+    ws_tokens = _lazy_ws("tokens")
 
     def _ensure_headers(self, ws, headers=None):
         """
@@ -377,6 +739,7 @@ class GoogleSheetsStorage:
         rows = vals[1:] if len(vals) > 1 else []
         return headers, rows
 
+    @instrumented("sheets.parse_rows")
     def _rows_to_dicts(self, rows: List[List[str]], headers: List[str], default_headers: List[str]) -> List[Dict]:
         """
         map row -> dict ด้วยชื่อหัวคอลัมน์จริง
@@ -411,102 +774,513 @@ class GoogleSheetsStorage:
             rows.append([str(d.get(k, "")) for k in headers])
         return rows
 
-    # ---------- public: reviews ----------
-
-    def load_data(self) -> Dict:
-        # pending
-        hdr_p, rows_p = self._read_all(self.ws_pending)
-        if not hdr_p:
-            self._ensure_headers(self.ws_pending, HEADERS)
-            hdr_p, rows_p = HEADERS, []
-        pending = self._rows_to_dicts(rows_p, hdr_p, HEADERS)
-
-        # approved
-        hdr_a, rows_a = self._read_all(self.ws_approved)
-        if not hdr_a:
-            self._ensure_headers(self.ws_approved, HEADERS)
-            hdr_a, rows_a = HEADERS, []
-        approved = self._rows_to_dicts(rows_a, hdr_a, HEADERS)
-
-        return {"pending_reviews": pending, "approved_reviews": approved}
+    # ---------- users index ----------
+
+    USERS_INDEX_TTL = 60.0         # วินาที: อ่านชีต users ใหม่เผื่อมีการแก้จากที่อื่น (เช่นแก้มือในชีต)
+    USERS_MISS_REFRESH_AFTER = 5.0  # หาไม่เจอ → ยอมอ่านใหม่ได้ถ้า index เก่ากว่านี้
+
+    @staticmethod
+    def _email_key(email: Optional[str]) -> str:
+        return (email or "").strip().lower()
+
+    def _set_users_index(self, users: List[Dict]) -> None:
+        """users ต้องเรียงตามแถวในชีต (แถว 2 เป็นต้นไป)"""
+        with self._lock:
+            self._users_idx = {}
+            self._users_rows = {}
+            for i, u in enumerate(users):
+                key = self._email_key(u.get("email"))
+                if key and key not in self._users_idx:
+                    self._users_idx[key] = u
+                    self._users_rows[key] = i + 2
+            self._users_idx_at = time.monotonic()
+
+    @staticmethod
+    def _row_from_append(resp) -> int:
+        """ดึงเลขแถวจากผลของ append_row (updates.updatedRange เช่น "users!A12:G12"); ไม่รู้ = 0"""
+        try:
+            rng = resp["updates"]["updatedRange"]
+            return int(rng.split("!")[-1].split(":")[0].lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+        except Exception:
+            return 0
+
+    @staticmethod
+    def _col_letter(n: int) -> str:
+        s = ""
+        while n:
+            n, r = divmod(n - 1, 26)
+            s = chr(65 + r) + s
+        return s
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        """ค้นผู้ใช้ด้วย email จาก index ในหน่วยความจำ (ไม่อ่านชีตบน hot path ของการล็อกอิน)"""
+        key = self._email_key(email)
+        age = time.monotonic() - self._users_idx_at
+        if self._users_idx is None or age > self.USERS_INDEX_TTL:
+            self.load_users()
+        u = self._users_idx.get(key)
+        if u is None and time.monotonic() - self._users_idx_at > self.USERS_MISS_REFRESH_AFTER:
+            self.load_users()
+            u = self._users_idx.get(key)
+        return dict(u) if u else None
+
+    # ---------- change detection (meta sheet) ----------
+
+    META_SHEET = "_meta"
+    WRITE_STAMP_KEY = "reviews_write_stamp"
+    WRITE_STAMP_CELL = "B2"          # _meta: แถว 2 = [WRITE_STAMP_KEY, stamp], แถว 3 = [schema_version, n]
+    FULL_RELOAD_INTERVAL = 300.0     # วินาที: โหลดเต็มอย่างน้อยเท่านี้ เผื่อมีคนแก้ชีตด้วยมือ (ไม่ bump stamp)
+
+    ws_meta = _lazy_ws(META_SHEET)
+
+    def _read_write_stamp(self) -> Optional[str]:
+        """probe ราคาถูก: อ่านเซลล์เดียว"""
+        vals = self.ws_meta.get(self.WRITE_STAMP_CELL)
+        return str(vals[0][0]) if vals and vals[0] else ""
+
+    def _stamp_request(self) -> List[Dict]:
+        """request สำหรับเปลี่ยน write stamp — ใส่รวมใน batchUpdate เดียวกับการเขียนรีวิว
+        ใช้ค่าไม่ซ้ำ (เวลา + สุ่ม) แทนตัวนับ +1 เพื่อไม่ต้องอ่านก่อนเขียน และสองโปรเซสไม่ได้ค่าชนกัน"""
+        ws = self.ws_meta
+        self._write_stamp = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        return [{"updateCells": {
+            "rows": [self._row_data([self._write_stamp])],
+            "fields": "userEnteredValue",
+            "start": {"sheetId": ws.id, "rowIndex": 1, "columnIndex": 1},
+        }}]
+
+    # ---------- diff-based review writes ----------
+
+    def _remember_rows(self, bucket: str, headers: List[str], dicts: List[Dict]) -> None:
+        """จำสภาพชีตล่าสุด (ลำดับ id + ค่าแถวที่ serialize แล้ว) ไว้คำนวณ diff ตอน save"""
+        with self._lock:
+            ids = [str(d.get("id", "")) for d in dicts]
+            self._snapshots[bucket] = {
+                "headers": list(headers),
+                "ids": ids,
+                "id_set": set(ids),
+                "rows": self._dicts_to_rows(dicts, headers),
+            }
 
-    def save_data(self, data: Dict) -> None:
+    @staticmethod
+    def _row_data(values: List[str]) -> Dict:
+        # เทียบเท่า value_input_option="RAW" ของ ws.update (เก็บเป็นสตริงตรง ๆ)
+        return {"values": [{"userEnteredValue": {"stringValue": v}} for v in values]}
+
+    @staticmethod
+    def _delete_requests(sheet_id: int, indices: List[int]) -> List[Dict]:
+        """deleteDimension สำหรับแถวข้อมูล (index เริ่ม 0 ไม่นับหัวตาราง) รวมช่วงที่ติดกัน ลบจากล่างขึ้นบน"""
+        spans: List[List[int]] = []
+        for i in sorted(indices):
+            if spans and spans[-1][1] == i:
+                spans[-1][1] = i + 1
+            else:
+                spans.append([i, i + 1])
+        return [{"deleteDimension": {"range": {
+            "sheetId": sheet_id, "dimension": "ROWS",
+            "startIndex": start + 1, "endIndex": end + 1,
+        }}} for start, end in reversed(spans)]
+
+    @classmethod
+    def _append_request(cls, sheet_id: int, rows: List[List[str]]) -> Dict:
+        return {"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [cls._row_data(row) for row in rows],
+            "fields": "userEnteredValue",
+        }}
+
+    def _plan_bucket_diff(self, bucket: str, ws, dicts: List[Dict]) -> Optional[Tuple[List[Dict], Dict]]:
         """
-        เขียนทับทั้งชีตแบบง่าย (เหมาะกับโปรโตไทป์)
-        ถ้าต้องการลดโควตา สามารถเปลี่ยนเป็น partial update ได้ภายหลัง
+        เทียบ dicts (สภาพที่ต้องการ) กับ snapshot แล้วคืน (requests, snapshot ใหม่)
+        - แถวที่ค่าเปลี่ยน → updateCells (ใช้เลขแถวเดิม)
+        - แถวที่หายไป → deleteDimension (ไล่จากล่างขึ้นบน ให้เลขแถวไม่เลื่อน)
+        - แถวใหม่ → appendCells ครั้งเดียวท้ายชีต
+        คืน None ถ้ายังไม่มี snapshot หรือมีรายการที่ไม่มี id (ให้ไปเขียนทับทั้งชีตแทน)
         """
-        pending = data.get("pending_reviews", [])
-        approved = data.get("approved_reviews", [])
+        snap = self._snapshots.get(bucket)
+        if snap is None or any(not d.get("id") for d in dicts):
+            return None
+        headers = snap["headers"]
+        desired: Dict[str, List[str]] = {}
+        for d, row in zip(dicts, self._dicts_to_rows(dicts, headers)):
+            desired[str(d["id"])] = row
+
+        updates: List[Tuple[int, List[str]]] = []
+        deletes: List[int] = []
+        kept: List[Tuple[str, List[str]]] = []
+        seen = set()
+        for i, (rid, row) in enumerate(zip(snap["ids"], snap["rows"])):
+            if not rid:  # แถวที่ไม่มี id (เช่นแถวว่าง) — ไม่แตะ
+                kept.append((rid, row))
+                continue
+            if rid not in desired or rid in seen:
+                deletes.append(i)
+                continue
+            seen.add(rid)
+            if desired[rid] != row:
+                updates.append((i, desired[rid]))
+            kept.append((rid, desired[rid]))
+        added = [(rid, row) for rid, row in desired.items() if rid not in seen]
+
+        sheet_id = ws.id
+        requests: List[Dict] = []
+        for i, row in updates:
+            requests.append({"updateCells": {
+                "rows": [self._row_data(row)],
+                "fields": "userEnteredValue",
+                "start": {"sheetId": sheet_id, "rowIndex": i + 1, "columnIndex": 0},
+            }})
+        requests.extend(self._delete_requests(sheet_id, deletes))
+        if added:
+            requests.append(self._append_request(sheet_id, [row for _, row in added]))
+
+        rows_after = kept + added
+        ids_after = [rid for rid, _ in rows_after]
+        new_snap = {
+            "headers": headers,
+            "ids": ids_after,
+            "id_set": set(ids_after),
+            "rows": [row for _, row in rows_after],
+        }
+        return requests, new_snap
 
-        # pending
-        self.ws_pending.clear()
-        self.ws_pending.update("A1", [HEADERS] + self._dicts_to_rows(pending, HEADERS))
+    def _snapshot_is_current(self, bucket: str, ws) -> bool:
+        """
+        ชีตยังเรียงแถวตรงกับ snapshot ไหม — อ่านคอลัมน์ id คอลัมน์เดียวมาเทียบ
+        (แก้มือในชีต / app.py / อีกโปรเซส ที่แทรกหรือลบแถวโดยไม่ bump stamp จะทำให้เลขแถวเลื่อน)
+        """
+        snap = self._snapshots.get(bucket)
+        if snap is None or "id" not in snap["headers"]:
+            return False
+        sheet_ids = [str(v) for v in ws.col_values(snap["headers"].index("id") + 1)[1:]]
+        known = list(snap["ids"])
+        while sheet_ids and not sheet_ids[-1]:
+            sheet_ids.pop()
+        while known and not known[-1]:
+            known.pop()
+        return sheet_ids == known
+
+    def _stale_buckets(self, buckets) -> List[str]:
+        """bucket ที่ห้ามใช้เลขแถวจาก snapshot: stamp ใน _meta เปลี่ยน (= ทุกชีต) หรือคอลัมน์ id ไม่ตรง"""
+        wanted = set(buckets)
+        buckets = [b for b, _ in self._review_sheets() if b in wanted]
+        if self._read_write_stamp() != self._write_stamp:
+            return buckets
+        sheets = dict(self._review_sheets())
+        return [b for b in buckets if not self._snapshot_is_current(b, sheets[b])]
+
+    def _merge_remote(self, bucket: str, base: Optional[Dict], dicts: List[Dict]) -> List[Dict]:
+        """
+        three-way merge ก่อน save เมื่อชีตเปลี่ยนหลังจากที่ผู้เรียกโหลดไป (ต้องโหลดชีตใหม่แล้ว)
+        - base = snapshot ที่ผู้เรียกเห็นตอนโหลด, ชีตล่าสุด = self._parsed[bucket], dicts = สิ่งที่ผู้เรียกต้องการ
+        - เอาชีตล่าสุดเป็นตั้ง แล้วใส่เฉพาะสิ่งที่ผู้เรียกแก้จาก base (แก้แถว/ลบแถว/เพิ่มแถวใหม่)
+        - แถวที่อีกโปรเซสเพิ่ม/แก้/ลบ และผู้เรียกไม่ได้แตะ → คงตามชีตล่าสุด (ไม่ถูกเขียนทับด้วยรายการเก่า)
+        ไม่มี base หรือมีรายการที่ไม่มี id → คืน dicts ตามเดิม (ผู้เรียกชนะ)
+        """
+        if base is None or any(not d.get("id") for d in dicts):
+            return dicts
+        base_rows = dict(zip(base["ids"], base["rows"]))
+        mine = {str(d["id"]): d for d in dicts}
+        mine_rows = dict(zip(mine, self._dicts_to_rows(list(mine.values()), base["headers"])))
+        deleted = {rid for rid in base_rows if rid and rid not in mine}
+        changed = {rid for rid, row in mine_rows.items() if base_rows.get(rid) != row}
+        out: List[Dict] = []
+        for r in self._parsed[bucket]:
+            rid = str(r.get("id", ""))
+            if not rid or rid in deleted:
+                continue  # แถวไม่มี id ในชีตไม่แตะ (_plan_bucket_diff เก็บไว้ที่เดิมเอง)
+            out.append(mine[rid] if rid in changed else r)
+        # แถวใหม่จากผู้เรียก; แถวที่ผู้เรียกแก้แต่อีกโปรเซสลบ/ย้ายไปแล้ว → ลบชนะ (กันรีวิวซ้ำสองชีต)
+        out += [mine[rid] for rid in mine if rid not in base_rows]
+        return out
 
-        # approved
-        self.ws_approved.clear()
-        self.ws_approved.update("A1", [HEADERS] + self._dicts_to_rows(approved, HEADERS))
+    def _rewrite_bucket(self, bucket: str, ws, dicts: List[Dict]) -> None:
+        ws.clear()
+        ws.update("A1", [HEADERS] + self._dicts_to_rows(dicts, HEADERS))
+        self._remember_rows(bucket, HEADERS, dicts)
 
-    # ---------- public: users ----------
+    # ---------- review mutations as batchUpdate requests ----------
 
-    def load_users(self) -> List[Dict]:
-        hdr, rows = self._read_all(self.ws_users)
-        if not hdr:
-            self._ensure_headers(self.ws_users, USERS_HEADERS)
+    def _append_requests(self, review: Dict) -> List[Dict]:
+        """
+        requests สำหรับเพิ่มรีวิวท้ายชีต pending แล้วอัปเดต snapshot/ผลแปลงตามทันที
+        ถ้ารู้ snapshot อยู่แล้วและ id นี้มีในชีตแล้ว จะข้าม (เล่น journal ซ้ำหลัง crash ได้ไม่เกิดแถวซ้ำ)
+        """
+        snap = self._snapshots.get("pending_reviews")
+        rid = str(review.get("id", ""))
+        if snap is not None and rid and any(rid in s["id_set"] for s in self._snapshots.values()):
             return []
-        return self._rows_to_dicts(rows, hdr, USERS_HEADERS)
+        headers = snap["headers"] if snap else HEADERS
+        row = self._dicts_to_rows([review], headers)[0]
+        if snap is not None:
+            snap["ids"].append(rid)
+            snap["id_set"].add(rid)
+            snap["rows"].append(row)
+        if self._parsed is not None:
+            self._parsed = dict(self._parsed, pending_reviews=self._parsed["pending_reviews"] + [dict(review)])
+        return [self._append_request(self.ws_pending.id, [row])]
+
+    def _move_requests(self, ids: List[str], from_bucket: str, to_bucket: Optional[str],
+                       status: Optional[str]) -> List[Dict]:
+        """
+        requests สำหรับย้าย ids: deleteDimension ฝั่งต้นทาง + appendCells ฝั่งปลายทาง
+        คำนวณเลขแถวจาก snapshot ปัจจุบัน แล้วอัปเดต snapshot ให้ op ถัดไปใน batch เดียวกันใช้ต่อได้
+        (id ที่ไม่อยู่ต้นทางแล้วจะถูกข้าม — เล่นซ้ำได้)
+        """
+        sheets = dict(self._review_sheets())
+        if from_bucket not in self._snapshots or (to_bucket and to_bucket not in self._snapshots):
+            self._load_sheets()
+        src = self._snapshots[from_bucket]
+        wanted = {str(i) for i in ids}
+        if not wanted & src["id_set"]:
+            return []
+        idx = [i for i, rid in enumerate(src["ids"]) if rid in wanted]
+        if not idx:
+            return []
+        requests = self._delete_requests(sheets[from_bucket].id, idx)
+        moved: List[List[str]] = []
+        if to_bucket:
+            dst = self._snapshots[to_bucket]
+            for i in idx:
+                rec = dict(zip(src["headers"], src["rows"][i]))
+                if status:
+                    rec["status"] = status
+                moved.append([rec.get(h, "") for h in dst["headers"]])
+            requests.append(self._append_request(sheets[to_bucket].id, moved))
+            dst["ids"].extend(src["ids"][i] for i in idx)
+            dst["id_set"].update(src["ids"][i] for i in idx)
+            dst["rows"].extend(moved)
+        gone = set(idx)
+        src["id_set"].difference_update(src["ids"][i] for i in idx)
+        src["ids"] = [rid for i, rid in enumerate(src["ids"]) if i not in gone]
+        src["rows"] = [row for i, row in enumerate(src["rows"]) if i not in gone]
+        if self._parsed is not None:
+            self._parsed = _apply_move(self._parsed, list(wanted), from_bucket, to_bucket, status)
+        return requests
+
+    def _refresh_if_stale(self, buckets) -> None:
+        """
+        ก่อนวางแผน deleteDimension ด้วยเลขแถวจาก snapshot: ถ้า stamp หรือคอลัมน์ id ของชีตต้นทางไม่ตรง
+        ให้โหลดชีตใหม่แล้วค่อยวางแผน — แผนจาก snapshot เก่าจะลบแถวของรีวิวอื่นที่เลื่อนมาแทนที่
+        """
+        buckets = [b for b in buckets if b in self._snapshots]
+        if buckets and self._stale_buckets(buckets):
+            self._load_sheets(force=True)
 
-    def upsert_user(self, user: Dict) -> None:
+    def _commit_requests(self, requests: List[Dict]) -> None:
+        """ส่ง requests + bump stamp ใน batchUpdate เดียว; ล้มเหลว → ทิ้ง snapshot (ถูกแก้ล่วงหน้าไปแล้ว) ให้โหลดใหม่"""
+        if not requests:
+            return
+        try:
+            self.ss.batch_update({"requests": requests + self._stamp_request()})
+        except Exception:
+            self._snapshots.clear()
+            self._parsed = None
+            raise
+
+    # ---------- write-behind (optional) ----------
+
+    def _start_write_behind(self, journal_path: str) -> None:
         """
-        เพิ่ม/แก้ไขผู้ใช้ โดยใช้ email เป็นคีย์
+        โหมด write-behind: append/move ลง journal ในเครื่อง (fsync) แล้วคืนทันที
+        thread เบื้องหลังรวม op ที่ค้างเป็น batchUpdate เดียวทุก SHEETS_WRITE_BEHIND_MS ms
+        หรือเมื่อค้างครบ SHEETS_WRITE_BEHIND_MAX_OPS; op ใน journal ที่ค้างจากรอบก่อน (เช่นโปรเซสตาย) ถูกส่งต่อเมื่อเริ่มใหม่
         """
-        users = self.load_users()
-        email = (user.get("email") or "").strip().lower()
-        idx = next((i for i, u in enumerate(users) if (u.get("email") or "").lower() == email), -1)
-        if idx >= 0:
-            users[idx].update(user)
+        self._wb_journal = journal_path
+        self._wb_lock = threading.Lock()
+        self._wb_wake = threading.Event()
+        self._wb_error = ""
+        ops: List[Dict] = []
+        if os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        ops.append(json.loads(line))
+                    except Exception:
+                        break  # บรรทัดสุดท้ายเขียนไม่ครบตอนโปรเซสตาย
         else:
-            users.append(user)
-
-        self.ws_users.clear()
-        self.ws_users.update("A1", [USERS_HEADERS] + self._dicts_to_rows(users, USERS_HEADERS))
+            base_dir = os.path.dirname(journal_path)
+            if base_dir:
+                os.makedirs(base_dir, exist_ok=True)
+        self._wb_ops = ops
+        threading.Thread(target=self._write_behind_loop, name="sheets-write-behind", daemon=True).start()
+        if ops:
+            self._wb_wake.set()
+
+    def _enqueue(self, op: Dict) -> None:
+        line = json.dumps(op, ensure_ascii=False) + "\n"
+        with self._wb_lock:
+            with open(self._wb_journal, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._wb_ops.append(op)
+            if len(self._wb_ops) >= SHEETS_WRITE_BEHIND_MAX_OPS:
+                self._wb_wake.set()
+
+    def _write_behind_loop(self) -> None:
+        delay = SHEETS_WRITE_BEHIND_MS / 1000.0
+        while True:
+            self._wb_wake.wait(delay)
+            self._wb_wake.clear()
+            try:
+                self.flush()
+                self._wb_error = ""
+                delay = SHEETS_WRITE_BEHIND_MS / 1000.0
+            except Exception as e:
+                # op ยังอยู่ใน journal/คิว — ลองใหม่รอบหน้า ถอยเวลาไม่เกิน 60 วินาที
+                self._wb_error = f"{type(e).__name__}: {e}"
+                delay = min(60.0, delay * 2)
+
+    def pending_writes(self) -> int:
+        return len(self._wb_ops) if self._wb_ops is not None else 0
+
+    def flush(self) -> int:
+        """ส่ง op ที่ค้างทั้งหมดขึ้นชีตใน batchUpdate เดียว คืนจำนวน op ที่ส่ง"""
+        if self._wb_ops is None:
+            return 0
+        with self._lock:
+            with self._wb_lock:
+                ops = list(self._wb_ops)
+            if not ops:
+                return 0
+            if any(b not in self._snapshots for b, _ in self._review_sheets()):
+                self._load_sheets()
+            self._refresh_if_stale({op["from"] for op in ops if op["op"] == "move"})
+            requests: List[Dict] = []
+            for op in ops:
+                if op["op"] == "append":
+                    requests.extend(self._append_requests(op["review"]))
+                elif op["op"] == "move":
+                    requests.extend(self._move_requests(op["ids"], op["from"], op.get("to"), op.get("status")))
+            self._commit_requests(requests)
+            with self._wb_lock:
+                del self._wb_ops[:len(ops)]
+                tmp = self._wb_journal + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for op in self._wb_ops:
+                        f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self._wb_journal)
+            return len(ops)
+
+    def _overlay_pending(self, data: Dict) -> Dict:
+        """ให้ผู้อ่านเห็น op ที่ยังไม่ถูกส่งขึ้นชีต (ไม่แก้ data เดิม)"""
+        with self._wb_lock:
+            ops = list(self._wb_ops)
+        for op in ops:
+            if op["op"] == "append":
+                data = dict(data, pending_reviews=data["pending_reviews"] + [dict(op["review"])])
+            elif op["op"] == "move":
+                data = _apply_move(data, op["ids"], op["from"], op.get("to"), op.get("status"))
+        return data
 
-    # ---------- public: tokens (verify/reset) ----------
+    # ---------- public: reviews ----------
 
-    def load_tokens(self) -> List[Dict]:
-        hdr, rows = self._read_all(self.ws_tokens)
-        if not hdr:
-            self._ensure_headers(self.ws_tokens, TOKENS_HEADERS)
-            return []
-        return self._rows_to_dicts(rows, hdr, TOKENS_HEADERS)
+    def _load_sheets(self, force: bool = False) -> Dict:
+        """
+        อ่านชีตรีวิวทั้งสอง — แต่ถ้า write stamp ใน _meta ไม่เปลี่ยนตั้งแต่ครั้งก่อน
+        จะคืนผลเดิม (object เดิม ห้ามแก้) โดยเสียแค่การอ่านเซลล์เดียว; force=True = อ่านใหม่เสมอ
+        """
+        with self._lock:
+            stamp = self._read_write_stamp()
+            fresh = time.monotonic() - self._parsed_at < self.FULL_RELOAD_INTERVAL
+            if not force and self._parsed is not None and stamp is not None and stamp == self._write_stamp and fresh:
+                return self._parsed
+
+            # pending
+            hdr_p, rows_p = self._read_all(self.ws_pending)
+            if not hdr_p:
+                self._ensure_headers(self.ws_pending, HEADERS)
+                hdr_p, rows_p = HEADERS, []
+            pending = self._rows_to_dicts(rows_p, hdr_p, HEADERS)
+            self._remember_rows("pending_reviews", hdr_p, pending)
+
+            # approved
+            hdr_a, rows_a = self._read_all(self.ws_approved)
+            if not hdr_a:
+                self._ensure_headers(self.ws_approved, HEADERS)
+                hdr_a, rows_a = HEADERS, []
+            approved = self._rows_to_dicts(rows_a, hdr_a, HEADERS)
+            self._remember_rows("approved_reviews", hdr_a, approved)
+
+            self._parsed = {"pending_reviews": pending, "approved_reviews": approved}
+            self._parsed_at = time.monotonic()
+            self._write_stamp = stamp
+            return self._parsed
 
-    def write_tokens(self, tokens: List[Dict]) -> None:
-        self.ws_tokens.clear()
-        self.ws_tokens.update("A1", [TOKENS_HEADERS] + self._dicts_to_rows(tokens, TOKENS_HEADERS))
+    def load_data(self) -> Dict:
+        with self._lock:
+            data = self._load_sheets()
+            if self.pending_writes():
+                data = self._overlay_pending(data)
+            return data
 
-    def add_token(self, token_row: Dict) -> None:
+    def save_data(self, data: Dict) -> None:
         """
-        เพิ่มโทเคนใหม่ 1 แถว (append) – ลดการอ่าน/เขียนทั้งชีต
+        เขียนเฉพาะแถวที่เปลี่ยนจากการโหลดครั้งล่าสุด
+        ทุกชีตรวมเป็น spreadsheets.batchUpdate ครั้งเดียว — ต้นทุนตามจำนวนแถวที่เปลี่ยน ไม่ใช่ขนาดตาราง
+        ถ้าชีตไม่ตรงกับ snapshot แล้ว (อีกโปรเซส bump stamp / มีคนแทรก-ลบแถวเอง) จะโหลดชีตใหม่
+        แล้ว merge สิ่งที่ผู้เรียกแก้เข้ากับชีตล่าสุด (_merge_remote) ก่อนวางแผน diff — ไม่ใช้เลขแถวที่เลื่อนไปแล้ว
+        และไม่เขียนทับการเปลี่ยนแปลงของอีกโปรเซสด้วยรายการเก่า
+        เขียนทับทั้งชีตเฉพาะเมื่อ diff ทำไม่ได้ (มีรายการที่ไม่มี id)
+        (โหมด write-behind: ส่ง op ที่ค้างให้หมดก่อน แล้วเขียนแบบ synchronous)
         """
-        # ให้แน่ใจว่าหัวครบก่อน
-        self._ensure_headers(self.ws_tokens, TOKENS_HEADERS)
-        row = [str(token_row.get(k, "")) for k in TOKENS_HEADERS]
-        self.ws_tokens.append_row(row, value_input_option="USER_ENTERED")
+        with self._lock:
+            self.flush()
+            wanted = {b: data.get(b, []) for b, _ in self._review_sheets()}
+            stale = self._stale_buckets(wanted)
+            if stale:
+                base = {b: self._snapshots.get(b) for b in stale}
+                self._load_sheets(force=True)
+                for b in stale:
+                    wanted[b] = self._merge_remote(b, base[b], wanted[b])
+            requests: List[Dict] = []
+            after: Dict[str, Dict] = {}
+            rewrote = False
+            for bucket, ws in self._review_sheets():
+                dicts = wanted[bucket]
+                plan = self._plan_bucket_diff(bucket, ws, dicts)
+                if plan is None:
+                    self._rewrite_bucket(bucket, ws, dicts)
+                    rewrote = True
+                    continue
+                reqs, after[bucket] = plan
+                requests.extend(reqs)
+            if requests or rewrote:
+                requests.extend(self._stamp_request())
+                self.ss.batch_update({"requests": requests})
+            self._snapshots.update(after)
+            self._parsed = {b: [dict(r) for r in wanted[b]] for b in wanted}
+
+    def append_review(self, review: Dict) -> None:
+        """เพิ่มรีวิวใหม่ท้ายชีต pending + bump stamp ใน batchUpdate ครั้งเดียว (ไม่อ่านชีต)"""
+        if self._wb_ops is not None:
+            self._enqueue({"op": "append", "bucket": "pending_reviews", "review": review})
+            return
+        with self._lock:
+            self._commit_requests(self._append_requests(review))
 
-    def mark_token_used(self, token: str) -> bool:
+    def move_reviews(self, ids: List[str], from_bucket: str, to_bucket: Optional[str] = None,
+                     status: Optional[str] = None) -> None:
         """
-        เซ็ต used_at ให้โทเคนที่ตรง (หาแบบอ่านทั้งหมดแล้วเขียนทับกลับไป)
+        ย้ายรีวิวตาม ids จาก from_bucket ไป to_bucket (to_bucket=None = ลบทิ้ง เช่นปฏิเสธ)
+        แตะเฉพาะแถวที่เกี่ยวข้อง รวมเป็น spreadsheets.batchUpdate ครั้งเดียว
         """
-        tokens = self.load_tokens()
-        found = False
-        now = datetime.now().isoformat(timespec="seconds")
-        for t in tokens:
-            if t.get("token") == token and not t.get("used_at"):
-                t["used_at"] = now
-                found = True
-                break
-        if found:
-            self.write_tokens(tokens)
-        return found
+        if self._wb_ops is not None:
+            self._enqueue({"op": "move", "ids": [str(i) for i in ids], "from": from_bucket,
+                           "to": to_bucket, "status": status})
+            return
+        with self._lock:
+            self._refresh_if_stale([from_bucket])
+            self._commit_requests(self._move_requests(ids, from_bucket, to_bucket, status))
+
+    # ---------- public: users / tokens ----------
+    # อยู่ในคลาสที่ประกาศซ้ำด้านล่าง (GoogleSheetsStorage(GoogleSheetsStorage)) ที่เดียว
 
 
 # Select backend from secrets (default to local JSON)
@@ -539,34 +1313,171 @@ def get_storage():
     # instantiate lazily to allow class overrides above to take effect
     if BACKEND == "gsheets":
         return GoogleSheetsStorage()
+    if BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH, import_local=DATA_FILE, import_sheets_dir=SQLITE_IMPORT_SHEETS_DIR)
     return LocalJSONStorage(DATA_FILE)
 
 
-@st.cache_data(ttl=10)
-def _cached_load_data(data_version: int):
-    return get_storage().load_data()
+DATA_CACHE_TTL = 10  # วินาที: อายุ snapshot ก่อนกลับไปถาม storage ว่ามีการเปลี่ยนแปลงไหม
+
+
+class DataCache:
+    """
+    snapshot ของ load_data() ที่แชร์กันทั้งโปรเซส (ทุก session ใช้ก้อนเดียวกัน)
+    - generation เพิ่มขึ้นทุกครั้งที่ snapshot เปลี่ยน ใช้เป็นคีย์ของแคชปลายน้ำได้
+    - หมดอายุแล้วถาม storage.data_signature() ก่อน (ถ้ามี) — ไม่เปลี่ยนก็ใช้ snapshot เดิมต่อ
+    - ผู้เขียน patch snapshot ตรง ๆ (copy-on-write) แทนการล้างแคชให้ทุกคนโหลดใหม่
+    - ผู้อ่านห้ามแก้ snapshot ที่ได้ไป
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data: Optional[Dict] = None
+        self.generation = 0
+        self._sig = None
+        self._checked_at = 0.0
+
+    @staticmethod
+    def _signature(storage):
+        return storage.data_signature() if hasattr(storage, "data_signature") else None
+
+    def get(self, storage) -> Dict:
+        return self.get_versioned(storage)[0]
+
+    def get_versioned(self, storage) -> Tuple[Dict, int]:
+        """(snapshot, generation) ที่อ่านภายใต้ lock เดียวกัน — แคชปลายน้ำใช้ generation นี้เป็นคีย์
+        (อ่าน generation แยกทีหลังอาจได้รุ่นที่ใหม่กว่า snapshot ถ้ามีการเขียนแทรกระหว่างนั้น)"""
+        # ถือ lock ระหว่างโหลด: session ที่มาพร้อมกันจะรอผลโหลดครั้งเดียวกัน
+        with self._lock:
+            now = time.monotonic()
+            if self.data is not None and now - self._checked_at < DATA_CACHE_TTL:
+                return self.data, self.generation
+            sig = self._signature(storage)
+            if self.data is None or sig is None or sig != self._sig:
+                data = storage.load_data()
+                if data is not self.data:  # storage คืน object เดิมได้ถ้ารู้ว่าไม่มีอะไรเปลี่ยน (เช่น Sheets)
+                    self.data = data
+                    self.generation += 1
+            self._sig = sig
+            self._checked_at = now
+            return self.data, self.generation
+
+    def write(self, storage, do_write, patch) -> Optional[int]:
+        """เขียนผ่าน storage แล้วอัปเดต snapshot ด้วย patch(old) -> new; คืน generation ใหม่ถ้า patch สำเร็จ"""
+        with self._lock:
+            before = self._signature(storage)
+            do_write()
+            if self.data is not None and (before is None or before == self._sig):
+                self.data = patch(self.data)
+                self._sig = self._signature(storage)
+                self.generation += 1
+                return self.generation
+            # snapshot ตามไม่ทันอยู่แล้ว (มีคนอื่นเขียนก่อนเรา) → โหลดใหม่รอบหน้า
+            self.data = None
+            self.generation += 1
+            return None
+
+
+@st.cache_resource
+def get_data_cache() -> DataCache:
+    return DataCache()
+
 
+def data_generation() -> int:
+    """หมายเลขรุ่นของข้อมูลรีวิว (เพิ่มขึ้นเสมอเมื่อข้อมูลเปลี่ยน)"""
+    return get_data_cache().generation
 
+
+@instrumented()
 def load_data() -> Dict:
-    ver = st.session_state.get("data_version", 0)
+    return load_data_versioned()[0]
+
+
+def load_data_versioned() -> Tuple[Dict, int]:
+    """load_data() + generation ของ snapshot นั้น (ใช้เป็นคีย์ของแคชที่สร้างจาก snapshot)
+    ข้อมูลสำรองจาก session ตอนเกินโควต้าไม่มีรุ่น → คืน -1 (ไม่ตรงกับรุ่นไหน = ไม่ถูกแคช)"""
+    cache = get_data_cache()
     try:
-        data = _cached_load_data(ver)
+        data, gen = cache.get_versioned(get_storage())
         st.session_state["last_data"] = data
-        return data
+        return data, gen
     except Exception as e:
         if any(x in str(e).lower() for x in ["quota exceeded", "429", "rate limit"]):
             st.warning("เกินโควต้าอ่าน Google Sheets ชั่วคราว — แสดงข้อมูลล่าสุดจากแคช")
-            return st.session_state.get("last_data", {"approved_reviews": [], "pending_reviews": []})
+            with cache._lock:
+                if cache.data is not None:
+                    return cache.data, cache.generation
+            return st.session_state.get("last_data", {"approved_reviews": [], "pending_reviews": []}), -1
         raise
 
 
+def _apply_move(data: Dict, ids: List[str], from_bucket: str, to_bucket: Optional[str],
+                status: Optional[str]) -> Dict:
+    """คืน dict ใหม่ที่ย้าย ids จาก from_bucket ไปท้าย to_bucket (ไม่แก้ของเดิม)"""
+    wanted = set(ids)
+    out = dict(data)
+    moved = [r for r in data.get(from_bucket, []) if r.get("id") in wanted]
+    out[from_bucket] = [r for r in data.get(from_bucket, []) if r.get("id") not in wanted]
+    if to_bucket:
+        if status:
+            moved = [dict(r, status=status) for r in moved]
+        out[to_bucket] = list(data.get(to_bucket, [])) + moved
+    return out
+
+
+@instrumented()
 def save_data(data: Dict) -> None:
-    get_storage().save_data(data)
-    st.session_state["data_version"] = st.session_state.get("data_version", 0) + 1
-    try:
-        _cached_load_data.clear()
-    except Exception:
-        pass
+    storage = get_storage()
+    snapshot = {k: [dict(r) for r in v] for k, v in data.items()}
+    get_data_cache().write(storage, lambda: storage.save_data(data), lambda _old: snapshot)
+
+
+@instrumented()
+def append_review(review: Dict) -> None:
+    """ส่งรีวิวใหม่เข้าคิว pending โดยไม่โหลด/เขียนทับข้อมูลทั้งหมด"""
+    storage = get_storage()
+
+    def do_write():
+        if hasattr(storage, "append_review"):
+            storage.append_review(review)
+        else:
+            data = storage.load_data()
+            data["pending_reviews"].append(review)
+            storage.save_data(data)
+
+    rec = dict(review)
+    gen = get_data_cache().write(storage, do_write,
+                                 lambda d: dict(d, pending_reviews=list(d.get("pending_reviews", [])) + [rec]))
+    if gen is not None:
+        get_course_aggregates().apply([], [], gen - 1, gen)  # pending ไม่กระทบ aggregates
+
+
+@instrumented()
+def move_reviews(ids: List[str], from_bucket: str, to_bucket: Optional[str] = None,
+                 status: Optional[str] = None) -> None:
+    """ย้ายรีวิวระหว่าง bucket (อนุมัติ) หรือลบออกจาก bucket (to_bucket=None, ปฏิเสธ)"""
+    if not ids:
+        return
+    storage = get_storage()
+
+    def do_write():
+        if hasattr(storage, "move_reviews"):
+            storage.move_reviews(ids, from_bucket, to_bucket, status)
+        else:
+            storage.save_data(_apply_move(storage.load_data(), ids, from_bucket, to_bucket, status))
+
+    moved: List[Dict] = []
+
+    def patch(d):
+        wanted = set(ids)
+        moved.extend(r for r in d.get(from_bucket, []) if r.get("id") in wanted)
+        return _apply_move(d, ids, from_bucket, to_bucket, status)
+
+    gen = get_data_cache().write(storage, do_write, patch)
+    if gen is not None:
+        removed = moved if from_bucket == "approved_reviews" else []
+        added = [dict(r, status=status) if status else r for r in moved] if to_bucket == "approved_reviews" else []
+        get_course_aggregates().apply(added, removed, gen - 1, gen)
 
 
 # -----------------------------
@@ -585,57 +1496,428 @@ TOKENS_HEADERS = ["token", "email", "type", "expires_at", "used", "created_at"]
 # ---- LocalJSONStorage (drop-in; supports reviews + users + tokens) ----
 
 
+try:  # advisory lock ข้ามโปรเซส (ไม่มีบน Windows → ล็อกได้เฉพาะภายในโปรเซส)
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+LOCAL_SEGMENT_DIR = st.secrets.get("LOCAL_SEGMENT_DIR", os.path.join("data", "segments"))
+LOCAL_COMPACT_RATIO = float(st.secrets.get("LOCAL_COMPACT_RATIO", 0.5))  # สัดส่วนบรรทัดขยะที่เริ่ม compaction
+LOCAL_COMPACT_MIN_LINES = 200  # ไฟล์เล็กกว่านี้ไม่ต้อง compaction
+LOCAL_FSYNC = str(st.secrets.get("LOCAL_FSYNC", "true")).lower() in ("1", "true", "yes")
+LOCAL_GROUP_COMMIT = str(st.secrets.get("LOCAL_GROUP_COMMIT", "true")).lower() in ("1", "true", "yes")
+
+
+class _PendingCommit:
+    """การเขียนที่รอเข้าคิว group commit: [(bucket, entries)] + ผลลัพธ์"""
+
+    __slots__ = ("batches", "done", "error")
+
+    def __init__(self, batches: List[Tuple[str, List[Dict]]]):
+        self.batches = batches
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+
 class LocalJSONStorage:
-    def __init__(self, path: str):
+    """
+    ที่เก็บไฟล์ในเครื่องแบบ log-structured: 1 bucket = 1 ไฟล์ JSONL (segment) ใต้ segment_dir
+    - แต่ละบรรทัดคือ {"k": key, "v": record} (put), {"k": key, "m": fields} (merge) หรือ {"k": key, "d": 1} (tombstone)
+    - insert / เปลี่ยนสถานะ / ลบ = ต่อท้าย 1 บรรทัดในไฟล์ของ bucket นั้น → ต้นทุนตามขนาดการเปลี่ยนแปลง ไม่ใช่ขนาดฐานข้อมูล
+    - หลัง compaction ส่วนหัวไฟล์คือ snapshot (เฉพาะ record ที่ยังอยู่) ส่วนที่ต่อท้ายทีหลังคือ tail; ตอนอ่าน replay ทั้งไฟล์ตามลำดับ
+    - เมื่อบรรทัดขยะ (ถูกทับ/ถูกลบ) เกิน LOCAL_COMPACT_RATIO ของไฟล์ จะเขียนไฟล์ใหม่ใน background thread
+    - data.json (+ data.log.jsonl รูปแบบเก่า) ถูก import ครั้งแรกครั้งเดียว หลังจากนั้นไม่ถูกเขียนอีก
+    - ทุก read-modify-write / append / การสลับไฟล์ ถือ flock บน segment_dir/.lock → หลายโปรเซสใช้ที่เก็บเดียวกันได้
+    - group commit: การเขียนที่มารอ lock พร้อมกันถูกเขียน + fsync รวดเดียวโดยเธรดที่ได้ lock ก่อน
+    """
+
+    BUCKETS = ("pending_reviews", "approved_reviews", "users", "tokens")
+    REVIEW_BUCKETS = ("pending_reviews", "approved_reviews")
+
+    def __init__(self, path: str, segment_dir: str = LOCAL_SEGMENT_DIR,
+                 compact_ratio: float = LOCAL_COMPACT_RATIO, compact_min_lines: int = LOCAL_COMPACT_MIN_LINES,
+                 fsync: bool = LOCAL_FSYNC, group_commit: bool = LOCAL_GROUP_COMMIT):
         self.path = path
+        # log รูปแบบเก่า (ก่อนแยก segment) — อ่านตอน import เท่านั้น
+        self.log_path = os.path.splitext(path)[0] + ".log.jsonl"
+        self.segment_dir = segment_dir
+        self.compact_ratio = compact_ratio
+        self.compact_min_lines = compact_min_lines
+        self.fsync = fsync
+        self.group_commit = group_commit
+        self._lock = threading.RLock()
+        self._lock_fd: Optional[int] = None
+        self._lock_depth = 0
+        self._queue: List[_PendingCommit] = []
+        self._queue_lock = threading.Lock()
+        self.commits = 0            # จำนวนครั้งที่เขียนลงไฟล์จริง
+        self.committed_writes = 0   # จำนวนการเขียนที่ผู้เรียกส่งมา (มากกว่า commits = ถูกรวม)
+        # bucket -> [จำนวนบรรทัดในไฟล์, จำนวน record ที่ยังอยู่] (ค่าประมาณ ใช้ตัดสินใจ compaction)
+        self._counts: Dict[str, List[int]] = {}
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segment-compact")
+        self._compacting: set = set()
+        self.compactions = 0
+        # แคชผล parse ต่อ bucket: bucket -> (ลายเซ็นไฟล์ (inode, mtime_ns, size), {key: record})
+        # state ที่แคชไว้ห้ามแก้ทั้งจากภายนอกและภายใน (เขียนแล้วแทนที่ด้วย dict ใหม่) — public method คืนสำเนาเสมอ
+        self._parsed: Dict[str, Tuple[Optional[Tuple], Dict[str, Dict]]] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._ensure()
 
+    def _segment(self, bucket: str) -> str:
+        return os.path.join(self.segment_dir, f"{bucket}.jsonl")
+
+    @contextmanager
+    def _locked(self):
+        """lock ของที่เก็บ: RLock ในโปรเซส + flock ข้ามโปรเซส (re-entrant ภายในเธรดเดียวกัน)"""
+        with self._lock:
+            if self._lock_depth == 0 and FCNTL_AVAILABLE:
+                fd = os.open(os.path.join(self.segment_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._lock_fd = fd
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_fd is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+                    os.close(self._lock_fd)
+                    self._lock_fd = None
+
+    def _fsync_dir(self) -> None:
+        # ให้ os.replace ทนไฟดับ (ชื่อไฟล์ใหม่ต้องลงดิสก์ด้วย); บางระบบเปิดโฟลเดอร์ไม่ได้ก็ข้าม
+        try:
+            fd = os.open(self.segment_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
     def _ensure(self):
-        # สร้างโฟลเดอร์/ไฟล์เริ่มต้น
-        base_dir = os.path.dirname(self.path)
-        if base_dir:
-            os.makedirs(base_dir, exist_ok=True)
-        if not os.path.exists(self.path):
-            with open(self.path, "w", encoding="utf-8") as f:
-                json.dump(
-                    {
-                        "pending_reviews": [],
-                        "approved_reviews": [],
-                        "users": [],
-                        "tokens": [],
-                    },
-                    f, ensure_ascii=False, indent=2
-                )
-        else:
-            # ให้แน่ใจว่ามีคีย์หลักครบ
+        # สร้างโฟลเดอร์ แล้ว import data.json ครั้งแรก (marker เขียนเป็นอย่างสุดท้าย: ตายกลางทาง = import ใหม่ทั้งชุด)
+        os.makedirs(self.segment_dir, exist_ok=True)
+        marker = os.path.join(self.segment_dir, ".imported")
+        if os.path.exists(marker):
+            return
+        with self._locked():
+            if os.path.exists(marker):  # อีกโปรเซส import เสร็จระหว่างรอ lock
+                return
+            legacy = self._read_legacy()
+            for bucket in self.BUCKETS:
+                self._write_segment(bucket, self._keyed(bucket, legacy.get(bucket, [])))
+            tmp = f"{marker}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(datetime.now().isoformat(timespec="seconds") + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, marker)
+            self._fsync_dir()
+
+    # ---------- legacy (data.json + data.log.jsonl) ----------
+    def _read_legacy(self) -> Dict:
+        data: Dict = {}
+        if os.path.exists(self.path):
             with open(self.path, "r", encoding="utf-8") as f:
                 try:
                     data = json.load(f)
                 except Exception:
                     data = {}
-            changed = False
-            for k in ("pending_reviews", "approved_reviews", "users", "tokens"):
-                if k not in data:
-                    data[k] = []
-                    changed = True
-            if changed:
-                with open(self.path, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-
-    # ---------- file helpers ----------
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self._replay_legacy(data, json.loads(line))
+                    except Exception:
+                        break  # บรรทัดท้ายที่เขียนไม่จบ (เช่นโปรเซสตายกลางคัน) — ข้าม
+        return data
+
+    @staticmethod
+    def _replay_legacy(data: Dict, rec: Dict) -> None:
+        op = rec.get("op")
+        if op == "append":
+            data.setdefault(rec["bucket"], []).append(rec["review"])
+        elif op == "move":
+            ids = set(rec["ids"])
+            keep, moved = [], []
+            for r in data.get(rec["from"], []):
+                (moved if r.get("id") in ids else keep).append(r)
+            data[rec["from"]] = keep
+            if rec.get("to"):
+                for r in moved:
+                    if rec.get("status"):
+                        r["status"] = rec["status"]
+                data.setdefault(rec["to"], []).extend(moved)
+        elif op == "upsert_user":
+            user = rec["user"]
+            email = (user.get("email") or "").strip().lower()
+            users = data.setdefault("users", [])
+            for u in users:
+                if (u.get("email") or "").strip().lower() == email:
+                    u.update(user)
+                    break
+            else:
+                users.append(dict(user))
+        elif op == "add_token":
+            data.setdefault("tokens", []).append(rec["token"])
+        elif op == "token_used":
+            for t in data.get("tokens", []):
+                if t.get("token") == rec["token"]:
+                    t["used"] = True
+                    break
+
+    # ---------- segment helpers ----------
+    @staticmethod
+    def _key(bucket: str, rec: Dict) -> Optional[str]:
+        if bucket == "users":
+            return (rec.get("email") or "").strip().lower()
+        if bucket == "tokens":
+            return str(rec.get("token") or "")
+        return str(rec["id"]) if rec.get("id") else None
+
+    def _keyed(self, bucket: str, records: List[Dict], spare: Sequence[str] = ()) -> Dict[str, Dict]:
+        """
+        จัด records เป็น {key: record}; รีวิวเก่าที่ไม่มี id ได้ key ตามตำแหน่ง
+        โดยใช้ key เดิมใน spare ตามลำดับก่อน (แก้แล้ว save ซ้ำ = put ทับที่เดิม ไม่ย้ายไปท้าย)
+        """
+        out: Dict[str, Dict] = {}
+        spare_it = iter(spare)
+        for rec in records:
+            k = self._key(bucket, rec)
+            if k is None or k in out:
+                k = next(spare_it, None) or f"n:{uuid.uuid4().hex}"
+            out[k] = rec
+        return out
+
+    @staticmethod
+    def _apply(state: Dict[str, Dict], rec: Dict) -> None:
+        k = rec.get("k")
+        if "v" in rec:
+            state[k] = rec["v"]
+        elif "m" in rec:
+            state[k] = {**(state.get(k) or {}), **rec["m"]}
+        elif rec.get("d"):
+            state.pop(k, None)
+
+    def _stat(self, bucket: str) -> Optional[Tuple]:
+        try:
+            s_ = os.stat(self._segment(bucket))
+        except FileNotFoundError:
+            return None
+        return (s_.st_ino, s_.st_mtime_ns, s_.st_size)
+
+    def _parse(self, bucket: str) -> Dict[str, Dict]:
+        """replay segment ของ bucket → {key: record} ตามลำดับที่ถูกเพิ่ม"""
+        state: Dict[str, Dict] = {}
+        lines = 0
+        try:
+            f = open(self._segment(bucket), "r", encoding="utf-8")
+        except FileNotFoundError:
+            return state
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue  # บรรทัดที่เขียนไม่จบ — _append ขึ้นบรรทัดใหม่ให้แล้ว ข้ามไปได้
+                lines += 1
+                self._apply(state, rec)
+        self._counts[bucket] = [lines, len(state)]
+        return state
+
+    def _load(self, bucket: str) -> Dict[str, Dict]:
+        """state ของ bucket จากแคช ถ้าลายเซ็นไฟล์ยังตรง (ต้นทุน = stat 1 ครั้ง) ไม่งั้น parse ใหม่"""
+        sig = self._stat(bucket)  # stat ก่อนอ่าน: ถ้าไฟล์โตระหว่าง parse รอบหน้าแค่ miss อีกครั้ง
+        cached = self._parsed.get(bucket)
+        if cached is not None and cached[0] == sig:
+            self.cache_hits += 1
+            return cached[1]
+        self.cache_misses += 1
+        state = self._parse(bucket)
+        self._parsed[bucket] = (sig, state)
+        return state
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "compactions": self.compactions,
+                "commits": self.commits, "writes": self.committed_writes}
+
+    def _append(self, bucket: str, entries: List[Dict]) -> None:
+        self._commit([(bucket, entries)])
+
+    def _commit(self, batches: List[Tuple[str, List[Dict]]]) -> None:
+        """
+        ต่อท้ายบรรทัดลง segment ภายใต้ lock
+        group commit: ฝากงานไว้ในคิวก่อนแล้วค่อยรอ lock — เธรดแรกที่ได้ lock เขียนงานทั้งคิวด้วย fsync ครั้งเดียว
+        เธรดที่ตามมาเห็นว่างานตัวเองเสร็จแล้วก็ออกได้ทันที
+        """
+        batches = [(b, e) for b, e in batches if e]
+        if not batches:
+            return
+        if not self.group_commit:
+            with self._locked():
+                self._write_batches([_PendingCommit(batches)])
+            return
+        req = _PendingCommit(batches)
+        with self._queue_lock:
+            self._queue.append(req)
+        with self._locked():
+            if not req.done:
+                with self._queue_lock:
+                    reqs, self._queue = self._queue, []
+                self._write_batches(reqs)
+        if req.error is not None:
+            raise req.error
+
+    def _write_batches(self, reqs: List[_PendingCommit]) -> None:
+        """เขียนงานหลายชิ้นรวดเดียว (ต้องถือ _locked อยู่): 1 ไฟล์ต่อ bucket, fsync ครั้งเดียวต่อไฟล์"""
+        by_bucket: Dict[str, List[Dict]] = {}
+        for req in reqs:
+            for bucket, entries in req.batches:
+                by_bucket.setdefault(bucket, []).extend(entries)
+        try:
+            for bucket, entries in by_bucket.items():
+                self._write_entries(bucket, entries)
+        except BaseException as e:
+            for req in reqs:
+                req.error = e
+            raise
+        finally:
+            for req in reqs:
+                req.done = True
+        self.commits += 1
+        self.committed_writes += len(reqs)
+
+    def _write_entries(self, bucket: str, entries: List[Dict]) -> None:
+        payload = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        before = self._stat(bucket)
+        with open(self._segment(bucket), "a+b") as f:
+            # ถ้าบรรทัดท้ายค้างไม่จบ (โปรเซสก่อนหน้าตาย) ขึ้นบรรทัดใหม่ก่อน ไม่ให้ต่อติดกัน
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    payload = "\n" + payload
+            f.write(payload.encode("utf-8"))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        # แคชตรงกับไฟล์ก่อนเขียน → เดินหน้าแคชด้วยบรรทัดที่เพิ่งเขียนแทนการ parse ใหม่
+        # (decode จาก payload ไม่ใช้ object ของผู้เรียก ซึ่งอาจถูกแก้ทีหลัง)
+        # copy-on-write: ผู้อ่านที่ได้ dict เดิมจาก _load ไปวนอยู่นอก lock → ห้ามแก้ dict นั้น
+        cached = self._parsed.get(bucket)
+        if cached is not None and cached[0] == before:
+            state = dict(cached[1])
+            for line in payload.splitlines():
+                if line:
+                    self._apply(state, json.loads(line))
+            self._parsed[bucket] = (self._stat(bucket), state)
+        lines, live = self._counts.get(bucket, [0, 0])
+        for e in entries:
+            lines += 1
+            live += 1 if "v" in e else (-1 if e.get("d") else 0)
+        self._counts[bucket] = [lines, max(live, 0)]
+        if self._needs_compaction(bucket) and bucket not in self._compacting:
+            self._compacting.add(bucket)
+            self._compactor.submit(self._compact_job, bucket)
+
+    def _needs_compaction(self, bucket: str) -> bool:
+        lines, live = self._counts.get(bucket, [0, 0])
+        return lines >= self.compact_min_lines and (lines - live) / lines > self.compact_ratio
+
+    def _write_segment(self, bucket: str, state: Dict[str, Dict], tail: bytes = b"") -> None:
+        """เขียน snapshot (put เฉพาะ record ที่ยังอยู่) + tail ลงไฟล์ชั่วคราวแล้ว os.replace"""
+        path = self._segment(bucket)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "wb") as f:
+            for k, v in state.items():
+                f.write((json.dumps({"k": k, "v": v}, ensure_ascii=False) + "\n").encode("utf-8"))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._fsync_dir()
+        self._counts[bucket] = [len(state), len(state)]
+
+    def _compact_job(self, bucket: str) -> None:
+        try:
+            self.compact(bucket)
+        finally:
+            with self._lock:
+                self._compacting.discard(bucket)
+
+    def compact(self, bucket: str) -> bool:
+        """
+        เขียน segment ใหม่ให้เหลือแต่ record ที่ยังอยู่ (อ่าน/parse snapshot นอก lock)
+        บรรทัดที่ถูกต่อท้ายระหว่างนั้นคัดลอกตามไปเป็น tail ก่อนสลับไฟล์ภายใต้ lock
+        ถือ fd ของไฟล์เดิมไว้ตลอด → inode ไม่ถูกนำกลับมาใช้ใหม่ เทียบได้ว่ายังเป็นไฟล์เดียวกันไหม
+        """
+        path = self._segment(bucket)
+        with self._locked():  # การต่อท้ายเขียนจบภายใต้ lock → size ตกที่ขอบบรรทัดเสมอ
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                return False
+        with f:
+            orig = os.fstat(f.fileno())
+            head = f.read(orig.st_size)
+            state: Dict[str, Dict] = {}
+            lines = 0
+            for line in head.splitlines():
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                lines += 1
+                self._apply(state, rec)
+            if lines == len(state):
+                return False
+            with self._locked():
+                before = self._stat(bucket)
+                if before is None or not os.path.samestat(orig, os.stat(path)):
+                    return False  # อีกโปรเซส compaction ไปแล้วระหว่างที่เราอ่าน
+                f.seek(orig.st_size)
+                tail = f.read()
+                if tail and not head.endswith(b"\n"):
+                    tail = b"\n" + tail
+                self._write_segment(bucket, state, tail)
+                # เนื้อหาเท่าเดิมแค่ไฟล์ใหม่ → ย้ายแคชไปผูกกับลายเซ็นใหม่ ไม่ต้อง parse ซ้ำ
+                cached = self._parsed.get(bucket)
+                if cached is not None and cached[0] == before:
+                    self._parsed[bucket] = (self._stat(bucket), cached[1])
+                self._counts[bucket] = [len(state) + tail.count(b"\n"), len(state)]
+                self.compactions += 1
+        return True
+
     def _read(self) -> Dict:
-        with open(self.path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return {b: [dict(r) for r in self._load(b).values()] for b in self.BUCKETS}
 
-    def _write(self, data: Dict) -> None:
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def _sig(self, buckets) -> Tuple:
+        return tuple(self._stat(b) for b in buckets)
+
+    def _replace_bucket(self, bucket: str, records: List[Dict]) -> None:
+        """ให้ bucket มีเนื้อหาเท่ากับ records โดยต่อท้ายเฉพาะส่วนต่าง (put ตัวที่ใหม่/เปลี่ยน, tombstone ตัวที่หายไป)"""
+        with self._locked():
+            cur = self._load(bucket)
+            new = self._keyed(bucket, records, [k for k in cur if k.startswith("n:")])
+            entries = [{"k": k, "d": 1} for k in cur if k not in new]
+            entries += [{"k": k, "v": v} for k, v in new.items() if cur.get(k) != v]
+            self._append(bucket, entries)
 
     # ---------- reviews ----------
     def load_data(self) -> Dict:
-        d = self._read()
+        d = {b: [dict(r) for r in self._load(b).values()] for b in self.REVIEW_BUCKETS}
         # normalize type (กันกรณี rating/year เป็น string)
-        for bucket in ("pending_reviews", "approved_reviews"):
+        for bucket in self.REVIEW_BUCKETS:
             for r in d.get(bucket, []):
                 try:
                     r["rating"] = int(r.get("rating", 0))
@@ -645,85 +1927,83 @@ class LocalJSONStorage:
                     r["year"] = int(r.get("year", 0)) if r.get("year") not in ("", None) else 0
                 except Exception:
                     r["year"] = 0
-        return {
-            "pending_reviews": d.get("pending_reviews", []),
-            "approved_reviews": d.get("approved_reviews", []),
-        }
+        return d
 
     def save_data(self, data: Dict) -> None:
-        d = self._read()
-        d["pending_reviews"]  = data.get("pending_reviews", [])
-        d["approved_reviews"] = data.get("approved_reviews", [])
-        self._write(d)
+        for bucket in self.REVIEW_BUCKETS:
+            self._replace_bucket(bucket, data.get(bucket, []))
+
+    def append_review(self, review: Dict) -> None:
+        """เพิ่มรีวิวใหม่เข้าคิว pending ด้วยการต่อท้าย segment 1 บรรทัด"""
+        key = self._key("pending_reviews", review) or f"n:{uuid.uuid4().hex}"
+        self._append("pending_reviews", [{"k": key, "v": review}])
+
+    def move_reviews(self, ids: List[str], from_bucket: str, to_bucket: Optional[str] = None,
+                     status: Optional[str] = None) -> None:
+        """ย้าย/ลบรีวิวหลายรายการ: put ฝั่งปลายทางก่อนแล้วค่อย tombstone ฝั่งต้นทาง (ตายกลางทาง = ซ้ำ ไม่ใช่หาย)"""
+        ids = {str(i) for i in ids}
+        with self._locked():
+            moved = [(k, r) for k, r in self._load(from_bucket).items() if str(r.get("id")) in ids]
+            if to_bucket:
+                puts = []
+                for k, r in moved:
+                    r = dict(r)
+                    if status:
+                        r["status"] = status
+                    puts.append({"k": k, "v": r})
+                self._append(to_bucket, puts)
+            self._append(from_bucket, [{"k": k, "d": 1} for k, _ in moved])
+
+    def data_signature(self) -> Tuple:
+        """probe ราคาถูกสำหรับ DataCache: ดูเฉพาะ segment ของรีวิว (ผู้ใช้/โทเคนเปลี่ยนไม่ต้องโหลดรีวิวใหม่)"""
+        return self._sig(self.REVIEW_BUCKETS)
 
     # ---------- users ----------
     def load_users(self) -> List[Dict]:
-        return self._read().get("users", [])
+        return [dict(u) for u in self._load("users").values()]
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        """ค้นผู้ใช้ด้วย email แบบ O(1) (state ของ segment ใช้ email เป็น key อยู่แล้ว)"""
+        u = self._load("users").get((email or "").strip().lower())
+        return dict(u) if u else None
 
     def upsert_user(self, user: Dict) -> None:
-        d = self._read()
-        users = d.get("users", [])
-        email = (user.get("email") or "").strip().lower()
-        idx = next((i for i, u in enumerate(users) if (u.get("email","").lower() == email)), -1)
-        if idx >= 0:
-            users[idx].update(user)
-        else:
-            users.append(user)
-        d["users"] = users
-        self._write(d)
+        """เพิ่ม/แก้ผู้ใช้ด้วยบรรทัด merge 1 บรรทัด (สอง session แก้คนละฟิลด์พร้อมกันจะถูกรวมกันตอน replay)"""
+        self._append("users", [{"k": self._key("users", user), "m": user}])
 
     # ---------- tokens (verify/reset) ----------
     def load_tokens(self) -> List[Dict]:
-        return self._read().get("tokens", [])
+        return [dict(t) for t in self._load("tokens").values()]
 
     def write_tokens(self, tokens: List[Dict]) -> None:
-        d = self._read()
-        d["tokens"] = tokens
-        self._write(d)
+        self._replace_bucket("tokens", tokens)
 
     def add_token(self, token_row: Dict) -> None:
-        d = self._read()
-        d.setdefault("tokens", []).append(token_row)
-        self._write(d)
+        self._append("tokens", [{"k": self._key("tokens", token_row), "v": token_row}])
+
+    def get_token(self, token: str) -> Optional[Dict]:
+        t = self._load("tokens").get(token) if token else None
+        return dict(t) if t else None
 
     def mark_token_used(self, token: str) -> bool:
-        d = self._read()
-        tokens = d.get("tokens", [])
-        now = datetime.now().isoformat(timespec="seconds")
-        found = False
-        for t in tokens:
-            if t.get("token") == token and not t.get("used_at"):
-                t["used_at"] = now
-                found = True
-                break
-        if found:
-            d["tokens"] = tokens
-            self._write(d)
-        return found
+        # ตรวจ + เขียนภายใต้ lock เดียว: สองโปรเซสกดลิงก์เดียวกันพร้อมกัน มีแค่คนเดียวที่ได้ True
+        with self._locked():
+            t = self.get_token(token)
+            if not t or t.get("used"):
+                return False
+            self._append("tokens", [{"k": token, "m": {"used": True}}])
+        return True
 
+    def sweep_tokens(self, now: str, limit: int = 500) -> int:
+        """ลบโทเคนที่ใช้แล้ว/หมดอายุด้วย tombstone (ไม่เขียนไฟล์ใหม่ทั้งไฟล์)"""
+        with self._locked():
+            dead = [k for k, t in self._load("tokens").items() if token_is_dead(t, now)][:limit]
+            self._append("tokens", [{"k": k, "d": 1} for k in dead])
+        return len(dead)
 
 
-class GoogleSheetsStorage(GoogleSheetsStorage):  # type: ignore[misc]
-    def __init__(self):  # override to also ensure users/tokens worksheets
-        import gspread
-        svc_info = dict(st.secrets.get("gcp_service_account", {}))
-        if not svc_info:
-            raise RuntimeError("Missing gcp_service_account in secrets")
-        self.spreadsheet_key = st.secrets.get("SPREADSHEET_KEY")
-        if not self.spreadsheet_key:
-            raise RuntimeError("Missing SPREADSHEET_KEY in secrets")
-        self.gc = gspread.service_account_from_dict(svc_info)
-        self.ss = self.gc.open_by_key(self.spreadsheet_key)
-        # Ensure worksheets
-        self.ws_pending = self._get_or_create_ws("pending_reviews")
-        self.ws_approved = self._get_or_create_ws("approved_reviews")
-        self.ws_users = self._get_or_create_ws("users")
-        self.ws_tokens = self._get_or_create_ws("tokens")
-        self._ensure_headers(self.ws_pending, HEADERS)
-        self._ensure_headers(self.ws_approved, HEADERS)
-        self._ensure_headers(self.ws_users, USERS_HEADERS)
-        self._ensure_headers(self.ws_tokens, TOKENS_HEADERS)
 
+class GoogleSheetsStorage(GoogleSheetsStorage):  # type: ignore[misc]
     def _ensure_headers(self, ws, headers=None):
         """
         ให้แผ่น (worksheet) มีหัวตารางตาม headers
@@ -761,12 +2041,66 @@ class GoogleSheetsStorage(GoogleSheetsStorage):  # type: ignore[misc]
             rec = {USERS_HEADERS[i]: (r[i] if i < len(r) else "") for i in range(len(USERS_HEADERS))}
             rec["is_verified"] = True if str(rec.get("is_verified", "")) in ("1", "true", "True", "yes") else False
             data.append(rec)
+        self._set_users_index(data)
         return data
 
     def save_users(self, users: List[Dict]) -> None:
         rows = [[str(u.get(k, "")) for k in USERS_HEADERS] for u in users]
         self.ws_users.clear();
         self.ws_users.update("A1", [USERS_HEADERS] + rows)
+        self._set_users_index([dict(u) for u in users])
+
+    def _user_row_matches(self, row_no: int, key: str) -> bool:
+        """เลขแถวใน index ยังเป็นผู้ใช้คนนี้ไหม (แทรก/ลบแถวในชีตแล้วเลื่อนได้) — อ่าน 1 เซลล์"""
+        col = self._col_letter(USERS_HEADERS.index("email") + 1)
+        vals = self.ws_users.get(f"{col}{row_no}")
+        return bool(vals and vals[0] and self._email_key(vals[0][0]) == key)
+
+    def upsert_user(self, user: Dict) -> None:
+        """
+        แก้ผู้ใช้เดิม = เขียนเฉพาะคอลัมน์ที่ส่งมา ในแถวเดียว, ผู้ใช้ใหม่ = append_row แถวเดียว (ใช้ map email -> เลขแถว)
+        - ก่อนแก้ ตรวจว่าแถวนั้นยังเป็น email นี้ (index อายุได้ถึง USERS_INDEX_TTL) ไม่ตรง → อ่านชีตใหม่
+        - ไม่เขียนคอลัมน์อื่นจาก index เก่า: อีกโปรเซสเพิ่งแก้ is_verified/password_hash จะไม่ถูกย้อนกลับ
+        - ก่อน append อ่านคอลัมน์ email ใหม่ (คอลัมน์เดียว) กันกรณีอีก session/โปรเซสเพิ่งสมัครอีเมลเดียวกัน
+          แต่ยังไม่ atomic: สองโปรเซสสมัครอีเมลเดียวกันในจังหวะเดียวกันอาจได้ 2 แถว
+          → ตอนอ่าน (_set_users_index) ใช้แถวแรกของ email นั้นเสมอ การแก้ครั้งถัดไปก็ลงแถวแรก
+        """
+        key = self._email_key(user.get("email"))
+        with self._lock:
+            if self._users_idx is None:
+                self.load_users()
+            row_no = self._users_rows.get(key)
+            if row_no is not None and not self._user_row_matches(row_no, key):
+                self.load_users()
+                row_no = self._users_rows.get(key)
+            if row_no is None:
+                emails = self.ws_users.col_values(USERS_HEADERS.index("email") + 1)[1:]
+                if key in {self._email_key(e) for e in emails}:
+                    self.load_users()  # มีคนเพิ่มจากที่อื่น → ดึงแถวเต็มมารวมก่อน
+                    row_no = self._users_rows.get(key)
+
+            current = self._users_idx.get(key) or {}
+            merged = dict(current, **user)
+            if row_no:
+                sheet_id = self.ws_users.id
+                requests = [{"updateCells": {
+                    "rows": [self._row_data([str(user[k])])],
+                    "fields": "userEnteredValue",
+                    "start": {"sheetId": sheet_id, "rowIndex": row_no - 1, "columnIndex": i},
+                }} for i, k in enumerate(USERS_HEADERS) if k in user and k != "email"]  # email = คีย์ ตรงอยู่แล้ว
+                if requests:
+                    self.ss.batch_update({"requests": requests})
+                merged["email"] = current.get("email") or merged.get("email", "")
+            else:
+                values = [str(merged.get(k, "")) for k in USERS_HEADERS]
+                row_no = self._row_from_append(self.ws_users.append_row(values, value_input_option="RAW"))
+            self._users_idx[key] = merged
+            if row_no:
+                self._users_rows[key] = row_no
+            else:
+                self._users_idx = None  # ไม่รู้เลขแถว → ให้อ่านใหม่ครั้งหน้า
+
+    TOKENS_MISS_REFRESH_AFTER = 5.0
 
     def load_tokens(self) -> List[Dict]:
         rows = self.ws_tokens.get_all_values()
@@ -775,12 +2109,371 @@ class GoogleSheetsStorage(GoogleSheetsStorage):  # type: ignore[misc]
             rec = {TOKENS_HEADERS[i]: (r[i] if i < len(r) else "") for i in range(len(TOKENS_HEADERS))}
             rec["used"] = True if str(rec.get("used", "")) in ("1", "true", "True", "yes") else False
             data.append(rec)
+        self._set_tokens_index(data)
         return data
 
     def save_tokens(self, tokens: List[Dict]) -> None:
         rows = [[str(t.get(k, "")) for k in TOKENS_HEADERS] for t in tokens]
         self.ws_tokens.clear();
         self.ws_tokens.update("A1", [TOKENS_HEADERS] + rows)
+        self._set_tokens_index([dict(t) for t in tokens])
+
+    write_tokens = save_tokens
+
+    def _set_tokens_index(self, tokens: List[Dict]) -> None:
+        with self._lock:
+            self._tokens_idx = {}
+            for i, t in enumerate(tokens):
+                if t.get("token") and t["token"] not in self._tokens_idx:
+                    self._tokens_idx[t["token"]] = (i + 2, t)
+            self._tokens_idx_at = time.monotonic()
+
+    def get_token(self, token: str) -> Optional[Dict]:
+        stale = time.monotonic() - self._tokens_idx_at > self.TOKENS_MISS_REFRESH_AFTER
+        if self._tokens_idx is None or (token not in self._tokens_idx and stale):
+            self.load_tokens()
+        hit = self._tokens_idx.get(token)
+        return dict(hit[1]) if hit else None
+
+    def add_token(self, token_row: Dict) -> None:
+        """append_row แถวเดียว แล้วจำเลขแถวไว้ใน index (ไม่อ่านชีต)"""
+        values = [str(token_row.get(k, "")) for k in TOKENS_HEADERS]
+        with self._lock:
+            row_no = self._row_from_append(self.ws_tokens.append_row(values, value_input_option="RAW"))
+            if self._tokens_idx is not None:
+                if row_no:
+                    self._tokens_idx[token_row["token"]] = (row_no, dict(token_row))
+                else:
+                    self._tokens_idx = None
+
+    def _token_row_matches(self, row_no: int, token: str) -> bool:
+        """เลขแถวใน index ยังเป็นโทเคนนี้ไหม (อีกโปรเซส sweep แล้วแถวเลื่อนได้) — อ่าน 1 เซลล์"""
+        col = self._col_letter(TOKENS_HEADERS.index("token") + 1)
+        vals = self.ws_tokens.get(f"{col}{row_no}")
+        return bool(vals and vals[0] and vals[0][0] == token)
+
+    def mark_token_used(self, token: str) -> bool:
+        """พลิกช่อง used ของโทเคนเดียว (update 1 เซลล์ หลังตรวจว่าแถวยังเป็นโทเคนนี้)"""
+        with self._lock:
+            if self.get_token(token) is None:
+                return False
+            if not self._token_row_matches(self._tokens_idx[token][0], token):
+                self.load_tokens()
+                if token not in self._tokens_idx:
+                    return False
+            row_no, rec = self._tokens_idx[token]
+            if rec.get("used"):
+                return False
+            col = self._col_letter(TOKENS_HEADERS.index("used") + 1)
+            self.ws_tokens.update(f"{col}{row_no}", [["True"]])
+            rec["used"] = True
+            return True
+
+    def sweep_tokens(self, now: str, limit: int = 500) -> int:
+        """
+        ลบโทเคนที่ใช้แล้ว/หมดอายุทีละชุด (deleteDimension ใน batchUpdate ครั้งเดียว)
+        อ่านชีตใหม่ก่อนทุกครั้ง: เลขแถวใน index อาจเลื่อนไปแล้วถ้าอีกโปรเซสเพิ่ง sweep
+        """
+        with self._lock:
+            self.load_tokens()
+            dead = sorted(row for row, t in self._tokens_idx.values() if token_is_dead(t, now))[:limit]
+            if not dead:
+                return 0
+            self.ss.batch_update({"requests": self._delete_requests(self.ws_tokens.id, [r - 2 for r in dead])})
+            gone = set(dead)
+            self._tokens_idx = {
+                tok: (row - bisect.bisect_left(dead, row), t)
+                for tok, (row, t) in self._tokens_idx.items() if row not in gone
+            }
+            return len(dead)
+
+
+# ---- SQLiteStorage (local DB แบบ WAL; รองรับหลาย session พร้อมกัน) ----
+
+SQLITE_PATH = st.secrets.get("SQLITE_PATH", os.path.join("data", "reviews.db"))
+SQLITE_IMPORT_SHEETS_DIR = st.secrets.get("SQLITE_IMPORT_SHEETS_DIR", "")  # โฟลเดอร์ไฟล์ CSV ที่ export จากชีต
+
+
+class SQLiteStorage:
+    """
+    เก็บรีวิว/ผู้ใช้/โทเคนใน SQLite ไฟล์เดียว
+    - journal_mode=WAL: ผู้อ่านไม่บล็อกผู้เขียน (หลาย session ของ Streamlit อ่านพร้อมกันได้)
+    - 1 connection ต่อ thread (Streamlit รันแต่ละ session บน thread ของตัวเอง)
+    - ครั้งแรกที่ฐานข้อมูลว่าง จะ import จากที่เก็บ local (segments + data.json เดิม ผ่าน LocalJSONStorage)
+      และ CSV ที่ export จากชีต (ถ้าตั้งค่าไว้) ให้อัตโนมัติ
+    - ลำดับแถว = rowid; ย้าย bucket = ลบแล้ว insert ใหม่ → ไปอยู่ท้าย bucket ปลายทางเหมือน backend อื่น
+    """
+
+    REVIEW_COLS = HEADERS
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reviews (
+            id TEXT PRIMARY KEY,
+            bucket TEXT NOT NULL,
+            course_type TEXT, faculty TEXT, faculty_name TEXT,
+            department TEXT, department_name TEXT, year INTEGER,
+            course_code TEXT, course_name TEXT,
+            rating INTEGER, text TEXT, author TEXT, created_at TEXT, status TEXT,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_reviews_bucket ON reviews(bucket, created_at);
+        CREATE INDEX IF NOT EXISTS ix_reviews_course ON reviews(bucket, course_type, faculty, course_code);
+        CREATE TABLE IF NOT EXISTS users (
+            email_key TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            password_salt TEXT, password_hash TEXT, role TEXT, display TEXT,
+            is_verified INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tokens (
+            token TEXT PRIMARY KEY,
+            email TEXT, type TEXT, expires_at TEXT,
+            used INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_tokens_email ON tokens(email);
+        CREATE INDEX IF NOT EXISTS ix_tokens_sweep ON tokens(used, expires_at);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path: str, import_local: Optional[str] = None, import_sheets_dir: str = ""):
+        self.path = path
+        self._local = threading.local()
+        base_dir = os.path.dirname(self.path)
+        if base_dir:
+            os.makedirs(base_dir, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        self._import_once(import_local, import_sheets_dir)
+
+    # ---------- connection helpers ----------
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def data_signature(self) -> Tuple:
+        """probe ราคาถูกสำหรับ DataCache: commit ใน WAL จะเปลี่ยน mtime/size ของ -wal"""
+        sig = []
+        for p in (self.path, self.path + "-wal"):
+            try:
+                s_ = os.stat(p)
+                sig.append((s_.st_ino, s_.st_mtime_ns, s_.st_size))
+            except FileNotFoundError:
+                sig.append(None)
+        return tuple(sig)
+
+    @contextmanager
+    def _tx(self):
+        """BEGIN IMMEDIATE … COMMIT — จองสิทธิ์เขียนตั้งแต่ต้น กัน read-modify-write ชนกัน"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # ---------- row mapping ----------
+    def _review_params(self, r: Dict, bucket: str) -> Tuple:
+        extra = {k: v for k, v in r.items() if k not in self.REVIEW_COLS}
+        vals = []
+        for k in self.REVIEW_COLS:
+            v = r.get(k, "")
+            if k in ("year", "rating"):
+                try:
+                    v = int(v or 0)
+                except Exception:
+                    v = 0
+            vals.append(v)
+        return (bucket, *vals, json.dumps(extra, ensure_ascii=False) if extra else None)
+
+    def _review_dict(self, row: sqlite3.Row) -> Dict:
+        rec = {k: row[k] if row[k] is not None else "" for k in self.REVIEW_COLS}
+        rec["year"] = int(rec["year"] or 0)
+        rec["rating"] = int(rec["rating"] or 0)
+        if row["extra"]:
+            rec.update(json.loads(row["extra"]))
+        return rec
+
+    def _insert_reviews(self, conn, bucket: str, reviews: List[Dict]) -> None:
+        # upsert (ไม่ใช้ INSERT OR REPLACE) เพื่อคง rowid เดิม = คงลำดับแถว
+        names = ["bucket", *self.REVIEW_COLS, "extra"]
+        sets = ", ".join(f"{c} = excluded.{c}" for c in names if c != "id")
+        conn.executemany(
+            f"INSERT INTO reviews ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT(id) DO UPDATE SET {sets}",
+            [self._review_params(r, bucket) for r in reviews])
+
+    @staticmethod
+    def _user_params(u: Dict) -> Tuple:
+        email = (u.get("email") or "").strip()
+        return (email.lower(), email, u.get("password_salt", ""), u.get("password_hash", ""),
+                u.get("role", "student"), u.get("display", ""),
+                1 if str(u.get("is_verified", "")) in ("1", "true", "True", "yes") else 0,
+                u.get("created_at", ""))
+
+    @staticmethod
+    def _token_params(t: Dict) -> Tuple:
+        return (t.get("token", ""), t.get("email", ""), t.get("type", ""), t.get("expires_at", ""),
+                1 if str(t.get("used", "")) in ("1", "true", "True", "yes") else 0,
+                t.get("created_at", ""))
+
+    # ---------- one-shot import ----------
+    def _import_once(self, local_path: Optional[str], sheets_dir: str) -> None:
+        with self._tx() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                return
+            sources = []
+            # data.json ไม่ถูกเขียนอีกหลังย้ายไปเก็บเป็น segment → อ่านผ่าน LocalJSONStorage (segments + legacy)
+            segment_dir = LOCAL_SEGMENT_DIR
+            if local_path and (os.path.exists(local_path) or os.path.isdir(segment_dir)):
+                local = LocalJSONStorage(local_path, segment_dir=segment_dir)
+                self._import_snapshot(conn, dict(local.load_data(), users=local.load_users(),
+                                                 tokens=local.load_tokens()))
+                sources.append(segment_dir)
+            if sheets_dir and os.path.isdir(sheets_dir):
+                self._import_snapshot(conn, self._read_sheet_exports(sheets_dir))
+                sources.append(sheets_dir)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                         (json.dumps({"sources": sources, "at": datetime.now().isoformat(timespec="seconds")}),))
+
+    @staticmethod
+    def _read_sheet_exports(folder: str) -> Dict:
+        """อ่าน CSV ที่ดาวน์โหลดจากแต่ละชีต (pending_reviews.csv, approved_reviews.csv, users.csv, tokens.csv)"""
+        out: Dict[str, List[Dict]] = {}
+        for name in ("pending_reviews", "approved_reviews", "users", "tokens"):
+            fp = os.path.join(folder, f"{name}.csv")
+            if os.path.exists(fp):
+                with open(fp, "r", encoding="utf-8-sig", newline="") as f:
+                    out[name] = list(csv.DictReader(f))
+        return out
+
+    def _import_snapshot(self, conn, d: Dict) -> None:
+        for bucket in ("pending_reviews", "approved_reviews"):
+            self._insert_reviews(conn, bucket, [r for r in d.get(bucket, []) if r.get("id")])
+        conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [self._user_params(u) for u in d.get("users", []) if u.get("email")])
+        conn.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)",
+                         [self._token_params(t) for t in d.get("tokens", []) if t.get("token")])
+
+    # ---------- reviews ----------
+    def load_data(self) -> Dict:
+        out: Dict[str, List[Dict]] = {"pending_reviews": [], "approved_reviews": []}
+        for row in self._conn().execute("SELECT * FROM reviews ORDER BY rowid"):
+            out.setdefault(row["bucket"], []).append(self._review_dict(row))
+        return {"pending_reviews": out["pending_reviews"], "approved_reviews": out["approved_reviews"]}
+
+    def save_data(self, data: Dict) -> None:
+        with self._tx() as conn:
+            for bucket in ("pending_reviews", "approved_reviews"):
+                reviews = data.get(bucket, [])
+                keep = [str(r.get("id", "")) for r in reviews]
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS _keep (id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM _keep")
+                conn.executemany("INSERT OR IGNORE INTO _keep VALUES (?)", [(i,) for i in keep])
+                conn.execute("DELETE FROM reviews WHERE bucket = ? AND id NOT IN (SELECT id FROM _keep)",
+                             (bucket,))
+                self._insert_reviews(conn, bucket, reviews)
+
+    def append_review(self, review: Dict) -> None:
+        with self._tx() as conn:
+            self._insert_reviews(conn, "pending_reviews", [review])
+
+    def move_reviews(self, ids: List[str], from_bucket: str, to_bucket: Optional[str] = None,
+                     status: Optional[str] = None) -> None:
+        params = [(str(i), from_bucket) for i in ids]
+        with self._tx() as conn:
+            moved: List[Dict] = []
+            if to_bucket:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS _move (id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM _move")
+                conn.executemany("INSERT OR IGNORE INTO _move VALUES (?)", [(i,) for i, _ in params])
+                moved = [self._review_dict(r) for r in conn.execute(
+                    "SELECT * FROM reviews WHERE bucket = ? AND id IN (SELECT id FROM _move) ORDER BY rowid",
+                    (from_bucket,))]
+            conn.executemany("DELETE FROM reviews WHERE id = ? AND bucket = ?", params)
+            if moved:
+                # insert ใหม่ (ไม่ UPDATE bucket) ให้ได้ rowid ใหม่ = ไปอยู่ท้าย bucket ปลายทาง
+                self._insert_reviews(conn, to_bucket, [dict(r, status=status) if status else r for r in moved])
+
+    # ---------- users ----------
+    @staticmethod
+    def _user_dict(row: sqlite3.Row) -> Dict:
+        rec = {k: row[k] if row[k] is not None else "" for k in USERS_HEADERS}
+        rec["is_verified"] = bool(row["is_verified"])
+        return rec
+
+    def load_users(self) -> List[Dict]:
+        return [self._user_dict(r) for r in self._conn().execute("SELECT * FROM users ORDER BY rowid")]
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT * FROM users WHERE email_key = ?",
+                                   ((email or "").strip().lower(),)).fetchone()
+        return self._user_dict(row) if row else None
+
+    def save_users(self, users: List[Dict]) -> None:
+        with self._tx() as conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [self._user_params(u) for u in users if u.get("email")])
+
+    def upsert_user(self, user: Dict) -> None:
+        with self._tx() as conn:
+            key = (user.get("email") or "").strip().lower()
+            row = conn.execute("SELECT * FROM users WHERE email_key = ?", (key,)).fetchone()
+            merged = self._user_dict(row) if row else {}
+            merged.update(user)
+            conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         self._user_params(merged))
+
+    # ---------- tokens (verify/reset) ----------
+    def load_tokens(self) -> List[Dict]:
+        out = []
+        for r in self._conn().execute("SELECT * FROM tokens ORDER BY rowid"):
+            rec = {k: r[k] if r[k] is not None else "" for k in TOKENS_HEADERS}
+            rec["used"] = bool(r["used"])
+            out.append(rec)
+        return out
+
+    def save_tokens(self, tokens: List[Dict]) -> None:
+        with self._tx() as conn:
+            conn.execute("DELETE FROM tokens")
+            conn.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)",
+                             [self._token_params(t) for t in tokens if t.get("token")])
+
+    write_tokens = save_tokens
+
+    def add_token(self, token_row: Dict) -> None:
+        with self._tx() as conn:
+            conn.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)",
+                         self._token_params(token_row))
+
+    def get_token(self, token: str) -> Optional[Dict]:
+        r = self._conn().execute("SELECT * FROM tokens WHERE token = ?", (token,)).fetchone()
+        if not r:
+            return None
+        rec = {k: r[k] if r[k] is not None else "" for k in TOKENS_HEADERS}
+        rec["used"] = bool(r["used"])
+        return rec
+
+    def mark_token_used(self, token: str) -> bool:
+        with self._tx() as conn:
+            cur = conn.execute("UPDATE tokens SET used = 1 WHERE token = ? AND used = 0", (token,))
+            return cur.rowcount > 0
+
+    def sweep_tokens(self, now: str, limit: int = 500) -> int:
+        with self._tx() as conn:
+            cur = conn.execute(
+                "DELETE FROM tokens WHERE rowid IN (SELECT rowid FROM tokens "
+                "WHERE used = 1 OR (expires_at != '' AND expires_at < ?) LIMIT ?)", (now, limit))
+            return cur.rowcount
 
 
 # simple wrappers
@@ -807,25 +2500,170 @@ def save_tokens(tokens: List[Dict]) -> None:
 
 
 # ---- password hashing helpers ----
+# รูปแบบที่เก็บใน password_hash (salt ยังอยู่คอลัมน์ password_salt เหมือนเดิม):
+#   scrypt$<n>$<r>$<p>$<hex>   |   pbkdf2_sha256$<iterations>$<hex>   |   <hex 64 ตัว> = SHA-256 แบบเก่า
+PASSWORD_KDF = st.secrets.get("PASSWORD_KDF", "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256")
+PASSWORD_HASH_TARGET_MS = float(st.secrets.get("PASSWORD_HASH_TARGET_MS", 100))  # ปรับ cost ให้ได้ราว ๆ นี้ต่อครั้ง
+PASSWORD_HASH_WORKERS = int(st.secrets.get("PASSWORD_HASH_WORKERS", max(1, min(4, (os.cpu_count() or 2) // 2))))
+PASSWORD_HASH_QUEUE = int(st.secrets.get("PASSWORD_HASH_QUEUE", 32))     # คำขอที่รอคิวได้สูงสุด
+PASSWORD_HASH_TIMEOUT = float(st.secrets.get("PASSWORD_HASH_TIMEOUT", 10))  # วินาที
+SCRYPT_MIN_N, SCRYPT_MAX_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 2 ** 20, 8, 1
+SCRYPT_MAX_COST = 128 * SCRYPT_MAX_N * SCRYPT_R * 2   # เพดาน 128*n*r*p ของ hash ที่ยอมคำนวณ (~2 GiB·รอบ)
+PBKDF2_MIN_ITERATIONS = 600_000
+PBKDF2_MAX_ITERATIONS = 10_000_000  # เกินนี้ = hash เสีย/ถูกแก้ (ค่าจริงจาก _calibrate ต่ำกว่านี้มาก)
+
+
+class PasswordHasherBusy(RuntimeError):
+    """คิวคำนวณรหัสผ่านเต็ม/รอนานเกิน — ให้ผู้ใช้ลองใหม่ ดีกว่าปล่อยให้ทุกคอร์ถูกกินหมด"""
+
+
+def _scrypt(pw: str, salt: str, n: int, r: int, p: int) -> str:
+    return hashlib.scrypt(pw.encode("utf-8"), salt=salt.encode("utf-8"), n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=32).hex()
+
+
+def _pbkdf2(pw: str, salt: str, iterations: int) -> str:
+    return hashlib.pbkdf2_hmac("sha256", pw.encode("utf-8"), salt.encode("utf-8"), iterations).hex()
+
+
+class PasswordHasher:
+    """
+    คำนวณ KDF ใน thread pool ขนาดจำกัด (hashlib.scrypt/pbkdf2_hmac ปล่อย GIL ระหว่างคำนวณ)
+    - semaphore จำกัดจำนวนที่รอคิว; เต็มหรือรอเกิน timeout → PasswordHasherBusy
+    - cost ปรับจากการจับเวลาตอนสร้าง (ไม่ต่ำกว่าขั้นต่ำที่กำหนด)
+    """
+
+    def __init__(self, kdf: str = PASSWORD_KDF, target_ms: float = PASSWORD_HASH_TARGET_MS,
+                 workers: int = PASSWORD_HASH_WORKERS, queue: int = PASSWORD_HASH_QUEUE,
+                 timeout: float = PASSWORD_HASH_TIMEOUT):
+        self.kdf = kdf
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self.params = self._calibrate(target_ms)
+
+    def _calibrate(self, target_ms: float) -> Tuple[int, ...]:
+        if self.kdf == "scrypt":
+            n = SCRYPT_MIN_N
+            t0 = time.perf_counter()
+            _scrypt("calibrate", "salt", n, SCRYPT_R, SCRYPT_P)
+            ms = (time.perf_counter() - t0) * 1000.0
+            while n < SCRYPT_MAX_N and ms * 2 <= target_ms:
+                n, ms = n * 2, ms * 2
+            return (n, SCRYPT_R, SCRYPT_P)
+        t0 = time.perf_counter()
+        _pbkdf2("calibrate", "salt", 100_000)
+        ms = (time.perf_counter() - t0) * 1000.0
+        iterations = int(100_000 * target_ms / max(ms, 0.01))
+        return (min(PBKDF2_MAX_ITERATIONS, max(PBKDF2_MIN_ITERATIONS, iterations)),)
+
+    def _run(self, fn, *args):
+        # deadline เดียวครอบทั้งรอ slot และรอผล; slot คืนเมื่องานเสร็จจริง (ไม่ใช่ตอนเลิกรอ)
+        # ไม่งั้นงานที่ timeout แล้วยังกิน worker อยู่ แต่ semaphore ปล่อยคำขอใหม่เข้ามาเพิ่ม
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy("password hashing queue is full")
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _f: self._slots.release())
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError as e:
+            raise PasswordHasherBusy("password hashing timed out") from e
+
+    def hash(self, pw: str, salt: str) -> str:
+        if self.kdf == "scrypt":
+            n, r, p = self.params
+            return f"scrypt${n}${r}${p}${self._run(_scrypt, pw, salt, n, r, p)}"
+        (iterations,) = self.params
+        return f"pbkdf2_sha256${iterations}${self._run(_pbkdf2, pw, salt, iterations)}"
+
+    def verify(self, pw: str, salt: str, stored: str) -> bool:
+        parts = (stored or "").split("$")
+        try:
+            if parts[0] == "scrypt" and len(parts) == 5:
+                # กัน hash เสีย/ถูกแก้ที่สั่งให้จองหน่วยความจำ/กินเวลามหาศาล (ค้าง slot ของ pool จน login อื่นรอ)
+                n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+                if not (1 < n <= SCRYPT_MAX_N and r >= 1 and p >= 1 and 128 * n * r * p <= SCRYPT_MAX_COST):
+                    return False
+                candidate = self._run(_scrypt, pw, salt, n, r, p)
+            elif parts[0] == "pbkdf2_sha256" and len(parts) == 3:
+                iterations = int(parts[1])
+                if not 1 <= iterations <= PBKDF2_MAX_ITERATIONS:
+                    return False
+                candidate = self._run(_pbkdf2, pw, salt, iterations)
+            elif len(parts) == 1 and stored:
+                candidate = hashlib.sha256((salt + pw).encode("utf-8")).hexdigest()  # แบบเก่า (legacy)
+                return secrets.compare_digest(candidate, stored)
+            else:
+                return False
+            return secrets.compare_digest(candidate, parts[-1])
+        except (ValueError, OverflowError, TypeError):  # hash ที่เก็บไว้เสีย → ถือว่ารหัสผ่านไม่ตรง
+            return False
+
+    def needs_rehash(self, stored: str) -> bool:
+        """True ถ้าเป็นแบบเก่าหรือ cost ต่ำกว่าค่าปัจจุบัน"""
+        parts = (stored or "").split("$")
+        if parts[0] != self.kdf:
+            return True
+        try:
+            if self.kdf == "scrypt":
+                return len(parts) != 5 or int(parts[1]) < self.params[0]
+            return len(parts) != 3 or int(parts[1]) < self.params[0]
+        except ValueError:
+            return True
+
+
+@st.cache_resource
+def get_password_hasher() -> PasswordHasher:
+    return PasswordHasher()
+
 
 def make_salt() -> str:
     return secrets.token_hex(16)
 
 
 def hash_password(pw: str, salt: str) -> str:
-    return hashlib.sha256((salt + pw).encode("utf-8")).hexdigest()
+    return get_password_hasher().hash(pw, salt)
 
 
 def verify_password(pw: str, salt: str, pw_hash: str) -> bool:
-    return secrets.compare_digest(hash_password(pw, salt), pw_hash)
+    return get_password_hasher().verify(pw, salt, pw_hash)
+
+
+def check_user_password(user: Dict, pw: str) -> bool:
+    """verify_password + อัปเกรด hash เก่า/cost ต่ำ เป็นแบบปัจจุบันทันทีเมื่อรหัสผ่านถูก"""
+    if not verify_password(pw, user.get("password_salt", ""), user.get("password_hash", "")):
+        return False
+    if get_password_hasher().needs_rehash(user.get("password_hash", "")):
+        salt = make_salt()
+        upsert_user(dict(user, password_salt=salt, password_hash=hash_password(pw, salt)))
+    return True
 
 
 # ---- token helpers ----
 
+TOKEN_TTL = {"verify": timedelta(days=2), "reset": timedelta(hours=1)}
+TOKEN_SWEEP_INTERVAL = 600  # วินาที: กวาดโทเคนที่ใช้แล้ว/หมดอายุ ไม่บ่อยกว่านี้
+
+
 def generate_token() -> str:
     return secrets.token_urlsafe(24)
 
 
+def token_is_expired(t: Dict, now: Optional[str] = None) -> bool:
+    exp = t.get("expires_at") or ""
+    return bool(exp) and exp < (now or datetime.now().isoformat(timespec="seconds"))
+
+
+def token_is_dead(t: Dict, now: str) -> bool:
+    used = t.get("used") in (True, 1) or str(t.get("used", "")) in ("1", "true", "True", "yes")
+    return used or token_is_expired(t, now)
+
+
 # ---- email sender ----
 class Mailer:
     def __init__(self):
@@ -835,33 +2673,216 @@ class Mailer:
         self.password = st.secrets.get("SMTP_PASS")
         self.sender = st.secrets.get("SMTP_SENDER", self.user)
         self.sender_name = st.secrets.get("SMTP_SENDER_NAME", "Uni Course Reviews")
-        self.enabled = all([self.host, self.port, self.user, self.password, self.sender])
+        self.enabled = all([self.host, self.port, self.sender])  # user/pass ไม่บังคับ (relay ที่ไม่ต้อง login)
 
     def send(self, to_email: str, subject: str, body: str) -> bool:
         if not self.enabled:
             return False
+        queue = get_mail_queue()
+        if queue is None:
+            return False
+        queue.enqueue(to_email, subject, body, f"{self.sender_name} <{self.sender}>")
+        return True
+
+
+MAILER = Mailer()
+
+
+# ---- mail queue (spool + background SMTP sender) ----
+MAIL_SPOOL_DIR = st.secrets.get("MAIL_SPOOL_DIR", os.path.join("data", "mail_spool"))
+MAIL_MAX_ATTEMPTS = int(st.secrets.get("MAIL_MAX_ATTEMPTS", 8))
+MAIL_CONN_IDLE = 60  # วินาที: ปิด connection SMTP ที่ว่างนานกว่านี้
+
+
+class MailQueue:
+    """
+    คิวอีเมลขาออก: enqueue() เขียนลง spool (ไฟล์ละฉบับ, fsync + os.replace) แล้วคืนทันที
+    - worker thread เดียวส่งตามลำดับ ใช้ connection ที่ login แล้วซ้ำข้ามหลายฉบับ
+    - ส่งไม่ผ่าน → retry แบบ exponential backoff; ครบ MAIL_MAX_ATTEMPTS → ย้ายไป spool/failed
+    - รีสตาร์ตแล้วไฟล์ที่ค้างใน spool จะถูกส่งต่อ (ไม่หาย)
+    - starttls/login ปิดได้ ใช้ทดสอบกับ SMTP server จำลองในเครื่องได้
+    """
+
+    def __init__(self, spool_dir: str, host: str, port: int, user: Optional[str] = None,
+                 password: Optional[str] = None, use_ssl: bool = False, starttls: bool = True,
+                 timeout: float = 20, max_attempts: int = MAIL_MAX_ATTEMPTS, idle: float = MAIL_CONN_IDLE):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.host, self.port, self.user, self.password = host, int(port), user, password
+        self.use_ssl, self.starttls, self.timeout = use_ssl, starttls, timeout
+        self.max_attempts, self.idle = max_attempts, idle
+        self.counters = defaultdict(int)
+        self.last_error = ""
+        self._conn: Optional[smtplib.SMTP] = None
+        self._conn_used = 0.0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._loop, name="mail-queue", daemon=True)
+        self._thread.start()
+
+    # ---------- spool ----------
+
+    def _write(self, path: str, item: Dict) -> None:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(item, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def enqueue(self, to: str, subject: str, body: str, sender: str, reply_to: Optional[str] = None) -> str:
+        mid = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        self._write(os.path.join(self.spool_dir, f"{mid}.json"),
+                    {"id": mid, "to": to, "subject": subject, "body": body, "from": sender,
+                     "reply_to": reply_to or "", "attempts": 0, "next_at": 0.0, "error": ""})
+        self.counters["queued"] += 1
+        self._wake.set()
+        return mid
+
+    def pending(self) -> List[str]:
+        return sorted(n for n in os.listdir(self.spool_dir) if n.endswith(".json"))
+
+    # ---------- SMTP ----------
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.use_ssl:
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                    context=ssl.create_default_context())
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                conn.starttls(context=ssl.create_default_context())
+        if self.user and self.password:
+            conn.login(self.user, self.password)
+        return conn
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _send(self, item: Dict) -> None:
         msg = EmailMessage()
-        msg["From"] = f"{self.sender_name} <{self.sender}>"
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.set_content(body)
+        msg["Subject"] = item["subject"]
+        msg["From"] = item["from"]
+        msg["To"] = item["to"]
+        if item.get("reply_to"):
+            msg["Reply-To"] = item["reply_to"]
+        msg.set_content(item["body"])
+        for fresh in (False, True):
+            if self._conn is None:
+                self._conn = self._connect()
+                fresh = True
+            try:
+                self._conn.send_message(msg)
+                self._conn_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._conn = None  # connection เก่าหลุด → ต่อใหม่แล้วลองอีกครั้ง
+                if fresh:
+                    raise
+
+    def _process(self, name: str) -> Optional[float]:
+        """ส่ง 1 ฉบับ; คืนเวลาที่ควรลองใหม่ (ถ้ายังไม่ถึงเวลา/ส่งไม่ผ่าน)"""
+        path = os.path.join(self.spool_dir, name)
         try:
-            with smtplib.SMTP(self.host, self.port, timeout=20) as s:
-                s.starttls(context=ssl.create_default_context())
-                s.login(self.user, self.password)
-                s.send_message(msg)
-            return True
+            with open(path, encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item.get("next_at", 0) > time.time():
+            return item["next_at"]
+        try:
+            self._send(item)
         except Exception as e:
-            st.warning(f"ส่งอีเมลไม่สำเร็จ: {e}")
-            return False
+            self._close()
+            item["attempts"] += 1
+            item["error"] = str(e)
+            if item["attempts"] >= self.max_attempts:
+                self._write(os.path.join(self.failed_dir, name), item)
+                os.remove(path)
+                self.counters["failed"] += 1
+                return None
+            item["next_at"] = time.time() + min(600.0, 5 * 2 ** (item["attempts"] - 1)) * random.uniform(0.8, 1.2)
+            self._write(path, item)
+            self.counters["retried"] += 1
+            return item["next_at"]
+        os.remove(path)
+        self.counters["sent"] += 1
+        return None
+
+    def _error(self, e: Exception) -> None:
+        self.counters["errors"] += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            wake_at = time.time() + self.idle
+            try:
+                names = self.pending()
+            except OSError as e:
+                self._error(e)
+                names = []
+                wake_at = time.time() + 5
+            for name in names:
+                # ข้อผิดพลาดที่ไม่ใช่ SMTP (เช่น เขียน spool ไม่ได้/ดิสก์เต็ม) ต้องไม่ฆ่า worker
+                # ไฟล์ยังอยู่ใน spool → รอบหน้าลองใหม่
+                try:
+                    retry_at = self._process(name)
+                except Exception as e:
+                    self._error(e)
+                    retry_at = time.time() + 5
+                if retry_at is not None:
+                    wake_at = min(wake_at, retry_at)
+            if self._conn is not None and time.monotonic() - self._conn_used > self.idle:
+                self._close()
+            self._wake.wait(max(0.05, wake_at - time.time()))
+        self._close()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, spooled=len(self.pending()))
+
+
+def smtp_settings() -> Dict:
+    return {
+        "host": st.secrets.get("SMTP_HOST"),
+        "port": st.secrets.get("SMTP_PORT"),
+        "user": st.secrets.get("SMTP_USER"),
+        "password": st.secrets.get("SMTP_PASS"),
+        "sender": st.secrets.get("SMTP_SENDER") or st.secrets.get("SMTP_USER"),
+        "sender_name": st.secrets.get("SMTP_SENDER_NAME", "MU Course Reviews"),
+        "use_ssl": str(st.secrets.get("SMTP_SSL", "false")).lower() in ("1", "true", "yes"),
+        "starttls": str(st.secrets.get("SMTP_STARTTLS", "true")).lower() in ("1", "true", "yes"),
+        "reply_to": st.secrets.get("REPLY_TO"),
+    }
 
 
-MAILER = Mailer()
+@st.cache_resource
+def get_mail_queue() -> Optional[MailQueue]:
+    """None ถ้ายังตั้งค่า SMTP ไม่ครบ (host/port/sender)"""
+    cfg = smtp_settings()
+    if not (cfg["host"] and cfg["port"] and cfg["sender"]):
+        return None
+    return MailQueue(MAIL_SPOOL_DIR, cfg["host"], int(cfg["port"]), cfg["user"], cfg["password"],
+                     use_ssl=cfg["use_ssl"], starttls=cfg["starttls"])
 
 
 # ---- auth data layer ----
 
 def find_user_by_email(email: str) -> Optional[Dict]:
+    storage = get_storage()
+    if hasattr(storage, "get_user"):
+        return storage.get_user(email)
     users = load_users()
     for u in users:
         if u.get("email", "").lower() == email.lower():
@@ -870,6 +2891,10 @@ def find_user_by_email(email: str) -> Optional[Dict]:
 
 
 def upsert_user(user: Dict) -> None:
+    storage = get_storage()
+    if hasattr(storage, "upsert_user"):
+        storage.upsert_user(user)
+        return
     users = load_users()
     found = False
     for i, u in enumerate(users):
@@ -882,26 +2907,66 @@ def upsert_user(user: Dict) -> None:
     save_users(users)
 
 
-def add_token(email: str, type_: str, expires_at: str) -> Dict:
-    tokens = load_tokens()
+def _maybe_sweep_tokens(storage) -> None:
+    """กวาดโทเคนตอนเขียน (on-write) อย่างมากทุก TOKEN_SWEEP_INTERVAL วินาทีต่อโปรเซส"""
+    if not hasattr(storage, "sweep_tokens"):
+        return
+    # เก็บเวลาไว้บน storage (cache_resource) เพราะตัวแปรระดับโมดูลถูกสร้างใหม่ทุก rerun
+    if time.monotonic() - getattr(storage, "_tokens_swept_at", 0.0) < TOKEN_SWEEP_INTERVAL:
+        return
+    storage._tokens_swept_at = time.monotonic()
+    try:
+        storage.sweep_tokens(datetime.now().isoformat(timespec="seconds"))
+    except Exception:
+        pass  # การกวาดเป็นงานเสริม ไม่ให้ทำให้การสมัคร/รีเซ็ตล้ม
+
+
+def add_token(email: str, type_: str, expires_at: str = "") -> Dict:
+    now = datetime.now()
+    if not expires_at:
+        expires_at = (now + TOKEN_TTL.get(type_, timedelta(days=1))).isoformat(timespec="seconds")
     tok = {"token": generate_token(), "email": email, "type": type_, "expires_at": expires_at, "used": False,
-           "created_at": datetime.now().isoformat(timespec="seconds")}
-    tokens.append(tok);
-    save_tokens(tokens)
+           "created_at": now.isoformat(timespec="seconds")}
+    storage = get_storage()
+    if hasattr(storage, "add_token"):
+        storage.add_token(tok)
+    else:
+        tokens = load_tokens()
+        tokens.append(tok);
+        save_tokens(tokens)
+    _maybe_sweep_tokens(storage)
     return tok
 
 
-def consume_token(token: str, type_: str) -> Optional[Dict]:
-    tokens = load_tokens()
-    for t in tokens:
-        if t.get("token") == token and t.get("type") == type_ and not t.get("used"):
-            # (ไม่ตรวจวันหมดอายุแบบเข้มงวดเพื่อความง่ายของ prototype)
-            t["used"] = True
-            save_tokens(tokens)
-            return t
+def get_token_record(token: str, type_: str) -> Optional[Dict]:
+    storage = get_storage()
+    if hasattr(storage, "get_token"):
+        t = storage.get_token(token)
+    else:
+        t = next((t for t in load_tokens() if t.get("token") == token), None)
+    if t and t.get("type") == type_:
+        return t
     return None
 
 
+def consume_token(token: str, type_: str) -> Optional[Dict]:
+    t = get_token_record(token, type_)
+    if not t or t.get("used") or token_is_expired(t):
+        return None
+    storage = get_storage()
+    if hasattr(storage, "mark_token_used"):
+        if not storage.mark_token_used(token):
+            return None
+    else:
+        tokens = load_tokens()
+        for row in tokens:
+            if row.get("token") == token:
+                row["used"] = True
+        save_tokens(tokens)
+    t["used"] = True
+    return t
+
+
 # ---- URL helpers ----
 
 def make_link_with_param(param_key: str, token: str) -> str:
@@ -991,7 +3056,12 @@ def do_login_form():
                                 st.markdown(f"[คลิกเพื่อยืนยันบัญชี]({link})")
                                 st.code(link)
                     else:
-                        if verify_password(pw, u.get("password_salt", ""), u.get("password_hash", "")):
+                        try:
+                            ok = check_user_password(u, pw)
+                        except PasswordHasherBusy:
+                            st.warning("ระบบกำลังมีผู้ใช้งานจำนวนมาก โปรดลองใหม่อีกครั้ง")
+                            ok = None
+                        if ok:
                             st.session_state["auth"] = {
                                 "email": u["email"], "username": u["email"],
                                 "role": u.get("role", "student"),
@@ -999,7 +3069,7 @@ def do_login_form():
                             }
                             st.success("เข้าสู่ระบบสำเร็จ")
                             st.rerun()
-                        else:
+                        elif ok is not None:
                             st.error("รหัสผ่านไม่ถูกต้อง")
 
     # =========================
@@ -1027,7 +3097,11 @@ def do_login_form():
             else:
                 existing = find_user_by_email(student_email)
                 salt = make_salt()
-                pw_hash = hash_password(pw1, salt)
+                try:
+                    pw_hash = "" if existing and existing.get("is_verified") else hash_password(pw1, salt)
+                except PasswordHasherBusy:
+                    st.warning("ระบบกำลังมีผู้ใช้งานจำนวนมาก โปรดลองใหม่อีกครั้ง")
+                    st.stop()
 
                 if existing and existing.get("is_verified"):
                     st.error("อีเมลนี้มีผู้ใช้งานแล้ว")
@@ -1105,19 +3179,26 @@ def do_login_form():
                     st.error("รหัสผ่านยืนยันไม่ตรงกัน")
                 else:
                     tok = get_token_record(reset_token, "reset")
-                    if not tok or tok.get("used"):
-                        st.error("โทเคนไม่ถูกต้องหรือถูกใช้ไปแล้ว")
+                    if not tok or tok.get("used") or token_is_expired(tok):
+                        st.error("โทเคนไม่ถูกต้อง หมดอายุ หรือถูกใช้ไปแล้ว")
                     else:
                         u = find_user_by_email(tok["email"])
                         if not u:
                             st.error("ไม่พบบัญชีผู้ใช้ที่เกี่ยวข้องกับโทเคน")
                         else:
                             salt = make_salt()
-                            pw_hash = hash_password(npw1, salt)
+                            try:
+                                pw_hash = hash_password(npw1, salt)
+                            except PasswordHasherBusy:
+                                st.warning("ระบบกำลังมีผู้ใช้งานจำนวนมาก โปรดลองใหม่อีกครั้ง")
+                                st.stop()
+                            # ใช้โทเคนก่อนแล้วค่อยเขียนรหัสใหม่: กดส่งลิงก์เดียวกันซ้ำ/พร้อมกัน มีแค่ครั้งแรกที่เปลี่ยนรหัสได้
+                            if not consume_token(reset_token, "reset"):
+                                st.error("โทเคนไม่ถูกต้อง หมดอายุ หรือถูกใช้ไปแล้ว")
+                                st.stop()
                             u["password_salt"] = salt
                             u["password_hash"] = pw_hash
                             upsert_user(u)
-                            consume_token(reset_token, "reset")
                             st.success("ตั้งรหัสผ่านใหม่สำเร็จ! โปรดเข้าสู่ระบบอีกครั้ง")
                             try:
                                 st.query_params.clear()
@@ -1213,53 +3294,77 @@ def sidebar_user_box():
             st.rerun()
 
 
+def perf_sidebar_panel():
+    """แผงเวลาแต่ละ stage (p50/p95) + การเรียก Sheets/โควต้าที่เหลือ — แสดงเฉพาะแอดมิน"""
+    with st.sidebar.expander("⏱️ Performance", expanded=False):
+        scope = st.radio("ขอบเขต", ["session นี้", "ทั้งโปรเซส"], horizontal=True, key="perf_scope")
+        metrics = get_process_metrics() if scope == "ทั้งโปรเซส" else _session_metrics()
+        rows = metrics.summary() if metrics is not None else []
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        else:
+            st.caption("ยังไม่มีข้อมูลเวลา")
+        if BACKEND == "gsheets":
+            sched = get_sheets_scheduler()
+            stats = sched.stats()
+            st.markdown("**Google Sheets**")
+            st.caption(" • ".join(f"{k}: {stats.get(k, 0)}" for k in
+                                  ("reads", "writes", "coalesced", "throttled", "retried", "rate_limited", "errors")))
+            st.caption(f"โควต้าคงเหลือ: อ่าน {sched.read_bucket.available():.0f}/{sched.read_bucket.capacity:.0f} • "
+                       f"เขียน {sched.write_bucket.available():.0f}/{sched.write_bucket.capacity:.0f} ต่อนาที")
+        storage = get_storage()
+        if hasattr(storage, "cache_stats"):
+            cstats = storage.cache_stats()
+            st.markdown("**Local storage**")
+            st.caption(" • ".join(f"{k}: {cstats.get(k, 0)}" for k in ("hits", "misses", "compactions", "commits", "writes")))
+        queue = get_mail_queue()
+        if queue is not None:
+            mstats = queue.stats()
+            st.markdown("**อีเมล**")
+            st.caption(" • ".join(f"{k}: {mstats.get(k, 0)}" for k in ("queued", "sent", "retried", "failed", "errors", "spooled")))
+            if queue.last_error:
+                st.caption(f"ข้อผิดพลาดล่าสุด: {queue.last_error}")
+        if st.button("ล้างสถิติ", key="perf_reset"):
+            if metrics is not None:
+                metrics.reset()
+
+
 # -----------------------------
 # Helpers for filters (frontend)
 # -----------------------------
-ALL_FACULTIES = ["ทั้งหมด"] + sorted({r["faculty_name"] for r in ALL_COURSES})
-
-
-def faculty_options() -> List[str]:
-    return ALL_FACULTIES
+def faculty_options() -> Tuple[str, ...]:
+    return COURSE_CATALOG.faculty_options()
 
 
 def department_options(selected_faculty_name: str) -> List[str]:
-    if selected_faculty_name == "ทั้งหมด":
-        depts = sorted({r["department_name"] for r in ALL_COURSES})
-    else:
-        depts = sorted({r["department_name"] for r in ALL_COURSES if r["faculty_name"] == selected_faculty_name})
+    depts = sorted({r["department_name"] for r in COURSE_CATALOG.courses_by_faculty_name(selected_faculty_name)})
     return ["ทั้งหมด"] + depts
 
 
 def year_options(selected_faculty_name: str, selected_dept_name: str) -> List[str]:
     # show actual years available from catalog
     years = sorted({
-        r["year"] for r in ALL_COURSES
-        if (selected_faculty_name == "ทั้งหมด" or r["faculty_name"] == selected_faculty_name)
-           and (selected_dept_name == "ทั้งหมด" or r["department_name"] == selected_dept_name)
+        r["year"] for r in COURSE_CATALOG.courses_by_faculty_name(selected_faculty_name)
+        if selected_dept_name == "ทั้งหมด" or r["department_name"] == selected_dept_name
     })
     return ["ทั้งหมด"] + [str(y) for y in years]
 
 
-def filter_courses(fac_name: str, dept_name: str, year_str: str) -> List[Dict]:
-    items = list(ALL_COURSES)
-    if fac_name != "ทั้งหมด":
-        items = [r for r in items if r["faculty_name"] == fac_name]
+def filter_courses(fac_name: str, dept_name: str, year_str: str) -> List[CourseRecord]:
+    items = COURSE_CATALOG.courses_by_faculty_name(fac_name)
     if dept_name != "ทั้งหมด":
         items = [r for r in items if r["department_name"] == dept_name]
     if year_str != "ทั้งหมด":
         items = [r for r in items if r["year"] == int(year_str)]
-    return items
+    return list(items)
 
 
 # -----------------------------
 # Student page
 # -----------------------------
 
+@instrumented()
 def page_student(data: Dict):
-    approved = data["approved_reviews"]
-    pending = data["pending_reviews"]
-
     t_submit, t_browse = st.tabs(["📝 ส่งรีวิวรายวิชา", "🔎 ดูรีวิวที่อนุมัติแล้ว"])
 
     # Submit tab
@@ -1360,8 +3465,7 @@ def page_student(data: Dict):
                 "status": "pending",
             }
 
-            pending.append(new_r)
-            save_data(data)
+            append_review(new_r)
             st.success("ส่งรีวิวเรียบร้อย! รอผู้ดูแลอนุมัติ")
             st.balloons()
 
@@ -1369,13 +3473,13 @@ def page_student(data: Dict):
     with t_browse:
         st.subheader("ดูรีวิวที่อนุมัติแล้ว")
 
-        approved_only = [r for r in approved if r.get("status") == "approved"]
+        a_table = get_review_table("approved_reviews")  # ตัวเลือก dropdown จำไว้ต่อรุ่นข้อมูล
 
         col1, col2, col3, col4 = st.columns([1, 1, 1, 1.2])
 
         # 1) ประเภท
         with col1:
-            t_opts = admin_type_options(approved_only)
+            t_opts = a_table.type_options(approved_only=True)
             s_type = st.selectbox(
                 "ประเภท", t_opts, index=0, key="stu_a_type",
                 format_func=lambda v: "ทั้งหมด" if v == "ทั้งหมด" else COURSE_TYPES.get(v, v)
@@ -1384,7 +3488,7 @@ def page_student(data: Dict):
 
         # 2) คณะ (ขึ้นกับประเภท)
         with col2:
-            fac_map2 = admin_faculty_map(approved_only, sel_type2)
+            fac_map2 = a_table.faculty_map(True, sel_type2)
             f_opts2 = ["ทั้งหมด"] + list(sorted(fac_map2.keys()))
             s_fac = st.selectbox(
                 "คณะ", f_opts2, index=0, key="stu_a_fac",
@@ -1394,86 +3498,547 @@ def page_student(data: Dict):
 
         # 3) รายวิชา (ขึ้นกับประเภท+คณะ)
         with col3:
-            c_opts2 = admin_course_options(approved_only, sel_type2, sel_fac2)
+            c_opts2 = a_table.course_options(True, sel_type2, sel_fac2)
             s_course = st.selectbox("รายวิชา", c_opts2, index=0, key="stu_a_course")
 
         # 4) ค้นหา
         with col4:
-            s_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", key="stu_a_q")
+            s_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", help=SEARCH_HELP, key="stu_a_q")
 
         # ตัวกรองอื่น ๆ + จัดเรียง
         s_minr = st.slider("คะแนนขั้นต่ำ", 1, 5, 1, step=1, key="stu_a_minr")
-        s_sort = st.selectbox(
-            "จัดเรียงโดย",
-            ["วันที่ (ใหม่→เก่า)", "วันที่ (เก่า→ใหม่)", "คะแนน (สูง→ต่ำ)", "คะแนน (ต่ำ→สูง)"],
-            index=0, key="stu_a_sort"
-        )
+        s_sort = st.selectbox("จัดเรียงโดย", SORT_OPTIONS, index=0, key="stu_a_sort")
 
         # apply filters & sort เหมือนแอดมิน แล้วเรนเดอร์แบบ grouped
-        sf = admin_apply_filters(approved_only, sel_type2, sel_fac2, s_course, s_q, s_minr)
-        sf = admin_sort_items(sf, s_sort)
-        render_grouped(sf, pending_mode=False)  # ไม่มีปุ่มอนุมัติ/ปฏิเสธในฝั่งนักศึกษา
+        sf = query_reviews("approved_reviews", sel_type2, sel_fac2, s_course, s_q, s_minr, s_sort,
+                           approved_only=True)
+        render_grouped(sf, pending_mode=False, key_prefix="stu_a")  # ไม่มีปุ่มอนุมัติ/ปฏิเสธในฝั่งนักศึกษา
 
 
 # -----------------------------
+# Full-text search index (review text + course name)
 # -----------------------------
-# Admin helpers (filters + grouping)  [REPLACED]
-# -----------------------------
+try:  # ตัดคำภาษาไทยด้วย PyThaiNLP ถ้าติดตั้งไว้ (ไม่บังคับ)
+    from pythainlp.tokenize import word_tokenize as _thai_word_tokenize
+except Exception:
+    _thai_word_tokenize = None
 
-def admin_type_options(items: List[Dict]) -> List[str]:
-    """คืนค่าเป็น list ของคีย์ประเภทที่มีอยู่จริงใน items เช่น ['GE','FE','ME']"""
-    types = sorted({r.get("course_type") for r in items if r.get("course_type")})
-    return ["ทั้งหมด"] + types
+# ช่วงอักษรไทยต้องมาก่อน เพราะสระ/วรรณยุกต์ไทยไม่นับเป็น \w
+_SEARCH_WORD_RE = re.compile(r"[฀-๿]+|[^\W_]+")
+_SEARCH_QUERY_RE = re.compile(r'"([^"]*)"?|(\S+)')
 
-def admin_faculty_map(items: List[Dict], sel_type: Optional[str] = None) -> Dict[str, str]:
-    """สร้าง mapping code -> name เฉพาะที่มีอยู่จริงใน items (ตามประเภทที่เลือก)"""
-    rows = [r for r in items if r.get("faculty") and (not sel_type or r.get("course_type") == sel_type)]
-    m = {}
-    for r in rows:
-        code = r.get("faculty")
-        name = r.get("faculty_name") or code
-        if code not in m:
-            m[code] = name
-    return m
-
-def admin_course_options(items: List[Dict], sel_type: Optional[str], sel_fac: Optional[str]) -> List[str]:
-    """คืนค่าเป็น ['ทั้งหมด', 'CODE NAME', ...] ตามตัวกรองประเภท/คณะ"""
-    rows = [r for r in items if r.get("course_code")]
-    if sel_type:
-        rows = [r for r in rows if r.get("course_type") == sel_type]
-    if sel_fac:
-        rows = [r for r in rows if r.get("faculty") == sel_fac]
-    names = sorted({f"{r['course_code']} {r.get('course_name','')}".strip() for r in rows})
-    return ["ทั้งหมด"] + names
-
-def admin_apply_filters(items: List[Dict],
-                        sel_type: Optional[str],
-                        sel_fac: Optional[str],
-                        course_label: str,
-                        q: str,
-                        min_rating: int) -> List[Dict]:
-    out = list(items)
-    if sel_type:
-        out = [r for r in out if r.get("course_type") == sel_type]
-    if sel_fac:
-        out = [r for r in out if r.get("faculty") == sel_fac]
-    if course_label and course_label != "ทั้งหมด":
-        code = course_label.split(" ")[0]
-        out = [r for r in out if str(r.get("course_code", "")) == code]
-    if q:
-        ql = q.lower().strip()
-        out = [r for r in out if ql in (r.get("text") or "").lower()
-               or ql in (r.get("course_name") or "").lower()]
-    if min_rating and min_rating > 1:
-        out = [r for r in out if int(r.get("rating", 0)) >= min_rating]
+
+SEARCH_HELP = ('ต้องเจอทุกคำ (ไม่ต้องเรียงกัน) และพิมพ์ต้นคำก็เจอ เช่น "prog" เจอ "programming"; '
+               'ใส่ "..." เพื่อค้นวลีตรงตัว')
+
+
+def _is_thai(word: str) -> bool:
+    return "฀" <= word[0] <= "๿"
+
+
+def search_tokens(text: str) -> List[str]:
+    """
+    แตก token สำหรับค้นหา (ตัวพิมพ์เล็ก)
+    - ภาษาไทย: ตัดคำด้วย PyThaiNLP ถ้ามี; ไม่มี → bigram ตัวอักษร (ค้นกลางคำได้ ใช้แทน substring เดิม)
+    - อื่น ๆ: คำตามตัวอักษร/ตัวเลข
+    """
+    out: List[str] = []
+    for m in _SEARCH_WORD_RE.finditer((text or "").lower()):
+        w = m.group()
+        if not _is_thai(w):
+            out.append(w)
+        elif _thai_word_tokenize is not None:
+            out.extend(t for t in _thai_word_tokenize(w, engine="newmm", keep_whitespace=False) if t.strip())
+        elif len(w) == 1:
+            out.append(w)
+        else:
+            out.extend(w[i:i + 2] for i in range(len(w) - 1))
     return out
 
-def admin_sort_items(items: List[Dict], sort_key: str) -> List[Dict]:
-    if sort_key == "วันที่ (ใหม่→เก่า)": return sorted(items, key=lambda x: x.get("created_at", ""), reverse=True)
-    if sort_key == "วันที่ (เก่า→ใหม่)": return sorted(items, key=lambda x: x.get("created_at", ""))
-    if sort_key == "คะแนน (สูง→ต่ำ)": return sorted(items, key=lambda x: int(x.get("rating", 0)), reverse=True)
-    if sort_key == "คะแนน (ต่ำ→สูง)": return sorted(items, key=lambda x: int(x.get("rating", 0)))
-    return items
+
+class ReviewSearchIndex:
+    """
+    inverted index แบบมีตำแหน่ง (token → {review id → [ตำแหน่ง]}) ของข้อความรีวิว + รหัส/ชื่อวิชา
+    - เพิ่ม/ลบทีละรีวิว; sync() เทียบ id + fingerprint ของฟิลด์ที่ index เมื่อข้อมูลเปลี่ยนรุ่น (ไม่สร้างใหม่ทั้งก้อน)
+    - query: หลายคำ = ต้องเจอทุกคำ (จัดอันดับแบบ BM25), "..." = วลีตรงตัว, คำนอก "..." = prefix (พิมพ์ไม่จบคำก็เจอ)
+    """
+
+    FIELDS = ("course_code", "course_name", "text")
+    FIELD_GAP = 1000  # เว้นตำแหน่งระหว่างฟิลด์ กันวลีข้ามฟิลด์
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Dict[str, List[int]]] = {}
+        self._doc_terms: Dict[str, Tuple[str, ...]] = {}
+        self._doc_len: Dict[str, int] = {}
+        self._doc_fp: Dict[str, Tuple[str, ...]] = {}  # ค่าฟิลด์ที่ index ไว้ — แก้ข้อความ/วิชาใต้ id เดิมต้อง index ใหม่
+        self._total_len = 0
+        self._vocab: List[str] = []  # เรียงไว้สำหรับ prefix (bisect)
+        self.generation = -1
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    @classmethod
+    def _fingerprint(cls, review: Dict) -> Tuple[str, ...]:
+        return tuple(str(review.get(field) or "") for field in cls.FIELDS)
+
+    def add(self, review: Dict) -> None:
+        rid = str(review.get("id", ""))
+        if not rid:
+            return
+        with self._lock:
+            if rid in self._doc_len:
+                self.remove(rid)
+            positions: Dict[str, List[int]] = defaultdict(list)
+            pos = 0
+            fp = self._fingerprint(review)
+            for value in fp:
+                for tok in search_tokens(value):
+                    positions[tok].append(pos)
+                    pos += 1
+                pos += self.FIELD_GAP
+            for tok, plist in positions.items():
+                posting = self._postings.get(tok)
+                if posting is None:
+                    posting = self._postings[tok] = {}
+                    bisect.insort(self._vocab, tok)
+                posting[rid] = plist
+            n = sum(len(p) for p in positions.values())
+            self._doc_terms[rid] = tuple(positions)
+            self._doc_fp[rid] = fp
+            self._doc_len[rid] = n
+            self._total_len += n
+
+    def remove(self, rid: str) -> None:
+        with self._lock:
+            terms = self._doc_terms.pop(rid, None)
+            if terms is None:
+                return
+            self._total_len -= self._doc_len.pop(rid, 0)
+            self._doc_fp.pop(rid, None)
+            for tok in terms:
+                posting = self._postings.get(tok)
+                if posting is None:
+                    continue
+                posting.pop(rid, None)
+                if not posting:
+                    del self._postings[tok]
+                    i = bisect.bisect_left(self._vocab, tok)
+                    if i < len(self._vocab) and self._vocab[i] == tok:
+                        del self._vocab[i]
+
+    def sync(self, reviews: List[Dict], generation: int) -> None:
+        """ทำให้ index ตรงกับ reviews — เพิ่ม id ใหม่, ลบ id ที่หายไป, index ใหม่เฉพาะรีวิวที่ฟิลด์ที่ค้นได้เปลี่ยน"""
+        if generation == self.generation:
+            return
+        with self._lock:
+            if generation == self.generation:
+                return
+            current = {str(r.get("id", "")): r for r in reviews if r.get("id")}
+            for rid in [rid for rid in self._doc_len if rid not in current]:
+                self.remove(rid)
+            for rid, r in current.items():
+                if self._doc_fp.get(rid) != self._fingerprint(r):
+                    self.add(r)  # add() ลบ postings เดิมของ id นี้ก่อน
+            self.generation = generation
+
+    # ---------- query ----------
+
+    def _expand(self, tok: str, prefix: bool) -> Dict[str, List[int]]:
+        """postings ของ token; prefix=True รวม token ทุกตัวที่ขึ้นต้นด้วย tok"""
+        if not prefix:
+            return self._postings.get(tok, {})
+        merged: Dict[str, List[int]] = {}
+        i = bisect.bisect_left(self._vocab, tok)
+        while i < len(self._vocab) and self._vocab[i].startswith(tok):
+            for rid, plist in self._postings[self._vocab[i]].items():
+                merged.setdefault(rid, []).extend(plist)
+            i += 1
+        return merged
+
+    @staticmethod
+    def _parse(query: str) -> List[Tuple[List[str], bool]]:
+        """แยก query เป็นกลุ่ม (tokens, อยู่ใน "..." ไหม); กลุ่มที่มีหลาย token (วลี/คำไทย) ต้องเรียงติดกัน"""
+        groups = []
+        for m in _SEARCH_QUERY_RE.finditer(query or ""):
+            toks = search_tokens(m.group(1) if m.group(1) is not None else m.group(2))
+            if toks:
+                groups.append((toks, m.group(1) is not None))
+        return groups
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """คืน [(review id, คะแนน)] เรียงจากเกี่ยวข้องมากไปน้อย"""
+        groups = self._parse(query)
+        if not groups:
+            return []
+        with self._lock:
+            n_docs = len(self._doc_len) or 1
+            avg_len = (self._total_len / n_docs) or 1.0
+            scores: Optional[Dict[str, float]] = None
+            for toks, quoted in groups:
+                lists = [self._expand(t, prefix=not quoted) for t in toks]
+                if any(not p for p in lists):
+                    return []
+                cand = set(min(lists, key=len))
+                if scores is not None:
+                    cand &= scores.keys()
+                for p in lists:
+                    cand.intersection_update(p)
+                if len(toks) > 1:
+                    cand = {rid for rid in cand if self._has_phrase([p[rid] for p in lists])}
+                group_scores: Dict[str, float] = {}
+                for p in lists:
+                    idf = math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5))
+                    for rid in cand:
+                        tf = len(p[rid])
+                        norm = 1.2 * (0.25 + 0.75 * self._doc_len[rid] / avg_len)
+                        group_scores[rid] = group_scores.get(rid, 0.0) + idf * tf * 2.2 / (tf + norm)
+                scores = group_scores if scores is None else {rid: scores[rid] + group_scores[rid] for rid in cand}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda kv: -kv[1])
+        return ranked[:limit] if limit else ranked
+
+    @staticmethod
+    def _has_phrase(position_lists: List[List[int]]) -> bool:
+        rest = [set(p) for p in position_lists[1:]]
+        return any(all(start + k + 1 in s for k, s in enumerate(rest)) for start in position_lists[0])
+
+    def match_ids(self, query: str) -> set:
+        return {rid for rid, _ in self.search(query)}
+
+
+@st.cache_resource
+def _review_search_indexes() -> Dict[str, ReviewSearchIndex]:
+    return {"pending_reviews": ReviewSearchIndex(), "approved_reviews": ReviewSearchIndex()}
+
+
+def get_review_search_index(bucket: str) -> ReviewSearchIndex:
+    """index ของ bucket ที่ sync กับ snapshot ล่าสุดของ DataCache (งานเกิดเฉพาะตอนข้อมูลเปลี่ยนรุ่น)"""
+    idx = _review_search_indexes()[bucket]
+    data, gen = load_data_versioned()
+    if idx.generation != gen:
+        with timed("search_index.sync"):
+            idx.sync(data.get(bucket, []), gen)
+    return idx
+
+
+# -----------------------------
+# Columnar review table (NumPy)
+# -----------------------------
+SORT_OPTIONS = ["วันที่ (ใหม่→เก่า)", "วันที่ (เก่า→ใหม่)", "คะแนน (สูง→ต่ำ)", "คะแนน (ต่ำ→สูง)"]
+REVIEW_PAGE_SIZES = [10, 20, 50, 100]
+REVIEW_PAGE_SIZE = int(st.secrets.get("REVIEW_PAGE_SIZE", 20))  # ค่าเริ่มต้นของ "รีวิวต่อหน้า"
+AggKey = Tuple[str, str, str]  # (course_type, faculty, course_code)
+
+
+class ReviewTable:
+    """
+    มุมมองแบบคอลัมน์ของรีวิวใน bucket เดียว (สร้างครั้งเดียวต่อรุ่นข้อมูล)
+    - course_type / faculty / course_code เก็บเป็นรหัส category (int32) + ตาราง labels
+    - rating เป็น int8, created_at เป็น datetime64 (แปลงไม่ได้ = NaT → เรียงไว้เก่าสุด)
+    - กรอง = boolean mask, เรียง = argsort (stable) ครั้งเดียวต่อ key, สรุปต่อรายวิชา = bincount
+    """
+
+    def __init__(self, rows: List[Dict], generation: int = -1):
+        self.generation = generation
+        self.source = rows
+        n = len(rows)
+        self.rows = np.empty(n, dtype=object)
+        self.rows[:] = rows
+        get = lambda k: [r.get(k) or "" for r in rows]
+        self.type_codes, self.type_labels = self._factorize(get("course_type"))
+        self.fac_codes, self.fac_labels = self._factorize(get("faculty"))
+        self.course_codes, self.course_labels = self._factorize([str(r.get("course_code") or "") for r in rows])
+        self.name_codes, self.name_labels = self._factorize(get("course_name"))
+        self.rating = np.fromiter((_as_rating(r.get("rating")) for r in rows), dtype=np.int8, count=n)
+        created = pd.to_datetime(pd.Series(get("created_at"), dtype=object), errors="coerce", format="ISO8601")
+        self.created_at = created.to_numpy(dtype="datetime64[ns]")
+        self.approved = np.fromiter((r.get("status") == "approved" for r in rows), dtype=bool, count=n)
+        self.ids = np.array([r.get("id") for r in rows], dtype=object)
+        self.position = {r.get("id"): i for i, r in enumerate(rows)}
+        self._perms: Dict[str, np.ndarray] = {}
+        self._options: Dict[Tuple, object] = {}
+
+    @staticmethod
+    def _factorize(values: List[str]) -> Tuple[np.ndarray, Tuple[str, ...]]:
+        codes, labels = pd.factorize(pd.Series(values, dtype=object), sort=True)
+        return codes.astype(np.int32), tuple(labels)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _code_of(self, labels: Tuple[str, ...], value: str) -> int:
+        i = bisect.bisect_left(labels, value)
+        return i if i < len(labels) and labels[i] == value else -1
+
+    def mask(self, sel_type: Optional[str] = None, sel_fac: Optional[str] = None,
+             course_code: Optional[str] = None, min_rating: int = 0,
+             ids: Optional[set] = None, approved_only: bool = False) -> np.ndarray:
+        m = np.ones(len(self.rows), dtype=bool)
+        if approved_only:
+            m &= self.approved
+        if sel_type:
+            m &= self.type_codes == self._code_of(self.type_labels, sel_type)
+        if sel_fac:
+            m &= self.fac_codes == self._code_of(self.fac_labels, sel_fac)
+        if course_code:
+            m &= self.course_codes == self._code_of(self.course_labels, course_code)
+        if min_rating and min_rating > 1:
+            m &= self.rating >= min_rating
+        if ids is not None:
+            hit = np.zeros(len(self.rows), dtype=bool)
+            pos = [self.position[i] for i in ids if i in self.position]
+            hit[pos] = True
+            m &= hit
+        return m
+
+    def _permutation(self, sort_key: str) -> Optional[np.ndarray]:
+        """ลำดับทั้งตารางตาม sort_key (argsort ครั้งเดียวต่อ key; stable เหมือน sorted() เดิม)"""
+        perm = self._perms.get(sort_key)
+        if perm is None and sort_key in SORT_OPTIONS:
+            i = SORT_OPTIONS.index(sort_key)
+            key = self.created_at.view(np.int64) if i < 2 else self.rating
+            if i in (0, 2):  # ใหม่→เก่า / สูง→ต่ำ: ~key แทน reverse เพื่อคงลำดับเดิมของค่าที่เท่ากัน
+                key = ~key
+            perm = self._perms[sort_key] = np.argsort(key, kind="stable")
+        return perm
+
+    def select(self, m: np.ndarray, sort_key: str) -> np.ndarray:
+        """index ของแถวที่ผ่าน mask เรียงตาม sort_key — กรองลำดับที่เรียงไว้แล้ว ไม่ต้อง sort ใหม่ทุก rerun"""
+        perm = self._permutation(sort_key)
+        return np.flatnonzero(m) if perm is None else perm[m[perm]]
+
+    def take(self, idx: np.ndarray) -> List[Dict]:
+        return self.rows[idx].tolist()
+
+    def group_by_course(self, idx: np.ndarray) -> List[Tuple[AggKey, np.ndarray]]:
+        """แบ่ง idx ตาม (course_type, faculty, course_code) โดยคงลำดับเดิมภายในกลุ่ม"""
+        if not len(idx):
+            return []
+        n_fac, n_course = len(self.fac_labels), len(self.course_labels)
+        key = (self.type_codes[idx].astype(np.int64) * n_fac + self.fac_codes[idx]) * n_course + self.course_codes[idx]
+        order = np.argsort(key, kind="stable")
+        parts = np.split(idx[order], np.flatnonzero(np.diff(key[order])) + 1)
+        return [((self.type_labels[self.type_codes[p[0]]], self.fac_labels[self.fac_codes[p[0]]],
+                  self.course_labels[self.course_codes[p[0]]]), p) for p in parts]
+
+    # ---------- ตัวเลือก dropdown (จำไว้ต่อ table = ต่อรุ่นข้อมูล) ----------
+
+    def _memo(self, key: Tuple, build):
+        if key not in self._options:
+            self._options[key] = build()
+        return self._options[key]
+
+    def type_options(self, approved_only: bool = False) -> List[str]:
+        """['ทั้งหมด', ประเภทที่มีอยู่จริง...]"""
+        def build():
+            codes = np.unique(self.type_codes[self.mask(approved_only=approved_only)])
+            return ["ทั้งหมด"] + [self.type_labels[c] for c in codes if self.type_labels[c]]
+        return list(self._memo(("type", approved_only), build))
+
+    def faculty_map(self, approved_only: bool = False, sel_type: Optional[str] = None) -> Dict[str, str]:
+        """code → ชื่อคณะ (ชื่อจากแถวแรกที่พบของคณะนั้น)"""
+        def build():
+            idx = np.flatnonzero(self.mask(sel_type, approved_only=approved_only))
+            codes, first = np.unique(self.fac_codes[idx], return_index=True)
+            out = {}
+            for c, i in sorted(zip(codes, first), key=lambda t: t[1]):
+                code = self.fac_labels[c]
+                if code:
+                    out[code] = self.rows[idx[i]].get("faculty_name") or code
+            return out
+        return dict(self._memo(("fac", approved_only, sel_type), build))
+
+    def course_options(self, approved_only: bool = False, sel_type: Optional[str] = None,
+                       sel_fac: Optional[str] = None) -> List[str]:
+        """['ทั้งหมด', 'CODE NAME', ...]"""
+        def build():
+            m = self.mask(sel_type, sel_fac, approved_only=approved_only)
+            pairs = np.unique(self.course_codes[m].astype(np.int64) * len(self.name_labels) + self.name_codes[m])
+            names = {f"{self.course_labels[p // len(self.name_labels)]} {self.name_labels[p % len(self.name_labels)]}".strip()
+                     for p in pairs.tolist() if self.course_labels[p // len(self.name_labels)]}
+            return ["ทั้งหมด"] + sorted(names)
+        return list(self._memo(("course", approved_only, sel_type, sel_fac), build))
+
+    def course_aggregates(self, m: Optional[np.ndarray] = None) -> Dict[AggKey, Dict]:
+        """(course_type, faculty, course_code) → count, sum, hist[1..5] ของแถวที่ผ่าน mask"""
+        idx = np.flatnonzero(m) if m is not None else np.arange(len(self.rows))
+        if not len(idx):
+            return {}
+        n_fac, n_course = len(self.fac_labels), len(self.course_labels)
+        key = (self.type_codes[idx].astype(np.int64) * n_fac + self.fac_codes[idx]) * n_course + self.course_codes[idx]
+        groups, first, inv = np.unique(key, return_index=True, return_inverse=True)
+        ratings = self.rating[idx].astype(np.int64)
+        counts = np.bincount(inv, minlength=len(groups))
+        sums = np.bincount(inv, weights=ratings, minlength=len(groups))
+        valid = (ratings >= 1) & (ratings <= 5)
+        hist = np.bincount(inv[valid] * 5 + ratings[valid] - 1, minlength=len(groups) * 5).reshape(-1, 5)
+        out = {}
+        for g, i in enumerate(first):
+            row = idx[i]
+            out[(self.type_labels[self.type_codes[row]], self.fac_labels[self.fac_codes[row]],
+                 self.course_labels[self.course_codes[row]])] = {
+                "count": int(counts[g]), "sum": float(sums[g]), "hist": [int(x) for x in hist[g]],
+                "faculty_name": self.rows[row].get("faculty_name") or "-",
+                "course_name": self.rows[row].get("course_name") or "-",
+            }
+        return out
+
+
+class ReviewSelection:
+    """ผลกรอง/เรียงบน ReviewTable — เก็บแค่ index; แปลงเป็น dict เฉพาะแถวที่จะแสดงจริง"""
+
+    __slots__ = ("table", "idx")
+
+    def __init__(self, table: ReviewTable, idx: np.ndarray):
+        self.table = table
+        self.idx = idx
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+    def ids(self) -> List[str]:
+        return self.table.ids[self.idx].tolist()
+
+    def rows(self, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        return self.table.take(self.idx[start:stop])
+
+    def iter_rows(self, chunk: int = 5000) -> Iterator[Dict]:
+        for start in range(0, len(self.idx), chunk):
+            yield from self.rows(start, start + chunk)
+
+    def groups(self) -> List[Tuple[AggKey, "ReviewSelection"]]:
+        return [(k, ReviewSelection(self.table, p)) for k, p in self.table.group_by_course(self.idx)]
+
+
+def _as_rating(v) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+@st.cache_resource
+def _review_tables() -> Dict[str, ReviewTable]:
+    return {}
+
+
+def get_review_table(bucket: str) -> ReviewTable:
+    """ReviewTable ของ bucket จาก snapshot ล่าสุด — สร้างใหม่เฉพาะเมื่อข้อมูลเปลี่ยนรุ่น"""
+    tables = _review_tables()
+    data, gen = load_data_versioned()
+    rows = data.get(bucket, [])
+    t = tables.get(bucket)
+    if t is None or t.generation != gen or t.source is not rows:
+        with timed("review_table.build"):
+            t = tables[bucket] = ReviewTable(rows, gen)
+    return t
+
+
+@instrumented()
+def query_reviews(bucket: str, sel_type: Optional[str], sel_fac: Optional[str], course_label: str,
+                  q: str, min_rating: int, sort_key: str, approved_only: bool = False) -> ReviewSelection:
+    """กรอง (ประเภท/คณะ/วิชา/คำค้น/คะแนน) + เรียงบน ReviewTable (ใช้กับ bucket เต็มจาก load_data)"""
+    table = get_review_table(bucket)
+    code = course_label.split(" ")[0] if course_label and course_label != "ทั้งหมด" else None
+    ids = get_review_search_index(bucket).match_ids(q) if q and q.strip() else None
+    m = table.mask(sel_type, sel_fac, code, min_rating, ids=ids, approved_only=approved_only)
+    return ReviewSelection(table, table.select(m, sort_key))
+
+
+# -----------------------------
+# Per-course rating aggregates (incremental)
+# -----------------------------
+class CourseAggregates:
+    """
+    count / sum / histogram 5 ดาว ต่อรายวิชา ของรีวิวที่อนุมัติแล้ว (อยู่ข้าม rerun/session)
+    - move_reviews ปรับแบบ delta: เข้า approved = บวก, ออกจาก approved (ปฏิเสธภายหลัง/ลบ) = ลบ
+    - รุ่นข้อมูลไม่ต่อเนื่อง (save_data ทั้งก้อน, มีคนเขียนจากที่อื่น) → rebuild จาก ReviewTable
+    - verify() นับใหม่ทั้งหมดแล้วคืน key ที่เพี้ยน (ใช้คู่กับ rebuild เมื่อสงสัยว่า drift)
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rows: Dict[AggKey, Dict] = {}
+        self.generation = -1
+        self.rebuilds = 0
+
+    @staticmethod
+    def key_of(r: Dict) -> AggKey:
+        return (r.get("course_type") or "", r.get("faculty") or "", str(r.get("course_code") or ""))
+
+    def _bump(self, r: Dict, sign: int) -> None:
+        if r.get("status") != "approved":
+            return
+        k = self.key_of(r)
+        row = self._rows.get(k)
+        if row is None:
+            if sign < 0:
+                return
+            row = self._rows[k] = {"count": 0, "sum": 0.0, "hist": [0] * 5,
+                                   "faculty_name": r.get("faculty_name") or "-",
+                                   "course_name": r.get("course_name") or "-"}
+        rating = _as_rating(r.get("rating"))
+        row["count"] += sign
+        row["sum"] += sign * rating
+        if 1 <= rating <= 5:
+            row["hist"][rating - 1] += sign
+        if row["count"] <= 0:
+            del self._rows[k]
+
+    def apply(self, added: List[Dict], removed: List[Dict], gen_before: int, gen_after: int) -> bool:
+        """ปรับ delta ของการเขียนที่พา data จาก gen_before → gen_after; รุ่นไม่ตรง = ไม่ทำ (รอ rebuild)"""
+        with self._lock:
+            if self.generation != gen_before:
+                return False
+            for r in removed:
+                self._bump(r, -1)
+            for r in added:
+                self._bump(r, +1)
+            self.generation = gen_after
+            return True
+
+    def rebuild(self, table: ReviewTable, generation: int) -> None:
+        fresh = table.course_aggregates(table.approved)
+        with self._lock:
+            self._rows = fresh
+            self.generation = generation
+            self.rebuilds += 1
+
+    def verify(self, table: ReviewTable) -> List[AggKey]:
+        fresh = table.course_aggregates(table.approved)
+        with self._lock:
+            keys = set(fresh) | set(self._rows)
+            return sorted(k for k in keys
+                          if (fresh.get(k) or {}).get("hist") != (self._rows.get(k) or {}).get("hist")
+                          or (fresh.get(k) or {}).get("sum") != (self._rows.get(k) or {}).get("sum"))
+
+    def snapshot(self) -> Dict[AggKey, Dict]:
+        with self._lock:
+            return {k: dict(v, hist=list(v["hist"])) for k, v in self._rows.items()}
+
+
+@st.cache_resource
+def get_course_aggregates() -> CourseAggregates:
+    return CourseAggregates()
+
+
+def course_aggregates() -> CourseAggregates:
+    """aggregates ที่ตรงกับรุ่นข้อมูลปัจจุบัน (ปกติได้จาก delta; rebuild เฉพาะตอนรุ่นกระโดด)"""
+    agg = get_course_aggregates()
+    _, gen = load_data_versioned()
+    if agg.generation != gen:
+        table = get_review_table("approved_reviews")
+        agg.rebuild(table, table.generation)
+    return agg
+
+
+# -----------------------------
+# -----------------------------
+# Admin helpers (filters + grouping)  [REPLACED]
+# -----------------------------
 
 def bulk_bar(filtered_ids: List[str], data: Dict):
     pending = data["pending_reviews"]
@@ -1489,109 +4054,123 @@ def bulk_bar(filtered_ids: List[str], data: Dict):
             st.rerun()
     with c3:
         if st.button("✅ อนุมัติที่เลือก") and selected_ids:
-            move, keep = [], []
-            ids = set(selected_ids)
-            for r in pending: (move if r["id"] in ids else keep).append(r)
-            for r in move: r["status"] = "approved"
-            data["approved_reviews"].extend(move)
-            data["pending_reviews"] = keep
-            save_data(data)
-            st.success(f"อนุมัติ {len(move)} รายการ")
+            ids = [r["id"] for r in pending if r["id"] in selected_ids]
+            move_reviews(ids, "pending_reviews", "approved_reviews", status="approved")
+            st.success(f"อนุมัติ {len(ids)} รายการ")
             st.session_state["selected_ids"] = set()
             st.rerun()
     with c4:
         if st.button("🗑️ ปฏิเสธที่เลือก") and selected_ids:
-            keep = [r for r in pending if r["id"] not in selected_ids]
-            removed = len(pending) - len(keep)
-            data["pending_reviews"] = keep
-            save_data(data)
-            st.warning(f"ปฏิเสธ {removed} รายการ")
+            ids = [r["id"] for r in pending if r["id"] in selected_ids]
+            move_reviews(ids, "pending_reviews", None)
+            st.warning(f"ปฏิเสธ {len(ids)} รายการ")
             st.session_state["selected_ids"] = set()
             st.rerun()
 
-def render_grouped(items: List[Dict], data: Optional[Dict] = None, pending_mode: bool = False):
-    """จัดกลุ่มเป็น ประเภท → คณะ → รายวิชา"""
-    if not items:
+@instrumented()
+def render_grouped(sel: ReviewSelection, data: Optional[Dict] = None, pending_mode: bool = False,
+                   key_prefix: str = "grp"):
+    """
+    จัดกลุ่มเป็น ประเภท → คณะ → รายวิชา
+    - จำนวนต่อกลุ่มมาจาก index (ไม่แปลงทุกแถวเป็น dict)
+    - กลุ่มรายวิชาปิดไว้ก่อน; เปิดแล้วค่อยเรนเดอร์ทีละหน้า (ก่อนหน้า/ถัดไป ภายในกลุ่ม)
+    """
+    if not len(sel):
         st.info("ไม่พบรายการตามตัวกรอง")
         return
-    selected_ids = st.session_state.setdefault("selected_ids", set())
-    groups: Dict[str, Dict[str, Dict[str, List[Dict]]]] = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    for r in items:
-        ctype = COURSE_TYPES.get(r.get("course_type",""), r.get("course_type","?"))
-        fac = f"{r.get('faculty','?')} - {r.get('faculty_name','?')}"
-        course_key = f"{r.get('course_code','')} {r.get('course_name','')}".strip()
-        groups[ctype][fac][course_key].append(r)
-
-    for ctype in sorted(groups.keys()):
-        with st.expander(f"ประเภท: {ctype}", expanded=True):
-            for fac in sorted(groups[ctype].keys()):
+    sizes = sorted({*REVIEW_PAGE_SIZES, REVIEW_PAGE_SIZE})
+    page_size = st.selectbox("รีวิวต่อหน้า", sizes, index=sizes.index(REVIEW_PAGE_SIZE), key=f"{key_prefix}_page_size")
+
+    tree: Dict[str, Dict[str, List[Tuple[str, AggKey, ReviewSelection]]]] = defaultdict(lambda: defaultdict(list))
+    for key, g in sel.groups():
+        first = g.rows(0, 1)[0]
+        ctype = COURSE_TYPES.get(key[0], key[0] or "?")
+        fac = f"{key[1] or '?'} - {first.get('faculty_name', '?')}"
+        course_key = f"{key[2]} {first.get('course_name', '')}".strip()
+        tree[ctype][fac].append((course_key, key, g))
+
+    for ctype in sorted(tree.keys()):
+        with st.expander(f"ประเภท: {ctype} ({sum(len(g) for f in tree[ctype].values() for _, _, g in f)})",
+                         expanded=True):
+            for fac in sorted(tree[ctype].keys()):
                 st.markdown(f"### คณะ: {fac}")
-                for course_key in sorted(groups[ctype][fac].keys()):
-                    st.markdown(f"**รายวิชา: {course_key}**")
-                    for r in groups[ctype][fac][course_key]:
-                        with st.container(border=True):
-                            left, right = st.columns([3, 1])
-                            with left:
-                                author = review_author(r)
-                                st.markdown(
-                                    f"**{r.get('course_code', '')} {r.get('course_name', '')}**  \n"
-                                    f"ให้คะแนน: {star_str(int(r.get('rating', 0)))}  \n"
-                                    f"โดย `{author}` • วันที่ {r.get('created_at', '')}"
-                                )
-                                if txt := r.get("text"):
-                                    st.markdown("—")
-                                    st.write(txt)
-
-                            with right:
-                                if pending_mode and data is not None:
-                                    checked = r["id"] in selected_ids
-                                    ck = st.checkbox("เลือก", key=f"sel_{r['id']}", value=checked)
-                                    if ck and r["id"] not in selected_ids: selected_ids.add(r["id"])
-                                    if not ck and r["id"] in selected_ids: selected_ids.remove(r["id"])
-                                    a1, a2 = st.columns(2)
-                                    with a1:
-                                        if st.button("อนุมัติ", key=f"ap_{r['id']}"):
-                                            r["status"] = "approved"
-                                            data["approved_reviews"].append(r)
-                                            data["pending_reviews"].remove(r)
-                                            save_data(data)
-                                            st.success("อนุมัติแล้ว"); st.rerun()
-                                    with a2:
-                                        if st.button("ปฏิเสธ", key=f"re_{r['id']}"):
-                                            data["pending_reviews"].remove(r)
-                                            save_data(data)
-                                            st.warning("ปฏิเสธแล้ว"); st.rerun()
+                for course_key, key, g in sorted(tree[ctype][fac], key=lambda t: t[0]):
+                    gid = f"{key_prefix}_{'|'.join(key)}"
+                    # label ต้องคงที่ (ถ้าใส่จำนวนไว้ใน label วิดเจ็ตจะถูกสร้างใหม่ทุกครั้งที่จำนวนเปลี่ยน)
+                    opened = st.toggle(f"รายวิชา: {course_key}", key=f"{gid}_open")
+                    st.caption(f"{len(g)} รีวิว")
+                    if not opened:
+                        continue
+                    _render_group_page(g, gid, page_size, data, pending_mode)
+
+
+def _render_group_page(g: ReviewSelection, gid: str, page_size: int, data: Optional[Dict], pending_mode: bool):
+    """เรนเดอร์หน้าปัจจุบันของกลุ่ม (cursor เก็บใน session_state ต่อกลุ่ม)"""
+    n = len(g)
+    pages = max(1, -(-n // page_size))
+    cur = min(st.session_state.get(f"{gid}_page", 0), pages - 1)
+    start = cur * page_size
+    for r in g.rows(start, start + page_size):
+        _render_review_card(r, data, pending_mode)
+    if pages > 1:
+        prev_col, info_col, next_col = st.columns([1, 2, 1])
+        with prev_col:
+            if st.button("◀ ก่อนหน้า", key=f"{gid}_prev", disabled=cur == 0):
+                st.session_state[f"{gid}_page"] = cur - 1
+                st.rerun()
+        with info_col:
+            st.caption(f"แสดง {start + 1}–{min(start + page_size, n)} จาก {n} • หน้า {cur + 1}/{pages}")
+        with next_col:
+            if st.button("ถัดไป ▶", key=f"{gid}_next", disabled=cur >= pages - 1):
+                st.session_state[f"{gid}_page"] = cur + 1
+                st.rerun()
+
+
+def _render_review_card(r: Dict, data: Optional[Dict], pending_mode: bool):
+    selected_ids = st.session_state.setdefault("selected_ids", set())
+    with st.container(border=True):
+        left, right = st.columns([3, 1])
+        with left:
+            author = review_author(r)
+            st.markdown(
+                f"**{r.get('course_code', '')} {r.get('course_name', '')}**  \n"
+                f"ให้คะแนน: {star_str(int(r.get('rating', 0)))}  \n"
+                f"โดย `{author}` • วันที่ {r.get('created_at', '')}"
+            )
+            if txt := r.get("text"):
+                st.markdown("—")
+                st.write(txt)
+
+        with right:
+            if pending_mode and data is not None:
+                checked = r["id"] in selected_ids
+                ck = st.checkbox("เลือก", key=f"sel_{r['id']}", value=checked)
+                if ck and r["id"] not in selected_ids: selected_ids.add(r["id"])
+                if not ck and r["id"] in selected_ids: selected_ids.remove(r["id"])
+                a1, a2 = st.columns(2)
+                with a1:
+                    if st.button("อนุมัติ", key=f"ap_{r['id']}"):
+                        move_reviews([r["id"]], "pending_reviews", "approved_reviews",
+                                     status="approved")
+                        st.success("อนุมัติแล้ว"); st.rerun()
+                with a2:
+                    if st.button("ปฏิเสธ", key=f"re_{r['id']}"):
+                        move_reviews([r["id"]], "pending_reviews", None)
+                        st.warning("ปฏิเสธแล้ว"); st.rerun()
 
 
 # -----------------------------
 # Summary table (Admin)  [REPLACED]
 # -----------------------------
-def build_summary_rows(approved: List[Dict]) -> List[Dict]:
-    """สรุปเป็นต่อรายวิชา: (ประเภท, คณะ, รหัส/ชื่อรายวิชา) → avg, count"""
-    agg: Dict[Tuple[str, str, str, str, str], Dict[str, float]] = {}
-    # key: (course_type, faculty_code, faculty_name, course_code, course_name)
-    for r in approved:
-        if r.get("status") != "approved":
-            continue
-        key = (
-            r.get("course_type",""),
-            r.get("faculty","-"),
-            r.get("faculty_name","-"),
-            r.get("course_code",""),
-            r.get("course_name","-"),
-        )
-        obj = agg.setdefault(key, {"sum": 0.0, "count": 0.0})
-        obj["sum"] += float(r.get("rating", 0))
-        obj["count"] += 1
-
+def summary_rows_from_aggregates(agg: Dict[Tuple[str, str, str], Dict]) -> List[Dict]:
     rows: List[Dict] = []
-    for (ctype, fac_code, fac_name, ccode, cname), v in agg.items():
+    for (ctype, fac_code, ccode), v in agg.items():
         avg = v["sum"] / v["count"] if v["count"] else 0.0
         rows.append({
             "ประเภท": COURSE_TYPES.get(ctype, ctype),
-            "คณะ": f"{fac_code} - {fac_name}",
+            "คณะ": f"{fac_code or '-'} - {v['faculty_name']}",
             "รหัสวิชา": ccode,
-            "รายวิชา": cname,
+            "รายวิชา": v["course_name"],
             "ค่าเฉลี่ย": round(avg, 2),
             "ดาว": star_str(int(round(avg))),
             "จำนวนรีวิว": int(v["count"]),
@@ -1600,10 +4179,12 @@ def build_summary_rows(approved: List[Dict]) -> List[Dict]:
     rows.sort(key=lambda r: (r["ประเภท"], r["คณะ"], r["รหัสวิชา"]))
     return rows
 
+@instrumented()
 def summary_table_panel(data: Dict):
     st.subheader("📊 สรุปภาพรวม (ตาราง)")
-    approved = [r for r in data.get("approved_reviews", []) if r.get("status") == "approved"]
-    all_rows = build_summary_rows(approved)
+    agg = course_aggregates()
+    snap = agg.snapshot()
+    all_rows = summary_rows_from_aggregates(snap)
 
     if not all_rows:
         st.info("ยังไม่มีข้อมูลสรุป"); return
@@ -1622,10 +4203,12 @@ def summary_table_panel(data: Dict):
                                            (ffac == "ทั้งหมด" or r["คณะ"] == ffac)})
         fc = st.selectbox("รายวิชา", courses, index=0, key="sum_course2")
 
-    rows = [r for r in all_rows
-            if (ftype == "ทั้งหมด" or r["ประเภท"] == ftype)
-            and (ffac == "ทั้งหมด" or r["คณะ"] == ffac)
-            and (fc == "ทั้งหมด" or r["รหัสวิชา"] == fc)]
+    def keep(type_label: str, fac_label: str, ccode: str) -> bool:
+        return ((ftype == "ทั้งหมด" or type_label == ftype)
+                and (ffac == "ทั้งหมด" or fac_label == ffac)
+                and (fc == "ทั้งหมด" or ccode == fc))
+
+    rows = [r for r in all_rows if keep(r["ประเภท"], r["คณะ"], r["รหัสวิชา"])]
 
     st.dataframe(
         pd.DataFrame(rows),
@@ -1638,17 +4221,260 @@ def summary_table_panel(data: Dict):
         },
     )
 
+    # ฮิสโตแกรมดาวของรายวิชาที่เลือก ใช้ตัวกรองเดียวกับตาราง (อ่านจาก aggregates ไม่ต้องสแกนรีวิว)
+    if fc != "ทั้งหมด":
+        hist = [0] * 5
+        for k, v in snap.items():
+            if keep(COURSE_TYPES.get(k[0], k[0]), f"{k[1] or '-'} - {v['faculty_name']}", k[2]):
+                hist = [a + b for a, b in zip(hist, v["hist"])]
+        st.markdown(f"#### สรุปคะแนนรีวิว — {fc}")
+        st.bar_chart(pd.DataFrame({"ดาว": [5, 4, 3, 2, 1], "จำนวน": hist[::-1]}).set_index("ดาว"),
+                     use_container_width=True)
+
+    # เช็ก drift ของตารางสรุปเทียบกับการนับใหม่ทั้งหมด แล้วสร้างใหม่
+    if st.button("🔁 ตรวจสอบ/สร้างสรุปใหม่", key="sum_rebuild"):
+        table = get_review_table("approved_reviews")
+        drift = agg.verify(table)
+        agg.rebuild(table, table.generation)
+        if drift:
+            st.warning(f"พบค่าสรุปไม่ตรง {len(drift)} รายวิชา — สร้างใหม่แล้ว")
+        else:
+            st.success("ค่าสรุปตรงกับข้อมูลรีวิวทั้งหมด")
+
+
+
+# -----------------------------
+# Exports (streaming, cached per data version)
+# -----------------------------
+try:  # Parquet ต้องมี pyarrow (ไม่บังคับ)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except Exception:
+    PARQUET_AVAILABLE = False
+
+EXPORT_DIR = st.secrets.get("EXPORT_DIR", os.path.join("data", "exports"))
+EXPORT_KEEP = 8            # จำนวนไฟล์ export ล่าสุดที่เก็บไว้บนดิสก์
+EXPORT_CHUNK_ROWS = 2000   # เขียนทีละก้อน ไม่ประกอบทั้งไฟล์เป็นสตริงเดียว
+EXPORT_FIELDS = [
+    "id", "course_type",
+    "faculty", "faculty_name",
+    "department", "department_name", "year",   # ยัง export ไว้เผื่อข้อมูลเก่า
+    "course_code", "course_name",
+    "rating", "text", "author", "created_at", "status",
+]
+# format → (นามสกุลไฟล์, mime)
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+    "jsonl.gz": (".jsonl.gz", "application/gzip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "json": (".json", "application/json"),
+    "json.gz": (".json.gz", "application/gzip"),
+}
+
+
+def iter_csv(rows: Iterable[Dict], fields: List[str] = EXPORT_FIELDS) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, r in enumerate(rows, 1):
+        writer.writerow([r.get(k, "") for k in fields])
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def iter_jsonl(rows: Iterable[Dict]) -> Iterator[str]:
+    chunk: List[str] = []
+    for r in rows:
+        chunk.append(json.dumps(r, ensure_ascii=False) + "\n")
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
+
+
+def iter_json_document(data: Dict) -> Iterator[str]:
+    """JSON ของทั้งฐานข้อมูล (รูปเดียวกับ data.json) แบบทีละรายการ"""
+    yield "{"
+    for n, (key, value) in enumerate(data.items()):
+        yield ("," if n else "") + f"\n  {json.dumps(key)}: "
+        if not isinstance(value, list):
+            yield json.dumps(value, ensure_ascii=False)
+            continue
+        yield "["
+        for i, r in enumerate(value):
+            yield ("," if i else "") + "\n    " + json.dumps(r, ensure_ascii=False)
+        yield "\n  ]" if value else "]"
+    yield "\n}\n"
+
+
+def _write_parquet(path: str, rows: Iterable[Dict]) -> None:
+    schema = pa.schema([(k, pa.int64() if k == "rating" else pa.string()) for k in EXPORT_FIELDS])
+    with pq.ParquetWriter(path, schema) as writer:
+        batch: List[Dict] = []
+        for r in itertools.chain(rows, [None]):
+            if r is not None:
+                batch.append(r)
+                if len(batch) < EXPORT_CHUNK_ROWS:
+                    continue
+            if batch:
+                cols = {k: [_as_rating(x.get(k)) if k == "rating" else str(x.get(k) or "") for x in batch]
+                        for k in EXPORT_FIELDS}
+                writer.write_table(pa.table(cols, schema=schema))
+                batch = []
+
+
+class ExportManager:
+    """
+    สร้างไฟล์ export บนดิสก์ใน thread แยก (ไม่บล็อก rerun ของ UI)
+    - key = (รุ่นข้อมูล, ชุดข้อมูล, ตัวกรอง, format) → งานเดียวกันสร้างครั้งเดียว ใช้ซ้ำได้ทุก session
+    - เขียนไฟล์ชั่วคราวแล้ว os.replace; เก็บไว้แค่ EXPORT_KEEP ไฟล์ล่าสุด
+    - progress ถูกเขียนจาก thread งานและอ่านจาก thread UI → ผ่าน _lock เสมอ (progress_of)
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._jobs: Dict[Tuple, Future] = {}
+        self.progress: Dict[Tuple, int] = {}
+
+    def path_for(self, key: Tuple, fmt: str) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, f"{key[1]}-{digest}{EXPORT_FORMATS[fmt][0]}")
+
+    def submit(self, key: Tuple, fmt: str, make_source: Callable[[], object]) -> Future:
+        """
+        make_source() = iterable ของรีวิว (หรือ dict ทั้งฐานข้อมูลสำหรับ json)
+        เรียกใน thread งานเท่านั้น — rerun ที่ไม่ได้กดสร้างไฟล์จึงไม่ต้องเตรียม generator
+        """
+        with self._lock:
+            fut = self._jobs.get(key)
+            if fut is not None and not (fut.done() and fut.exception() is not None):
+                return fut
+            fut = self._jobs[key] = self._pool.submit(self._build, key, fmt, make_source)
+            for old in list(self._jobs)[:-EXPORT_KEEP]:
+                if self._jobs[old].done():
+                    done = self._jobs.pop(old)
+                    self.progress.pop(old, None)
+                    if done.exception() is None:
+                        try:
+                            os.remove(done.result())
+                        except OSError:
+                            pass
+            return fut
+
+    def get(self, key: Tuple) -> Optional[Future]:
+        with self._lock:
+            return self._jobs.get(key)
+
+    def progress_of(self, key: Tuple) -> int:
+        with self._lock:
+            return self.progress.get(key, 0)
+
+    def _counted(self, key: Tuple, rows: Iterable[Dict]) -> Iterator[Dict]:
+        for i, r in enumerate(rows, 1):
+            if i % EXPORT_CHUNK_ROWS == 0:
+                with self._lock:
+                    self.progress[key] = i
+            yield r
+
+    def _build(self, key: Tuple, fmt: str, make_source: Callable[[], object]) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(key, fmt)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            source = make_source()
+            if fmt == "parquet":
+                _write_parquet(tmp, self._counted(key, source))
+            else:
+                if fmt in ("json", "json.gz"):
+                    chunks = iter_json_document(source)
+                elif fmt.startswith("jsonl"):
+                    chunks = iter_jsonl(self._counted(key, source))
+                else:
+                    chunks = iter_csv(self._counted(key, source))
+                opener = gzip.open if fmt.endswith(".gz") else open
+                with opener(tmp, "wt", encoding="utf-8", newline="") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            os.replace(tmp, path)
+            return path
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+@st.cache_resource
+def get_export_manager() -> ExportManager:
+    return ExportManager(EXPORT_DIR)
+
+
+@instrumented()
+def export_panel(data: Dict, filtered: Optional[ReviewSelection] = None, filters: Tuple = ()):
+    """ดาวน์โหลด: Approved ทั้งหมด / ตามตัวกรองของแท็บอนุมัติแล้ว / ทั้งฐานข้อมูล"""
+    st.subheader("⬇️ ดาวน์โหลดข้อมูล")
+    sources = ["approved", "approved_filtered", "database"]
+    labels = {"approved": "Approved ทั้งหมด", "approved_filtered": "Approved ตามตัวกรองปัจจุบัน",
+              "database": "ฐานข้อมูลทั้งหมด"}
+    c1, c2, c3 = st.columns([2, 1, 1])
+    with c1:
+        what = st.selectbox("ชุดข้อมูล", sources, format_func=labels.get, key="exp_source")
+    with c2:
+        if what == "database":
+            fmts = ["json", "json.gz"]
+        else:
+            fmts = ["csv", "csv.gz", "jsonl", "jsonl.gz"] + (["parquet"] if PARQUET_AVAILABLE else [])
+        fmt = st.selectbox("รูปแบบ", fmts, key=f"exp_fmt_{what == 'database'}")
+
+    # ส่ง factory ไม่ใช่ generator: สร้าง iterator เฉพาะตอนงานรันจริงใน thread export
+    if what == "database":
+        key, make_source = (data_generation(), "data", (), fmt), lambda: data
+    elif what == "approved_filtered" and filtered is not None:
+        key, make_source = (data_generation(), "approved_reviews_filtered", filters, fmt), filtered.iter_rows
+    else:
+        table = get_review_table("approved_reviews")
+        key = (table.generation, "approved_reviews", (), fmt)
+        make_source = lambda: ReviewSelection(table, np.flatnonzero(table.approved)).iter_rows()
+
+    mgr = get_export_manager()
+    with c3:
+        st.write("")
+        if st.button("เตรียมไฟล์", key="exp_build"):
+            mgr.submit(key, fmt, make_source)
+    fut = mgr.get(key)
+    if fut is None:
+        return
+    if not fut.done():
+        st.info(f"กำลังสร้างไฟล์… ({mgr.progress_of(key):,} แถว) กดรีเฟรชเพื่อตรวจสถานะ")
+        st.button("รีเฟรช", key="exp_refresh")
+    elif fut.exception() is not None:
+        st.error(f"สร้างไฟล์ไม่สำเร็จ: {fut.exception()}")
+    else:
+        path = fut.result()
+        name = ("data" if key[1] == "data" else key[1]) + EXPORT_FORMATS[fmt][0]
+        with open(path, "rb") as f:
+            st.download_button(f"Download {name}", f, name, EXPORT_FORMATS[fmt][1],
+                               key="exp_download", on_click="ignore")
 
 
 # -----------------------------
 # Admin page
 # -----------------------------
 
+@instrumented()
 def page_admin(data: Dict):
     st.markdown("### หลังบ้าน (Admin)")
-    pending = data.get("pending_reviews", [])
-    approved = [r for r in data.get("approved_reviews", []) if r.get("status") == "approved"]
-
+    p_table = get_review_table("pending_reviews")
+    a_table = get_review_table("approved_reviews")
     t_pend, t_appr, t_sum = st.tabs(["🕒 คิวรออนุมัติ", "✅ รีวิวที่อนุมัติแล้ว", "📊 สรุปตาราง"])
 
     with t_pend:
@@ -1657,124 +4483,72 @@ def page_admin(data: Dict):
         col1, col2, col3, col4 = st.columns([1,1,1,1.2])
 
         with col1:
-            t_opts = admin_type_options(pending)
+            t_opts = p_table.type_options()
             p_type = st.selectbox("ประเภท", t_opts, index=0, key="adm_p_type",
                                   format_func=lambda v: "ทั้งหมด" if v=="ทั้งหมด" else COURSE_TYPES.get(v, v))
             sel_type = None if p_type == "ทั้งหมด" else p_type
 
         with col2:
-            fac_map = admin_faculty_map(pending, sel_type)
+            fac_map = p_table.faculty_map(False, sel_type)
             f_opts = ["ทั้งหมด"] + list(sorted(fac_map.keys()))
             p_fac = st.selectbox("คณะ", f_opts, index=0, key="adm_p_fac2",
                                  format_func=lambda code: "ทั้งหมด" if code=="ทั้งหมด" else f"{code} - {fac_map.get(code, code)}")
             sel_fac = None if p_fac == "ทั้งหมด" else p_fac
 
         with col3:
-            c_opts = admin_course_options(pending, sel_type, sel_fac)
+            c_opts = p_table.course_options(False, sel_type, sel_fac)
             p_course = st.selectbox("รายวิชา", c_opts, index=0, key="adm_p_course2")
 
         with col4:
-            p_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", key="adm_p_q2")
+            p_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", help=SEARCH_HELP, key="adm_p_q2")
 
         p_minr = st.slider("คะแนนขั้นต่ำ", 1, 5, 1, step=1, key="adm_p_minr2")
-        sort1 = st.selectbox("จัดเรียงโดย",
-                             ["วันที่ (ใหม่→เก่า)", "วันที่ (เก่า→ใหม่)", "คะแนน (สูง→ต่ำ)", "คะแนน (ต่ำ→สูง)"],
-                             index=0, key="adm_p_sort2")
+        sort1 = st.selectbox("จัดเรียงโดย", SORT_OPTIONS, index=0, key="adm_p_sort2")
 
-        pf = admin_apply_filters(pending, sel_type, sel_fac, p_course, p_q, p_minr)
-        pf = admin_sort_items(pf, sort1)
-        ids = [r["id"] for r in pf]
-        bulk_bar(ids, data)
-        render_grouped(pf, data=data, pending_mode=True)
+        pf = query_reviews("pending_reviews", sel_type, sel_fac, p_course, p_q, p_minr, sort1)
+        bulk_bar(pf.ids(), data)
+        render_grouped(pf, data=data, pending_mode=True, key_prefix="adm_p")
 
     with t_appr:
         st.subheader("กรองรีวิวที่อนุมัติแล้ว")
         col1, col2, col3, col4 = st.columns([1,1,1,1.2])
 
         with col1:
-            t_opts = admin_type_options(approved)
+            t_opts = a_table.type_options(approved_only=True)
             a_type = st.selectbox("ประเภท", t_opts, index=0, key="adm_a_type",
                                   format_func=lambda v: "ทั้งหมด" if v=="ทั้งหมด" else COURSE_TYPES.get(v, v))
             sel_type2 = None if a_type == "ทั้งหมด" else a_type
 
         with col2:
-            fac_map2 = admin_faculty_map(approved, sel_type2)
+            fac_map2 = a_table.faculty_map(True, sel_type2)
             f_opts2 = ["ทั้งหมด"] + list(sorted(fac_map2.keys()))
             a_fac = st.selectbox("คณะ", f_opts2, index=0, key="adm_a_fac2",
                                  format_func=lambda code: "ทั้งหมด" if code=="ทั้งหมด" else f"{code} - {fac_map2.get(code, code)}")
             sel_fac2 = None if a_fac == "ทั้งหมด" else a_fac
 
         with col3:
-            c_opts2 = admin_course_options(approved, sel_type2, sel_fac2)
+            c_opts2 = a_table.course_options(True, sel_type2, sel_fac2)
             a_course = st.selectbox("รายวิชา", c_opts2, index=0, key="adm_a_course2")
 
         with col4:
-            a_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", key="adm_a_q2")
+            a_q = st.text_input("ค้นหาในข้อความรีวิว/ชื่อวิชา", help=SEARCH_HELP, key="adm_a_q2")
 
         a_minr = st.slider("คะแนนขั้นต่ำ", 1, 5, 1, step=1, key="adm_a_minr2")
-        sort2 = st.selectbox("จัดเรียงโดย",
-                             ["วันที่ (ใหม่→เก่า)", "วันที่ (เก่า→ใหม่)", "คะแนน (สูง→ต่ำ)", "คะแนน (ต่ำ→สูง)"],
-                             index=0, key="adm_a_sort2")
+        sort2 = st.selectbox("จัดเรียงโดย", SORT_OPTIONS, index=0, key="adm_a_sort2")
 
-        af = admin_apply_filters(approved, sel_type2, sel_fac2, a_course, a_q, a_minr)
-        af = admin_sort_items(af, sort2)
-        render_grouped(af, pending_mode=False)
+        af = query_reviews("approved_reviews", sel_type2, sel_fac2, a_course, a_q, a_minr, sort2,
+                           approved_only=True)
+        render_grouped(af, pending_mode=False, key_prefix="adm_a")
 
     with t_sum:
         summary_table_panel(data)
 
     st.divider()
-    # Exports
-    from io import StringIO
-    import csv
-    colx, coly = st.columns(2)
-    with colx:
-        if st.button("⬇️ ดาวน์โหลด Approved (CSV)"):
-            rows = approved
-            if not rows:
-                st.info("ยังไม่มีข้อมูลที่อนุมัติ")
-            else:
-                buf = StringIO()
-                writer = csv.DictWriter(
-                    buf,
-                    fieldnames=[
-                        "id", "course_type",
-                        "faculty", "faculty_name",
-                        "department", "department_name", "year",   # ยัง export ไว้เผื่อข้อมูลเก่า
-                        "course_code", "course_name",
-                        "rating", "text", "author", "created_at", "status",
-                    ],
-                )
-                writer.writeheader()
-                for r in rows:
-                    writer.writerow({k: r.get(k, "") for k in writer.fieldnames})
-                st.download_button("Download approved_reviews.csv", buf.getvalue(), "approved_reviews.csv", "text/csv")
-    with coly:
-        if st.button("⬇️ ดาวน์โหลดฐานข้อมูลทั้งหมด (JSON)"):
-            payload = json.dumps(data, ensure_ascii=False, indent=2)
-            st.download_button("Download data.json", payload, "data.json", "application/json")
-
-
-# สร้าง lookup จาก catalog: code → {credit, grading, updated_at}
-def build_course_lookup():
-    lut = {}
-    for ctype, facs in COURSE_CATALOG_BY_TYPE.items():
-        for fac, items in facs.items():
-            for c in items:
-                lut[c["code"]] = {
-                    "credit":     c.get("credit"),
-                    "grading":    c.get("grading"),
-                    "updated_at": c.get("updated_at"),
-                    "prereq":     c.get("prereq"),
-                    "desc_th":    c.get("desc_th"),
-                    "desc_en":    c.get("desc_en"),
-                    "type":       ctype,
-                    "faculty":    fac,
-                }
-    return lut
-
-
-COURSE_LUT = build_course_lookup()
+    export_panel(data, filtered=af, filters=(sel_type2, sel_fac2, a_course, a_q, a_minr, sort2))
+
+
+# lookup จาก catalog: code → รายวิชา (credit, grading, updated_at, type, faculty, ...)
+COURSE_LUT = COURSE_CATALOG.by_code
 
 # -----------------------------
 # Main
@@ -1792,65 +4566,48 @@ def header_bar():
 
 
 def send_email(to: str, subject: str, body: str) -> bool:
-    host = st.secrets.get("SMTP_HOST")
-    port = st.secrets.get("SMTP_PORT")
-    user = st.secrets.get("SMTP_USER")
-    pwd  = st.secrets.get("SMTP_PASS")
-    sender = st.secrets.get("SMTP_SENDER") or user
-    sender_name = st.secrets.get("SMTP_SENDER_NAME", "MU Course Reviews")
-    use_ssl = str(st.secrets.get("SMTP_SSL", "false")).lower() in ("1","true","yes")
+    """เข้าคิวส่งอีเมล (MailQueue) แล้วคืนทันที; False = ตั้งค่า SMTP ไม่ครบ ให้ผู้เรียกแสดงลิงก์สำรอง"""
+    cfg = smtp_settings()
 
     # ชี้ชัดว่าคีย์ไหนหาย
+    # (SMTP_USER/SMTP_PASS ไม่บังคับ — relay ภายในไม่ต้อง login; MailQueue login เฉพาะเมื่อมีครบทั้งคู่)
     missing = [k for k,v in {
-        "SMTP_HOST": host, "SMTP_PORT": port, "SMTP_USER": user,
-        "SMTP_PASS": pwd, "SMTP_SENDER": sender
+        "SMTP_HOST": cfg["host"], "SMTP_PORT": cfg["port"], "SMTP_SENDER": cfg["sender"]
     }.items() if not v]
     if missing:
         st.error("SMTP secrets ไม่ครบ: " + ", ".join(missing))
         return False
 
-    port = int(port)  # แปลงตรงนี้หลังเช็กครบ
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = f"{sender_name} <{sender}>"
-    msg["To"] = to
-    reply_to = st.secrets.get("REPLY_TO")
-    if reply_to:
-        msg["Reply-To"] = reply_to
-    msg.set_content(body)
-
+    queue = get_mail_queue()
+    if queue is None:
+        return False
     try:
-        if use_ssl:
-            with smtplib.SMTP_SSL(host, port, timeout=20) as s:
-                s.login(user, pwd)
-                s.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port, timeout=20) as s:
-                s.starttls(context=ssl.create_default_context())
-                s.login(user, pwd)
-                s.send_message(msg)
+        queue.enqueue(to, subject, body, f"{cfg['sender_name']} <{cfg['sender']}>", cfg["reply_to"])
         return True
-    except Exception as e:
-        st.error(f"SMTP error: {e}")
+    except OSError as e:
+        st.error(f"เข้าคิวอีเมลไม่สำเร็จ: {e}")
         return False
 
 
 
 
 def main():
-    # handle magic links (verify/reset) before painting header
-    handle_magic_links()
-    header_bar()
-    if "auth" not in st.session_state:
-        do_login_form();
-        return
-    sidebar_user_box()
-    data = load_data()
-    role = st.session_state["auth"]["role"]
+    with timed("rerun"):
+        # handle magic links (verify/reset) before painting header
+        handle_magic_links()
+        header_bar()
+        if "auth" not in st.session_state:
+            do_login_form();
+            return
+        sidebar_user_box()
+        data = load_data()
+        role = st.session_state["auth"]["role"]
+        if role == "admin":
+            page_admin(data)
+        else:
+            page_student(data)
     if role == "admin":
-        page_admin(data)
-    else:
-        page_student(data)
+        perf_sidebar_panel()  # วาดหลังจบ rerun เพื่อให้รวมเวลารอบนี้
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""
+คาแทล็อกรายวิชาแบบ immutable ที่ใช้ร่วมกันระหว่าง app.py และ app_2.py
+(ไม่ import streamlit — การแคชต่อเวอร์ชันอยู่ในแต่ละแอป)
+"""
+import hashlib
+import json
+import sys
+from collections import defaultdict
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+
+class CourseRecord:
+    """
+    รายวิชา 1 รายการแบบ immutable (__slots__ ไม่มี __dict__ ต่อ object)
+    อ่านแบบ dict ได้เหมือนเดิม: c["code"], c.get("credit") — ฟิลด์เก่า department/year คืนค่าว่าง
+    """
+
+    __slots__ = ("course_type", "faculty", "faculty_name", "code", "name", "desc_th", "desc_en",
+                 "credit", "grading", "prereq", "prereq_en", "updated_at")
+    _LEGACY = {"department": "", "department_name": "", "year": 0}
+    _ALIASES = {"type": "course_type"}
+
+    def __init__(self, **fields):
+        for k in self.__slots__:
+            object.__setattr__(self, k, fields.get(k))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("CourseRecord is immutable")
+
+    def __getitem__(self, key: str):
+        key = self._ALIASES.get(key, key)
+        if key in self._LEGACY:
+            return self._LEGACY[key]
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        try:
+            v = self[key]
+        except KeyError:
+            return default
+        return default if v is None else v
+
+    def __repr__(self) -> str:
+        return f"CourseRecord({self.course_type}/{self.faculty}/{self.code})"
+
+
+class CourseCatalog:
+    """
+    คาแทล็อกรายวิชาแบบ immutable สร้างครั้งเดียวต่อเวอร์ชัน (ดู get_course_catalog)
+    - เก็บเป็น tuple ของ CourseRecord, สตริงประเภท/คณะถูก intern (ใช้ object เดียวกันทั้งคาแทล็อก)
+    - index: ประเภท, คณะ (รหัส/ชื่อ), รหัสวิชา, คู่ ประเภท×คณะ → helper ทุกตัวตอบได้ใน O(1) หรือ O(k)
+    """
+
+    __slots__ = ("version", "types", "courses", "_fac_maps", "_by_type", "_by_faculty",
+                 "_by_faculty_name", "_by_pair", "by_code", "_faculty_options")
+
+    def __init__(self, version: str, types: Dict[str, str], fac_maps: Dict[str, Dict[str, str]],
+                 records: List[CourseRecord]):
+        put = lambda k, v: object.__setattr__(self, k, v)
+        put("version", version)
+        put("types", MappingProxyType(dict(types)))
+        put("_fac_maps", MappingProxyType({t: MappingProxyType(dict(m)) for t, m in fac_maps.items()}))
+
+        by_type, by_fac, by_fac_name, by_pair = defaultdict(list), defaultdict(list), defaultdict(list), defaultdict(list)
+        by_code: Dict[str, CourseRecord] = {}
+        for r in records:  # ลำดับใน index = ลำดับในคาแทล็อกต้นทาง
+            by_type[r.course_type].append(r)
+            by_fac[r.faculty].append(r)
+            by_fac_name[r.faculty_name].append(r)
+            by_pair[(r.course_type, r.faculty)].append(r)
+            by_code.setdefault(r.code, r)
+        freeze = lambda d: MappingProxyType({k: tuple(v) for k, v in d.items()})
+        put("courses", tuple(sorted(records, key=lambda r: (r.course_type, r.faculty, r.code))))
+        put("_by_type", freeze(by_type))
+        put("_by_faculty", freeze(by_fac))
+        put("_by_faculty_name", freeze(by_fac_name))
+        put("_by_pair", freeze(by_pair))
+        put("by_code", MappingProxyType(by_code))
+        put("_faculty_options", ("ทั้งหมด",) + tuple(sorted(by_fac_name)))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("CourseCatalog is immutable")
+
+    @classmethod
+    def from_nested(cls, version: str, types: Dict[str, str], faculties_by_type: Dict[str, Dict[str, str]],
+                    catalog_by_type: Dict[str, Dict[str, List[Dict]]]) -> "CourseCatalog":
+        """จากโครง ประเภท → คณะ → [รายวิชา] (COURSE_CATALOG_BY_TYPE ใน app_2.py)"""
+        records: List[CourseRecord] = []
+        for ctype, facs in catalog_by_type.items():
+            fac_map = faculties_by_type.get(ctype, {})
+            for fac_code, courses in facs.items():
+                fac_name = fac_map.get(fac_code, fac_code)
+                for c in courses:
+                    records.append(CourseRecord(
+                        course_type=sys.intern(ctype), faculty=sys.intern(fac_code),
+                        faculty_name=sys.intern(fac_name), code=c["code"], name=c["name"],
+                        desc_th=c.get("desc_th", ""), desc_en=c.get("desc_en", ""),
+                        credit=c.get("credit"), grading=c.get("grading"), prereq=c.get("prereq"),
+                        prereq_en=c.get("prereq_en"), updated_at=c.get("updated_at"),
+                    ))
+        return cls(version, types, faculties_by_type, records)
+
+    @classmethod
+    def from_rows(cls, version: str, course_rows: List[Dict]) -> "CourseCatalog":
+        """จากแถวของชีตรายวิชา (ผ่าน _normalize_course_row ของ app.py แล้ว) — ประเภท = ชื่อหมวดภาษาไทย"""
+        types = {c: c for c in sorted({r["course_type"] for r in course_rows if r.get("course_type")})}
+        fac_maps: Dict[str, Dict[str, str]] = defaultdict(dict)
+        for r in course_rows:
+            fac_maps[r["course_type"]][r["faculty"]] = r["faculty_name"] or r["faculty"]
+        records = [
+            CourseRecord(
+                course_type=sys.intern(r["course_type"]), faculty=sys.intern(r["faculty"]),
+                faculty_name=sys.intern(fac_maps[r["course_type"]][r["faculty"]]),
+                code=r["code"], name=r["name"], desc_th=r.get("desc_th", ""), desc_en=r.get("desc_en", ""),
+                credit=r.get("credit"), grading=r.get("grading"), prereq_en=r.get("prereq_en", ""),
+                updated_at=r.get("updated_at"),
+            )
+            for r in sorted(course_rows, key=lambda x: x.get("code", ""))
+        ]
+        return cls(version, types, fac_maps, records)
+
+    # ---------- lookups ----------
+
+    def list_faculties_by_type(self, course_type: str) -> Mapping[str, str]:
+        return self._fac_maps.get(course_type, MappingProxyType({}))
+
+    def list_courses(self, course_type: str, faculty_code: str) -> Tuple[CourseRecord, ...]:
+        return self._by_pair.get((course_type, faculty_code), ())
+
+    def courses_by_type(self, course_type: str) -> Tuple[CourseRecord, ...]:
+        return self._by_type.get(course_type, ())
+
+    def courses_by_faculty(self, faculty_code: str) -> Tuple[CourseRecord, ...]:
+        return self._by_faculty.get(faculty_code, ())
+
+    def courses_by_faculty_name(self, faculty_name: str) -> Tuple[CourseRecord, ...]:
+        return self.courses if faculty_name == "ทั้งหมด" else self._by_faculty_name.get(faculty_name, ())
+
+    def get(self, code: str) -> Optional[CourseRecord]:
+        return self.by_code.get(code)
+
+    def faculty_options(self) -> Tuple[str, ...]:
+        return self._faculty_options
+
+
+def catalog_version(*parts) -> str:
+    """เวอร์ชันของคาแทล็อก = hash ของข้อมูลต้นทาง (ข้อมูลเปลี่ยน → สร้าง index ใหม่เอง แม้ไม่ได้รีสตาร์ต)"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,16 @@
+"""
+app_2.py อ่าน st.secrets ตอน import — ให้ชี้ไปที่ secrets.toml ชั่วคราว และรันในโฟลเดอร์ชั่วคราว
+(ไฟล์ใน data/ ที่แอปสร้างจะไม่ไปปนกับ repo)
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="mu-reviews-tests-")
+os.makedirs(os.path.join(WORKDIR, ".streamlit"))
+with open(os.path.join(WORKDIR, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+    f.write('STORAGE_BACKEND = "local"\nPASSWORD_HASH_TARGET_MS = 1\n')
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,111 @@
+"""gspread Spreadsheet/Worksheet แบบในหน่วยความจำ — รองรับเฉพาะเมธอดที่ GoogleSheetsStorage ใช้"""
+import itertools
+import re
+
+_ids = itertools.count(100)
+
+
+def _col(letters: str) -> int:
+    c = 0
+    for ch in letters:
+        c = c * 26 + ord(ch) - 64
+    return c - 1
+
+
+class FakeWorksheet:
+    def __init__(self, ss, title):
+        self.ss, self.title, self.id, self.grid = ss, title, next(_ids), []
+
+    def _log(self, op):
+        self.ss.calls.append((self.title, op))
+
+    def get_all_values(self):
+        self._log("get_all_values")
+        return [list(r) for r in self.grid]
+
+    def row_values(self, n):
+        self._log("row_values")
+        return list(self.grid[n - 1]) if len(self.grid) >= n else []
+
+    def col_values(self, n):
+        self._log("col_values")
+        out = [r[n - 1] if len(r) >= n else "" for r in self.grid]
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def clear(self):
+        self._log("clear")
+        self.grid = []
+
+    def update(self, rng, values=None, **kw):
+        self._log("update")
+        m = re.match(r"([A-Z]+)(\d+)", rng)
+        row0, col0 = int(m.group(2)) - 1, _col(m.group(1))
+        for i, vals in enumerate(values):
+            while len(self.grid) <= row0 + i:
+                self.grid.append([])
+            row = self.grid[row0 + i]
+            while len(row) < col0 + len(vals):
+                row.append("")
+            for j, v in enumerate(vals):
+                row[col0 + j] = str(v)
+
+    def append_row(self, row, **kw):
+        self._log("append_row")
+        self.grid.append([str(v) for v in row])
+        n = len(self.grid)
+        return {"updates": {"updatedRange": f"{self.title}!A{n}:G{n}"}}
+
+    def get(self, rng, **kw):
+        self._log("get")
+        m = re.match(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?", rng)
+        r0, c0 = int(m.group(2)) - 1, _col(m.group(1))
+        r1 = int(m.group(4)) - 1 if m.group(4) else r0
+        c1 = _col(m.group(3)) if m.group(3) else c0
+        out = []
+        for r in range(r0, min(r1, len(self.grid) - 1) + 1):
+            row = self.grid[r]
+            out.append([row[c] if c < len(row) else "" for c in range(c0, c1 + 1)])
+        return out
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheets, self.calls = {}, []
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        self.calls.append((title, "add_worksheet"))
+        ws = self.sheets[title] = FakeWorksheet(self, title)
+        return ws
+
+    def _by_id(self, sid):
+        return next(w for w in self.sheets.values() if w.id == sid)
+
+    def batch_update(self, body):
+        self.calls.append(("*", "batch_update"))
+        for req in body["requests"]:
+            (kind, p), = req.items()
+            if kind == "updateCells":
+                ws = self._by_id(p["start"]["sheetId"])
+                r0, c0 = p["start"]["rowIndex"], p["start"]["columnIndex"]
+                for i, rd in enumerate(p["rows"]):
+                    while len(ws.grid) <= r0 + i:
+                        ws.grid.append([])
+                    row = ws.grid[r0 + i]
+                    vals = [c["userEnteredValue"]["stringValue"] for c in rd["values"]]
+                    while len(row) < c0 + len(vals):
+                        row.append("")
+                    row[c0:c0 + len(vals)] = vals
+            elif kind == "deleteDimension":
+                rg = p["range"]
+                del self._by_id(rg["sheetId"]).grid[rg["startIndex"]:rg["endIndex"]]
+            elif kind == "appendCells":
+                ws = self._by_id(p["sheetId"])
+                ws.grid.extend([c["userEnteredValue"]["stringValue"] for c in rd["values"]] for rd in p["rows"])
+            else:
+                raise ValueError(kind)
+        return {}
@@ -0,0 +1,50 @@
+import pytest
+
+from course_catalog import CourseCatalog, CourseRecord, catalog_version
+
+TYPES = {"GE": "วิชาศึกษาทั่วไป", "MAJOR": "วิชาเฉพาะ"}
+FACULTIES = {"GE": {"SH": "คณะสังคมศาสตร์"}, "MAJOR": {"SC": "คณะวิทยาศาสตร์"}}
+NESTED = {
+    "GE": {"SH": [{"code": "SHHS 101", "name": "Humanities"}]},
+    "MAJOR": {"SC": [{"code": "SCMA 243", "name": "Operating Systems", "credit": "3(3-0-6)"},
+                     {"code": "SCMA 240", "name": "Data Structures"}]},
+}
+
+
+@pytest.fixture
+def catalog():
+    return CourseCatalog.from_nested("v1", TYPES, FACULTIES, NESTED)
+
+
+def test_indexes(catalog):
+    assert [c["code"] for c in catalog.courses] == ["SHHS 101", "SCMA 240", "SCMA 243"]
+    assert [c.code for c in catalog.list_courses("MAJOR", "SC")] == ["SCMA 243", "SCMA 240"]
+    assert catalog.courses_by_faculty_name("ทั้งหมด") == catalog.courses
+    assert catalog.faculty_options() == ("ทั้งหมด", "คณะวิทยาศาสตร์", "คณะสังคมศาสตร์")
+    assert catalog.get("SCMA 243").get("credit") == "3(3-0-6)"
+    assert catalog.get("nope") is None
+
+
+def test_records_are_immutable_and_dict_like(catalog):
+    rec = catalog.get("SHHS 101")
+    assert rec["type"] == "GE" and rec["department"] == "" and rec.get("missing", 1) == 1
+    with pytest.raises(AttributeError):
+        rec.name = "x"
+    with pytest.raises(AttributeError):
+        catalog.version = "v2"
+    with pytest.raises(TypeError):
+        catalog.list_faculties_by_type("GE")["XX"] = "y"
+
+
+def test_from_rows_matches_sheet_layout():
+    rows = [{"course_type": "เฉพาะ", "faculty": "SC", "faculty_name": "", "code": "SCMA 2", "name": "B"},
+            {"course_type": "เฉพาะ", "faculty": "SC", "faculty_name": "", "code": "SCMA 1", "name": "A"}]
+    cat = CourseCatalog.from_rows("v", rows)
+    assert [c.code for c in cat.courses] == ["SCMA 1", "SCMA 2"]
+    assert dict(cat.list_faculties_by_type("เฉพาะ")) == {"SC": "SC"}
+    assert isinstance(cat.courses[0], CourseRecord)
+
+
+def test_catalog_version_tracks_content():
+    assert catalog_version(NESTED) == catalog_version(dict(NESTED))
+    assert catalog_version(NESTED) != catalog_version({"GE": {}})
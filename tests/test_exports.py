@@ -0,0 +1,39 @@
+import csv
+import gzip
+import json
+
+import app_2
+from app_2 import ExportManager
+
+
+def rows(n):
+    return [{"id": f"r{i}", "course_code": "SC101", "rating": i % 5 + 1, "text": f"ข้อความ {i}"} for i in range(n)]
+
+
+def test_source_is_built_inside_the_job(tmp_path):
+    mgr = ExportManager(str(tmp_path))
+    calls = []
+
+    def make_source():
+        calls.append(True)
+        return iter(rows(5))
+
+    key = (1, "approved_reviews", (), "csv")
+    fut = mgr.submit(key, "csv", make_source)
+    assert mgr.submit(key, "csv", make_source) is fut  # งานเดิม ไม่สร้างซ้ำ
+    with open(fut.result(timeout=10), encoding="utf-8", newline="") as f:
+        got = list(csv.DictReader(f))
+    assert calls == [True]
+    assert [r["id"] for r in got] == [f"r{i}" for i in range(5)]
+    assert got[1]["text"] == "ข้อความ 1"
+
+
+def test_progress_is_reported_per_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_2, "EXPORT_CHUNK_ROWS", 10)
+    mgr = ExportManager(str(tmp_path))
+    key = (1, "approved_reviews", (), "jsonl.gz")
+    assert mgr.progress_of(key) == 0
+    path = mgr.submit(key, "jsonl.gz", lambda: rows(25)).result(timeout=10)
+    assert mgr.progress_of(key) == 20
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == [f"r{i}" for i in range(25)]
@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+
+import pytest
+
+from app_2 import LocalJSONStorage
+
+
+def make_review(i, **kw):
+    r = {"id": f"r{i}", "course_code": "SCMA 243", "course_name": "Operating Systems",
+         "rating": 4, "year": 0, "text": f"review {i}", "status": "pending",
+         "created_at": f"2025-01-{i:02d}"}
+    r.update(kw)
+    return r
+
+
+def open_storage(tmp_path, **kw):
+    kw.setdefault("compact_min_lines", 10_000)  # ปิด compaction อัตโนมัติ ให้เทสต์สั่งเอง
+    return LocalJSONStorage(str(tmp_path / "data.json"), segment_dir=str(tmp_path / "segments"),
+                            fsync=False, **kw)
+
+
+def ids(storage, bucket):
+    return [r["id"] for r in storage.load_data()[bucket]]
+
+
+def segment_lines(storage, bucket):
+    with open(storage._segment(bucket), encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.fixture
+def storage(tmp_path):
+    s = open_storage(tmp_path)
+    for i in range(1, 6):
+        s.append_review(make_review(i))
+    return s
+
+
+def test_replay_matches_in_memory_state(storage, tmp_path):
+    storage.move_reviews(["r2", "r4"], "pending_reviews", "approved_reviews", status="approved")
+    storage.move_reviews(["r5"], "pending_reviews", None)
+    storage.upsert_user({"email": "A@x", "role": "student"})
+    storage.upsert_user({"email": "a@x", "is_verified": True})
+
+    fresh = open_storage(tmp_path)  # แคชว่าง → replay จากไฟล์ล้วน ๆ
+    for s in (storage, fresh):
+        assert ids(s, "pending_reviews") == ["r1", "r3"]
+        assert ids(s, "approved_reviews") == ["r2", "r4"]
+        assert {r["status"] for r in s.load_data()["approved_reviews"]} == {"approved"}
+        assert s.get_user("a@x") == {"email": "a@x", "role": "student", "is_verified": True}
+    ops = segment_lines(storage, "pending_reviews")
+    assert [op["k"] for op in ops if op.get("d")] == ["r2", "r4", "r5"]
+
+
+def test_save_data_appends_only_the_difference(storage):
+    before = len(segment_lines(storage, "pending_reviews"))
+    data = storage.load_data()
+    data["pending_reviews"][0]["text"] = "edited"
+    del data["pending_reviews"][1]
+    storage.save_data(data)
+    ops = segment_lines(storage, "pending_reviews")[before:]
+    assert ops == [{"k": "r2", "d": 1}, {"k": "r1", "v": data["pending_reviews"][0]}]
+    assert ids(storage, "pending_reviews") == ["r1", "r3", "r4", "r5"]
+
+
+def test_compaction_keeps_live_records_and_shrinks_file(storage):
+    for i in range(1, 6):
+        storage.move_reviews([f"r{i}"], "pending_reviews", "approved_reviews")
+    storage.append_review(make_review(9))
+    assert len(segment_lines(storage, "pending_reviews")) == 11
+    assert storage.compact("pending_reviews")
+    assert segment_lines(storage, "pending_reviews") == [{"k": "r9", "v": make_review(9)}]
+    assert ids(storage, "pending_reviews") == ["r9"]
+    assert not storage.compact("pending_reviews")  # ไม่มีขยะแล้ว
+
+
+def test_appends_during_compaction_are_carried_over(storage, tmp_path, monkeypatch):
+    storage.move_reviews(["r1", "r2"], "pending_reviews", None)
+    real_apply = LocalJSONStorage._apply
+    appended = []
+
+    def apply(state, rec):
+        # แทรกการเขียนจากอีกเธรดระหว่างที่ compact กำลัง parse snapshot นอก lock
+        if not appended:
+            appended.append(True)
+            t = threading.Thread(target=storage.append_review, args=(make_review(7),))
+            t.start()
+            t.join()
+        real_apply(state, rec)
+
+    monkeypatch.setattr(storage, "_apply", apply)
+    assert storage.compact("pending_reviews")
+    monkeypatch.undo()
+    assert ids(storage, "pending_reviews") == ["r3", "r4", "r5", "r7"]
+    assert ids(open_storage(tmp_path), "pending_reviews") == ["r3", "r4", "r5", "r7"]
+
+
+def test_background_compaction_triggers_on_garbage_ratio(tmp_path):
+    s = open_storage(tmp_path, compact_min_lines=10, compact_ratio=0.5)
+    for i in range(1, 11):
+        s.append_review(make_review(i))
+    s.move_reviews([f"r{i}" for i in range(1, 9)], "pending_reviews", None)
+    deadline = time.monotonic() + 5
+    while s.compactions == 0 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert s.compactions == 1
+    assert ids(s, "pending_reviews") == ["r9", "r10"]
+    assert len(segment_lines(s, "pending_reviews")) == 2
+
+
+def test_torn_last_line_is_skipped_and_not_glued_to_the_next(storage, tmp_path):
+    with open(storage._segment("pending_reviews"), "ab") as f:
+        f.write(b'{"k": "r8", "v": {"id": "r8", "te')
+    fresh = open_storage(tmp_path)
+    assert ids(fresh, "pending_reviews") == ["r1", "r2", "r3", "r4", "r5"]
+    fresh.append_review(make_review(6))
+    assert ids(open_storage(tmp_path), "pending_reviews") == ["r1", "r2", "r3", "r4", "r5", "r6"]
+
+
+def test_legacy_json_and_log_are_imported_once(tmp_path):
+    (tmp_path / "data.json").write_text(json.dumps({
+        "pending_reviews": [make_review(1), make_review(2)],
+        "approved_reviews": [],
+        "users": [{"email": "a@x", "role": "student"}],
+    }), encoding="utf-8")
+    log = [
+        {"op": "append", "bucket": "pending_reviews", "review": make_review(3)},
+        {"op": "move", "ids": ["r1"], "from": "pending_reviews", "to": "approved_reviews", "status": "approved"},
+        {"op": "upsert_user", "user": {"email": "a@x", "is_verified": True}},
+    ]
+    (tmp_path / "data.log.jsonl").write_text(
+        "".join(json.dumps(op) + "\n" for op in log) + '{"op": "app', encoding="utf-8")
+    s = open_storage(tmp_path)
+    assert ids(s, "pending_reviews") == ["r2", "r3"]
+    assert ids(s, "approved_reviews") == ["r1"]
+    assert s.get_user("a@x") == {"email": "a@x", "role": "student", "is_verified": True}
+
+    (tmp_path / "data.json").write_text("{}", encoding="utf-8")  # import ไปแล้ว ไม่อ่านซ้ำ
+    assert ids(open_storage(tmp_path), "pending_reviews") == ["r2", "r3"]
+
+
+def test_group_commit_writes_waiting_threads_together(storage):
+    commits = storage.commits
+    threads = [threading.Thread(target=storage.append_review, args=(make_review(10 + i),)) for i in range(4)]
+    with storage._locked():
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while len(storage._queue) < len(threads) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    for t in threads:
+        t.join()
+    assert storage.commits == commits + 1
+    assert storage.committed_writes >= 4
+    assert sorted(ids(storage, "pending_reviews")) == sorted([f"r{i}" for i in range(1, 6)] +
+                                                             [f"r{10 + i}" for i in range(4)])
+
+
+def test_writes_do_not_mutate_state_handed_to_readers(storage):
+    state = storage._load("pending_reviews")
+    before = dict(state)
+    misses = storage.cache_misses
+    storage.append_review(make_review(6))
+    storage.move_reviews(["r1"], "pending_reviews", None)
+    assert state == before
+    assert list(storage._load("pending_reviews")) == ["r2", "r3", "r4", "r5", "r6"]
+    assert storage.cache_misses == misses  # แคชเดินหน้าต่อ ไม่ต้อง parse ใหม่
+
+
+def test_token_is_consumed_once(storage):
+    storage.add_token({"token": "t1", "email": "a@x", "type": "reset", "expires_at": "2999-01-01T00:00:00",
+                       "used": False, "created_at": ""})
+    assert storage.mark_token_used("t1")
+    assert not storage.mark_token_used("t1")
+    assert storage.sweep_tokens("2025-01-01T00:00:00") == 1
+    assert storage.load_tokens() == []
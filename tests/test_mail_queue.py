@@ -0,0 +1,73 @@
+import os
+import time
+
+import app_2
+from app_2 import MailQueue
+
+
+class RecordingQueue(MailQueue):
+    """MailQueue ที่ "ส่ง" โดยจดไว้ในลิสต์แทนการต่อ SMTP"""
+
+    def __init__(self, spool_dir, fail_for=(), **kw):
+        self.sent, self.fail_for = [], set(fail_for)
+        super().__init__(spool_dir, "localhost", 25, idle=0.05, **kw)
+
+    def _send(self, item):
+        if item["to"] in self.fail_for:
+            raise ConnectionRefusedError("smtp down")
+        self.sent.append(item["to"])
+
+
+def wait_for(cond, timeout=5.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_sends_and_clears_spool(tmp_path):
+    q = RecordingQueue(str(tmp_path))
+    try:
+        q.enqueue("a@x", "s", "b", "App <app@x>")
+        q.enqueue("b@x", "s", "b", "App <app@x>")
+        assert wait_for(lambda: q.sent == ["a@x", "b@x"])
+        assert q.pending() == []
+        assert q.stats()["sent"] == 2
+    finally:
+        q.stop()
+
+
+def test_worker_survives_errors_outside_smtp(tmp_path, monkeypatch):
+    q = RecordingQueue(str(tmp_path), fail_for={"bad@x"}, max_attempts=1)
+    real_write = q._write
+
+    def write(path, item):
+        if os.path.dirname(path) == q.failed_dir:
+            raise OSError(28, "No space left on device")
+        real_write(path, item)
+
+    monkeypatch.setattr(q, "_write", write)
+    try:
+        q.enqueue("bad@x", "s", "b", "App <app@x>")
+        assert wait_for(lambda: q.counters["errors"] >= 1)
+        assert "No space left" in q.last_error
+        assert q._thread.is_alive()
+        q.enqueue("good@x", "s", "b", "App <app@x>")
+        assert wait_for(lambda: "good@x" in q.sent)
+    finally:
+        q.stop()
+
+
+def test_send_email_does_not_require_login(monkeypatch, tmp_path):
+    cfg = dict(host="relay.local", port=25, user=None, password=None, sender="noreply@x",
+               sender_name="App", use_ssl=False, starttls=False, reply_to=None)
+    q = RecordingQueue(str(tmp_path))
+    monkeypatch.setattr(app_2, "smtp_settings", lambda: cfg)
+    monkeypatch.setattr(app_2, "get_mail_queue", lambda: q)
+    try:
+        assert app_2.send_email("a@x", "s", "b")
+        assert wait_for(lambda: q.sent == ["a@x"])
+    finally:
+        q.stop()
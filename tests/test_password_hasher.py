@@ -0,0 +1,92 @@
+import hashlib
+import threading
+
+import pytest
+
+import app_2
+from app_2 import PasswordHasher, PasswordHasherBusy
+
+
+@pytest.fixture(scope="module", params=["scrypt", "pbkdf2_sha256"])
+def hasher(request):
+    h = PasswordHasher(kdf=request.param, target_ms=1, workers=1, queue=1, timeout=5)
+    yield h
+    h._pool.shutdown(wait=True)
+
+
+def test_hash_verify_round_trip(hasher):
+    stored = hasher.hash("s3cret", "salt")
+    assert stored.startswith(hasher.kdf + "$")
+    assert hasher.verify("s3cret", "salt", stored)
+    assert not hasher.verify("wrong", "salt", stored)
+    assert not hasher.verify("s3cret", "other-salt", stored)
+    assert not hasher.needs_rehash(stored)
+
+
+def test_legacy_sha256_verifies_and_needs_rehash(hasher):
+    legacy = hashlib.sha256(("salt" + "s3cret").encode("utf-8")).hexdigest()
+    assert hasher.verify("s3cret", "salt", legacy)
+    assert not hasher.verify("wrong", "salt", legacy)
+    assert hasher.needs_rehash(legacy)
+
+
+def test_lower_cost_needs_rehash(hasher):
+    parts = hasher.hash("s3cret", "salt").split("$")
+    parts[1] = str(int(parts[1]) // 2)
+    assert hasher.needs_rehash("$".join(parts))
+
+
+@pytest.mark.parametrize("stored", [
+    "", "scrypt$abc$8$1$00", "scrypt$3$8$1$00", f"scrypt${2 ** 40}$8$1$00",
+    "pbkdf2_sha256$x$00", "pbkdf2_sha256$0$00", "pbkdf2_sha256$1000$ไม่ใช่hex", "ไม่ใช่hash",
+])
+def test_malformed_hash_is_a_mismatch(hasher, stored):
+    assert hasher.verify("s3cret", "salt", stored) is False
+
+
+def test_slot_is_held_until_the_work_finishes():
+    h = PasswordHasher(kdf="pbkdf2_sha256", target_ms=1, workers=1, queue=0, timeout=0.2)
+    gate = threading.Event()
+    try:
+        with pytest.raises(PasswordHasherBusy, match="timed out"):
+            h._run(gate.wait)
+        # งานแรกยังค้างอยู่ใน worker → slot ยังไม่คืน คำขอใหม่ต้องเจอคิวเต็ม
+        with pytest.raises(PasswordHasherBusy, match="queue is full"):
+            h._run(lambda: "never")
+        gate.set()
+        assert h._run(lambda: "ok") == "ok"
+    finally:
+        gate.set()
+        h._pool.shutdown(wait=True)
+
+
+def test_check_user_password_upgrades_legacy_hash(monkeypatch):
+    saved = []
+    monkeypatch.setattr(app_2, "upsert_user", saved.append)
+    legacy = hashlib.sha256(("salt" + "s3cret").encode("utf-8")).hexdigest()
+    user = {"email": "a@b", "password_salt": "salt", "password_hash": legacy}
+    assert app_2.check_user_password(user, "s3cret")
+    (upgraded,) = saved
+    assert upgraded["password_hash"].startswith(app_2.PASSWORD_KDF + "$")
+    assert app_2.verify_password("s3cret", upgraded["password_salt"], upgraded["password_hash"])
+
+
+@pytest.mark.parametrize("stored", [
+    f"pbkdf2_sha256${app_2.PBKDF2_MAX_ITERATIONS + 1}$00",
+    f"pbkdf2_sha256${10 ** 12}$00",
+    f"scrypt${2 ** 14}${2 ** 20}$1$00",   # r ใหญ่ → หน่วยความจำมหาศาล
+    f"scrypt${2 ** 14}$8${2 ** 16}$00",   # p ใหญ่ → เวลาคำนวณหลายนาที
+    f"scrypt${2 ** 14}$0$1$00",
+    f"scrypt${2 ** 14}$8$0$00",
+])
+def test_oversized_cost_is_rejected_without_running_the_kdf(hasher, stored, monkeypatch):
+    monkeypatch.setattr(hasher, "_run", lambda *a: pytest.fail("KDF should not run"))
+    assert hasher.verify("s3cret", "salt", stored) is False
+
+
+def test_calibrated_cost_stays_within_the_verify_bounds():
+    h = PasswordHasher(kdf="pbkdf2_sha256", target_ms=10 ** 9, workers=1, queue=1)
+    try:
+        assert h.params == (app_2.PBKDF2_MAX_ITERATIONS,)
+    finally:
+        h._pool.shutdown(wait=True)
@@ -0,0 +1,98 @@
+import app_2
+from app_2 import ReviewSearchIndex
+
+
+def review(rid, text, code="SCMA 243", name="Operating Systems"):
+    return {"id": rid, "course_code": code, "course_name": name, "text": text}
+
+
+def ids(index, query):
+    return [rid for rid, _ in index.search(query)]
+
+
+def test_terms_are_and_of_prefixes():
+    idx = ReviewSearchIndex()
+    idx.sync([review("a", "great programming homework"), review("b", "boring lectures")], 1)
+    assert ids(idx, "prog") == ["a"]
+    assert ids(idx, "homework prog") == ["a"]
+    assert ids(idx, "prog boring") == []
+    assert set(ids(idx, "operating")) == {"a", "b"}
+
+
+def test_quoted_phrase_must_be_consecutive():
+    idx = ReviewSearchIndex()
+    idx.sync([review("a", "hard but fair exam"), review("b", "fair but hard exam")], 1)
+    assert ids(idx, '"hard but"') == ["a"]
+    assert set(ids(idx, "hard but")) == {"a", "b"}
+
+
+def test_thai_text_matches_inside_words():
+    idx = ReviewSearchIndex()
+    idx.sync([review("a", "อาจารย์สอนดีมาก การบ้านเยอะ")], 1)
+    assert ids(idx, "การบ้าน") == ["a"]
+
+
+def test_sync_adds_removes_and_reindexes_changed_rows():
+    idx = ReviewSearchIndex()
+    rows = [review("a", "old words"), review("b", "stay here")]
+    idx.sync(rows, 1)
+    assert ids(idx, "old") == ["a"]
+
+    rows = [review("a", "new words", code="SCMA 240", name="Data Structures"), review("c", "fresh", code="SCMA 101", name="Calculus")]
+    idx.sync(rows, 2)
+    assert ids(idx, "old") == []
+    assert ids(idx, "new") == ["a"]
+    assert ids(idx, "structures") == ["a"]
+    assert ids(idx, "operating") == []
+    assert ids(idx, "stay") == []
+    assert ids(idx, "fresh") == ["c"]
+    assert len(idx) == 2
+    assert idx._total_len == sum(idx._doc_len.values())
+
+
+def test_sync_is_a_noop_for_the_same_generation():
+    idx = ReviewSearchIndex()
+    idx.sync([review("a", "one")], 5)
+    idx.sync([review("a", "two")], 5)
+    assert ids(idx, "one") == ["a"]
+
+
+def test_remove_drops_unused_vocabulary():
+    idx = ReviewSearchIndex()
+    idx.add(review("a", "unique"))
+    idx.remove("a")
+    assert "unique" not in idx._vocab and not idx._postings
+    assert app_2.search_tokens("Hello, World") == ["hello", "world"]
+
+
+class RacyCache(app_2.DataCache):
+    """DataCache ที่มีการเขียนแทรกทันทีหลังคืน snapshot (generation ขยับก่อนผู้เรียกอ่านรุ่นแยก)"""
+
+    def get_versioned(self, storage):
+        out = super().get_versioned(storage)
+        self.generation += 1
+        return out
+
+    def get(self, storage):
+        return self.get_versioned(storage)[0]
+
+
+def test_index_is_keyed_by_the_generation_of_the_data_it_indexed(monkeypatch):
+    rows = {"pending_reviews": [review("a", "first")], "approved_reviews": []}
+
+    class Storage:
+        def load_data(self):
+            return rows
+
+    cache = RacyCache()
+    monkeypatch.setattr(app_2, "get_data_cache", lambda: cache)
+    monkeypatch.setattr(app_2, "get_storage", lambda: Storage())
+    monkeypatch.setattr(app_2, "_review_search_indexes",
+                        lambda _i={"pending_reviews": ReviewSearchIndex()}: _i)
+
+    idx = app_2.get_review_search_index("pending_reviews")
+    assert idx.generation == 1 and cache.generation == 2
+    rows = {"pending_reviews": [review("a", "second")], "approved_reviews": []}
+    cache.data = None  # รอบหน้าต้องโหลดใหม่
+    idx = app_2.get_review_search_index("pending_reviews")
+    assert ids(idx, "second") == ["a"]
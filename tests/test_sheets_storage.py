@@ -0,0 +1,256 @@
+import pytest
+
+import app_2
+from fakesheets import FakeSpreadsheet
+
+
+class FakeSheetsStorage(app_2.GoogleSheetsStorage):
+    def __init__(self, ss=None):
+        self._init_state()
+        self.ss = ss or FakeSpreadsheet()
+
+
+def make_review(i, **kw):
+    r = {"id": f"r{i}", "course_type": "GE", "faculty": "SC", "faculty_name": "Science",
+         "department": "", "department_name": "", "year": 1, "course_code": f"SC10{i % 3}",
+         "course_name": "Course", "rating": i % 5 + 1, "text": f"text {i}", "author": "a@x",
+         "created_at": f"2025-01-{i:02d}", "status": "pending"}
+    r.update(kw)
+    return r
+
+
+def as_strings(rows):
+    return [{k: str(v) for k, v in r.items()} for r in rows]
+
+
+def sheet_ids(storage, bucket):
+    grid = storage.ss.sheets[bucket].grid
+    col = grid[0].index("id")
+    return [row[col] for row in grid[1:]]
+
+
+@pytest.fixture
+def storage():
+    s = FakeSheetsStorage()
+    s.save_data({"pending_reviews": [make_review(i) for i in range(1, 8)], "approved_reviews": []})
+    s.load_data()
+    return s
+
+
+def test_plan_bucket_diff_emits_row_level_requests(storage):
+    ws = storage.ws_pending
+    wanted = [make_review(i) for i in (1, 3, 4, 5, 7)] + [make_review(9)]
+    wanted[1]["text"] = "edited"
+    requests, snap = storage._plan_bucket_diff("pending_reviews", ws, wanted)
+
+    kinds = [next(iter(r)) for r in requests]
+    assert kinds == ["updateCells", "deleteDimension", "deleteDimension", "appendCells"]
+    assert requests[0]["updateCells"]["start"]["rowIndex"] == 3  # r3 = แถวข้อมูลที่ 3 → rowIndex 3 (หัวตาราง = 0)
+    deleted = [(r["deleteDimension"]["range"]["startIndex"], r["deleteDimension"]["range"]["endIndex"])
+               for r in requests[1:3]]
+    assert deleted == [(6, 7), (2, 3)]  # ลบจากล่างขึ้นบน: r6 แล้ว r2
+    assert snap["ids"] == ["r1", "r3", "r4", "r5", "r7", "r9"]
+
+
+def test_plan_bucket_diff_requires_ids(storage):
+    assert storage._plan_bucket_diff("pending_reviews", storage.ws_pending, [{"text": "no id"}]) is None
+
+
+def test_save_data_round_trip_and_noop(storage):
+    data = storage.load_data()
+    moved = [r for r in data["pending_reviews"] if r["id"] in ("r2", "r6")]
+    data = {"pending_reviews": [dict(r) for r in data["pending_reviews"] if r not in moved],
+            "approved_reviews": [dict(r, status="approved") for r in moved]}
+    data["pending_reviews"][0]["text"] = "changed"
+    storage.save_data(data)
+
+    fresh = FakeSheetsStorage(storage.ss).load_data()
+    assert as_strings(fresh["pending_reviews"]) == as_strings(data["pending_reviews"])
+    assert as_strings(fresh["approved_reviews"]) == as_strings(data["approved_reviews"])
+
+    storage.ss.calls.clear()
+    storage.save_data(fresh)
+    assert ("*", "batch_update") not in storage.ss.calls
+
+
+def test_save_data_after_rows_shifted_outside_the_app(storage):
+    data = storage.load_data()
+    # มีคนแทรกแถวบนสุดในชีตเอง (ไม่ bump stamp) → เลขแถวใน snapshot เลื่อนหมด
+    grid = storage.ss.sheets["pending_reviews"].grid
+    grid.insert(1, storage._dicts_to_rows([make_review(50)], grid[0])[0])
+
+    wanted = [dict(r) for r in data["pending_reviews"] if r["id"] != "r4"]
+    storage.ss.calls.clear()
+    storage.save_data({"pending_reviews": wanted, "approved_reviews": []})
+    assert sheet_ids(storage, "pending_reviews") == ["r50"] + [r["id"] for r in wanted]
+    assert ("pending_reviews", "clear") not in storage.ss.calls
+
+
+def test_save_data_keeps_changes_committed_by_another_process(storage):
+    data = storage.load_data()
+    other = FakeSheetsStorage(storage.ss)  # อีกโปรเซส: ลบ r1, เพิ่ม r8, แก้ r3 (ทุกอย่าง bump stamp)
+    other.move_reviews(["r1"], "pending_reviews")
+    other.append_review(make_review(8))
+    theirs = other.load_data()
+    theirs["pending_reviews"] = [dict(r, text="edited elsewhere") if r["id"] == "r3" else r
+                                 for r in theirs["pending_reviews"]]
+    other.save_data(theirs)
+
+    # ผู้เรียกยังถือรายการเก่า: ลบ r7, แก้ r2, เพิ่ม r9
+    wanted = [dict(r, text="edited here") if r["id"] == "r2" else dict(r)
+              for r in data["pending_reviews"] if r["id"] != "r7"] + [make_review(9)]
+    storage.ss.calls.clear()
+    storage.save_data({"pending_reviews": wanted, "approved_reviews": []})
+
+    assert ("pending_reviews", "clear") not in storage.ss.calls
+    rows = {r["id"]: r for r in FakeSheetsStorage(storage.ss).load_data()["pending_reviews"]}
+    assert list(rows) == ["r2", "r3", "r4", "r5", "r6", "r8", "r9"]
+    assert rows["r2"]["text"] == "edited here"
+    assert rows["r3"]["text"] == "edited elsewhere"
+    assert [r["id"] for r in storage.load_data()["pending_reviews"]] == list(rows)
+
+
+def test_move_requests_delete_source_rows_and_append_to_destination(storage):
+    requests = storage._move_requests(["r2", "r3", "r6"], "pending_reviews", "approved_reviews", "approved")
+    kinds = [next(iter(r)) for r in requests]
+    assert kinds == ["deleteDimension", "deleteDimension", "appendCells"]
+    spans = [(r["deleteDimension"]["range"]["startIndex"], r["deleteDimension"]["range"]["endIndex"])
+             for r in requests[:2]]
+    assert spans == [(6, 7), (2, 4)]
+    appended = requests[2]["appendCells"]
+    assert appended["sheetId"] == storage.ws_approved.id
+    status_col = storage._snapshots["approved_reviews"]["headers"].index("status")
+    assert [row["values"][status_col]["userEnteredValue"]["stringValue"] for row in appended["rows"]] == ["approved"] * 3
+    assert storage._snapshots["pending_reviews"]["ids"] == ["r1", "r4", "r5", "r7"]
+    # เล่นซ้ำ (เช่น journal หลัง crash) → ไม่มีอะไรต้องทำ
+    assert storage._move_requests(["r2"], "pending_reviews", "approved_reviews", "approved") == []
+
+
+def assert_id_sets_match(storage):
+    for snap in storage._snapshots.values():
+        assert snap["id_set"] == set(snap["ids"])
+
+
+def test_append_skips_ids_already_on_either_sheet(storage):
+    storage.move_reviews(["r2"], "pending_reviews", "approved_reviews", "approved")
+    assert storage._append_requests(make_review(2)) == []  # อยู่ชีต approved แล้ว
+    assert storage._append_requests(make_review(3)) == []
+    assert len(storage._append_requests(make_review(20))) == 1
+    assert storage._append_requests(make_review(20)) == []  # journal เล่นซ้ำ
+    assert_id_sets_match(storage)
+
+    storage.save_data({"pending_reviews": [make_review(1)], "approved_reviews": []})
+    assert_id_sets_match(storage)
+    assert len(storage._append_requests(make_review(3))) == 1
+
+
+def test_move_reviews_after_rows_shifted_outside_the_app(storage):
+    storage.load_data()
+    grid = storage.ss.sheets["pending_reviews"].grid
+    del grid[1]  # มีคนลบ r1 ในชีตเอง → r2 เลื่อนขึ้นมาอยู่แถวของ r1
+
+    storage.move_reviews(["r3"], "pending_reviews", "approved_reviews", "approved")
+    assert sheet_ids(storage, "pending_reviews") == ["r2", "r4", "r5", "r6", "r7"]
+    assert sheet_ids(storage, "approved_reviews") == ["r3"]
+
+
+def test_write_behind_flush_reloads_stale_snapshot(storage, tmp_path):
+    storage.load_data()
+    storage._wb_ops = []
+    storage._wb_journal = str(tmp_path / "journal.jsonl")
+    storage._wb_lock = app_2.threading.Lock()
+    storage._wb_wake = app_2.threading.Event()
+    other = FakeSheetsStorage(storage.ss)
+    other.move_reviews(["r1", "r2"], "pending_reviews")
+
+    storage._enqueue({"op": "move", "ids": ["r5"], "from": "pending_reviews", "to": None, "status": None})
+    assert storage.flush() == 1
+    assert sheet_ids(storage, "pending_reviews") == ["r3", "r4", "r6", "r7"]
+
+
+def make_token(i, **kw):
+    t = {"token": f"t{i}", "email": "a@x", "type": "reset", "expires_at": "2999-01-01T00:00:00",
+         "used": False, "created_at": "2025-01-01T00:00:00"}
+    t.update(kw)
+    return t
+
+
+@pytest.fixture
+def token_storage():
+    s = FakeSheetsStorage()
+    s.save_tokens([make_token(1, used=True), make_token(2), make_token(3, used=True), make_token(4)])
+    return s
+
+
+TOKENS_USED = app_2.TOKENS_HEADERS.index("used")
+
+
+def token_rows(storage):
+    return [(row[0], row[TOKENS_USED]) for row in storage.ss.sheets["tokens"].grid[1:]]
+
+
+def test_sweep_tokens_after_another_process_swept(token_storage):
+    other = FakeSheetsStorage(token_storage.ss)
+    assert other.sweep_tokens("2026-01-01T00:00:00") == 2
+    # index ของ token_storage ยังชี้แถวเดิม (t1..t4) — sweep ซ้ำต้องไม่ลบ t2/t4 ที่ยังใช้ได้
+    assert token_storage.sweep_tokens("2026-01-01T00:00:00") == 0
+    assert [t for t, _ in token_rows(token_storage)] == ["t2", "t4"]
+
+
+def test_mark_token_used_after_rows_shifted(token_storage):
+    token_storage.get_token("t4")
+    FakeSheetsStorage(token_storage.ss).sweep_tokens("2026-01-01T00:00:00")
+    assert token_storage.mark_token_used("t4") is True
+    assert token_rows(token_storage) == [("t2", "False"), ("t4", "True")]
+    assert token_storage.mark_token_used("t4") is False
+
+
+def make_user(name, **kw):
+    u = {"email": f"{name}@x", "password_salt": "s", "password_hash": f"h-{name}", "role": "student",
+         "display": name, "is_verified": False, "created_at": "2025-01-01T00:00:00"}
+    u.update(kw)
+    return u
+
+
+@pytest.fixture
+def user_storage():
+    s = FakeSheetsStorage()
+    s.save_users([make_user("a"), make_user("b"), make_user("c")])
+    return s
+
+
+def user_rows(storage):
+    users = FakeSheetsStorage(storage.ss).load_users()
+    assert len({u["email"] for u in users}) == len(users), "แถวผู้ใช้ซ้ำ"
+    return {u["email"]: u for u in users}
+
+
+def test_upsert_user_after_rows_shifted(user_storage):
+    user_storage.get_user("b@x")
+    del user_storage.ss.sheets["users"].grid[1]  # มีคนลบแถวของ a ในชีตเอง → b เลื่อนขึ้นไปแถวของ a
+
+    user_storage.upsert_user({"email": "c@x", "display": "C"})
+    rows = user_rows(user_storage)
+    assert list(rows) == ["b@x", "c@x"]
+    assert rows["b@x"]["display"] == "b"
+    assert rows["c@x"]["display"] == "C"
+
+
+def test_upsert_user_writes_only_the_given_columns(user_storage):
+    user_storage.get_user("a@x")
+    FakeSheetsStorage(user_storage.ss).upsert_user({"email": "a@x", "is_verified": True,
+                                                    "password_hash": "h-new"})
+
+    user_storage.upsert_user({"email": "A@x", "display": "Alice"})  # index ของเรายังเป็นค่าเก่า
+    a = user_rows(user_storage)["a@x"]
+    assert (a["display"], a["is_verified"], a["password_hash"]) == ("Alice", True, "h-new")
+
+
+def test_upsert_new_user_appends_once(user_storage):
+    user_storage.get_user("a@x")
+    FakeSheetsStorage(user_storage.ss).upsert_user(make_user("d"))
+    user_storage.upsert_user({"email": "d@x", "display": "D"})
+    user_storage.upsert_user(make_user("e"))
+    rows = user_rows(user_storage)
+    assert list(rows) == ["a@x", "b@x", "c@x", "d@x", "e@x"]
+    assert rows["d@x"]["display"] == "D" and rows["d@x"]["password_hash"] == "h-d"
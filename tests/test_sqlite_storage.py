@@ -0,0 +1,44 @@
+from app_2 import LocalJSONStorage, SQLiteStorage
+
+
+def make_review(i, **kw):
+    r = {"id": f"r{i}", "course_type": "GE", "faculty": "SC", "faculty_name": "Science",
+         "department": "", "department_name": "", "year": 1, "course_code": "SC101",
+         "course_name": "Course", "rating": 4, "text": f"text {i}", "author": "a@x",
+         "created_at": f"2025-01-{i:02d}", "status": "pending"}
+    r.update(kw)
+    return r
+
+
+def ids(data, bucket):
+    return [r["id"] for r in data[bucket]]
+
+
+def test_moved_reviews_go_to_the_end_of_the_destination(tmp_path):
+    db = SQLiteStorage(str(tmp_path / "reviews.db"))
+    db.save_data({"pending_reviews": [make_review(i) for i in (1, 2, 3)],
+                  "approved_reviews": [make_review(i, status="approved") for i in (4, 5)]})
+    db.move_reviews(["r3", "r1"], "pending_reviews", "approved_reviews", status="approved")
+    db.move_reviews(["r2"], "pending_reviews", None)
+
+    data = db.load_data()
+    assert ids(data, "pending_reviews") == []
+    assert ids(data, "approved_reviews") == ["r4", "r5", "r1", "r3"]  # ตามลำดับเดิมในต้นทาง เหมือน _apply_move
+    assert {r["status"] for r in data["approved_reviews"]} == {"approved"}
+    assert data["approved_reviews"][2] == make_review(1, status="approved")
+
+
+def test_first_start_imports_local_segments(tmp_path, monkeypatch):
+    segments = tmp_path / "segments"
+    monkeypatch.setattr("app_2.LOCAL_SEGMENT_DIR", str(segments))
+    local = LocalJSONStorage(str(tmp_path / "data.json"), segment_dir=str(segments), fsync=False)
+    local.append_review(make_review(1))
+    local.append_review(make_review(2))
+    local.move_reviews(["r1"], "pending_reviews", "approved_reviews", status="approved")
+    local.upsert_user({"email": "a@x", "role": "student"})
+
+    db = SQLiteStorage(str(tmp_path / "reviews.db"), import_local=str(tmp_path / "data.json"))
+    data = db.load_data()
+    assert ids(data, "pending_reviews") == ["r2"]
+    assert ids(data, "approved_reviews") == ["r1"]
+    assert db.get_user("a@x")["role"] == "student"